@@ -1,8 +1,13 @@
 import logging
+import json
 import uuid
 import argparse
-from flask import Flask, request, jsonify
-from models import db, Task, Tag, TaskStatusLog, PeerDevice
+from flask import Flask, request, jsonify, Response, stream_with_context
+from models import db, Task, Tag, TaskStatusLog, PeerDevice, TaskTombstone, NotificationLedger, task_tag, ensure_schema, get_random_bright_hex_color
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached, noload
+from sqlalchemy.orm.util import identity_key
 from datetime import datetime, timezone, timedelta
 import os
 from pathlib import Path
@@ -10,11 +15,21 @@ from dotenv import load_dotenv
 from dateutil import parser
 import requests
 import traceback
-from tag_suggester import TagSuggester
+from tag_suggester import TagSuggester, SuggesterUpdater, lemma_cache
+from sync_digest import DigestTree, task_digest, format_hash
+from deadline_scheduler import DeadlineScheduler
+from sync_wire import (
+    supported_formats, supported_encodings, parse_header_tokens, negotiate, wire_of,
+    request_headers, content_headers, encode_items, decode_items, decode_response, CHUNK_SIZE
+)
 import threading
 import atexit
 import tempfile
+import sqlite3
 import sys
+import time
+import random
+from collections import defaultdict
 
 # === Глобальные переменные (инициализируются в create_app) ===
 TMP_ENV_PATH = None
@@ -22,9 +37,57 @@ TELEGRAM_CONFIG = {}
 PORT = None
 BASE_DIR = None
 INSTANCE_DIR = None
-NOTIFIED_CACHE = set()
 app = None
 
+# Максимум задач в одном запросе /suggest-tags/batch
+SUGGEST_BATCH_LIMIT = 1000
+
+# Размер пачки имён в одном запросе Tag.name IN (...)
+TAG_QUERY_CHUNK = 500
+
+# UPDATE/INSERT ... RETURNING появились в SQLite 3.35; на более старых id дочитываются отдельным SELECT
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35)
+
+# Размер пачки элементов, сливаемых за раз при потоковом приёме синхронизации
+SYNC_MERGE_CHUNK = 1000
+
+# Размер страницы потоковой выгрузки синхронизации (задачи вместе с их тегами и логами)
+SYNC_EXPORT_PAGE = 500
+
+# Перекрытие окна дельта-выгрузки: изменения, закоммиченные во время выгрузки, не теряются
+SYNC_WATERMARK_OVERLAP = timedelta(seconds=5)
+# Сверка по дереву хэшей: корзину с таким числом задач (у любой стороны) сверяем поштучно
+DIGEST_LEAF_ITEMS = 32
+# Максимум префиксов в одном запросе /sync/digest
+DIGEST_PREFIX_LIMIT = 4096
+# Максимум uuid в одном запросе /sync/tasks/fetch и в одной отправке при сверке
+SYNC_FETCH_LIMIT = 2000
+
+# Сколько пропущенных периодов цепи повторений догонять за проход (более старые пропускаются)
+RECURRENCE_CATCHUP_LIMIT = 100
+
+# Журнал отправленных уведомлений: записи завершённых задач живут столько после их последнего
+# изменения; о провале, случившемся раньше, уже не уведомляем
+NOTIFY_LEDGER_TTL = timedelta(days=30)
+# Как часто чистить журнал (при сборе уведомлений)
+NOTIFY_LEDGER_PRUNE_INTERVAL = timedelta(hours=1)
+# Поля задачи, от которых зависит её следующее уведомление (notify_at, notify_type)
+NOTIFY_SCHEDULE_FIELDS = ("status", "planned_at", "due_at", "grace_end", "duration_seconds")
+# Лента уведомлений /notify/stream: событий за чтение, keep-alive в простое (с), пауза переподключения (мс)
+NOTIFY_STREAM_BATCH = 200
+NOTIFY_STREAM_KEEPALIVE = 15
+NOTIFY_STREAM_RETRY_MS = 3000
+
+# Пул keep-alive соединений к пирам (общий для всех потоков синхронизации)
+SYNC_POOL_HOSTS = 16
+SYNC_POOL_SIZE = 8
+# Отсрочка после неудачной синхронизации: BASE * 2^(ошибок-1) с разбросом, не больше MAX (секунды)
+SYNC_BACKOFF_BASE = 30
+SYNC_BACKOFF_MAX = 3600
+
+# Статусы, из которых задача по истечении due_at становится overdue
+EXPIRING_STATUSES = ("planned", "inProgress")
+
 
 def cleanup_tmp_env():
     """Удаляет временный env-файл при завершении."""
@@ -88,12 +151,100 @@ def create_app(env_path: Path):
     return app
 
 
-def setup_routes(app, env_path: Path):
-    global TELEGRAM_CONFIG, TMP_ENV_PATH, PORT, NOTIFIED_CACHE
+def setup_routes(app, env_path: Path, background: bool = True):
+    """
+    Регистрирует эндпоинты. background=False — без фоновых потоков и сбора уведомлений
+    при старте: так работает наблюдающий процесс перезагрузчика Werkzeug, который
+    запросов не обслуживает (иначе два процесса гонялись бы за журналом уведомлений).
+    """
+    global TELEGRAM_CONFIG, TMP_ENV_PATH, PORT
 
     suggester_lock = threading.Lock()
     tag_suggester = None
 
+    # === Кэш тегов: имя -> цвет для тегов, уже существующих в БД ===
+    tag_cache = {}
+
+    @event.listens_for(db.session, "after_commit")
+    def publish_new_tags(session):
+        # Созданные теги попадают в общий кэш только после коммита: иначе другой поток
+        # мог бы привязать задачу к тегу из транзакции, которая затем откатится
+        tag_cache.update(session.info.pop("new_tags", {}))
+
+    @event.listens_for(db.session, "after_rollback")
+    def drop_new_tags(session):
+        session.info.pop("new_tags", None)
+
+    def normalize_tag_names(names):
+        result = []
+        for name in names or []:
+            if not isinstance(name, str):
+                continue
+            name = name.strip().lower()
+            if name and name not in result:
+                result.append(name)
+        return result
+
+    def resolve_tags(names):
+        """
+        Возвращает {имя: Tag} для всех имён за не более чем один IN-запрос на пачку.
+        Известные теги берутся из сессии или кэша без обращения к БД, недостающие создаются.
+        """
+        resolved = {}
+        unknown = []
+        for name in normalize_tag_names(names):
+            tag = db.session.identity_map.get(identity_key(Tag, name))
+            if tag is None and name in tag_cache:
+                tag = Tag(name=name, color=tag_cache[name])
+                make_transient_to_detached(tag)
+                db.session.add(tag)
+            if tag is None:
+                unknown.append(name)
+            else:
+                resolved[name] = tag
+        for start in range(0, len(unknown), TAG_QUERY_CHUNK):
+            for tag in Tag.query.filter(Tag.name.in_(unknown[start:start + TAG_QUERY_CHUNK])).all():
+                resolved[tag.name] = tag
+                tag_cache[tag.name] = tag.color
+        new_tags = [Tag(name=name, color=get_random_bright_hex_color()) for name in unknown if name not in resolved]
+        if new_tags:
+            db.session.add_all(new_tags)
+            pending = db.session.info.setdefault("new_tags", {})
+            for tag in new_tags:
+                resolved[tag.name] = tag
+                pending[tag.name] = tag.color
+        return resolved
+
+    def insert_tasks(rows):
+        """Вставляет задачи одним executemany и возвращает {uuid: id}."""
+        if SQLITE_RETURNING:
+            return {u: i for i, u in db.session.execute(db.insert(Task).returning(Task.id, Task.uuid), rows)}
+        db.session.execute(db.insert(Task), rows)
+        uuids = [row["uuid"] for row in rows]
+        ids = {}
+        for start in range(0, len(uuids), TAG_QUERY_CHUNK):
+            ids.update(db.session.execute(
+                db.select(Task.uuid, Task.id).where(Task.uuid.in_(uuids[start:start + TAG_QUERY_CHUNK]))).all())
+        return ids
+
+    def transition_tasks(scope, condition, status, now):
+        """
+        Переводит подходящие задачи в status одним UPDATE и возвращает [(uuid, id)].
+        Без RETURNING сменившие статус находятся по отметке modified_at этого вызова:
+        строки, которые успел перевести другой процесс, несут другую отметку.
+        """
+        update = db.update(Task).where(condition, scope) \
+            .values(status=status, modified_at=now, notify_at=now, notify_type=status)
+        if SQLITE_RETURNING:
+            return db.session.execute(update.returning(Task.uuid, Task.id)).all()
+        db.session.execute(update)
+        return db.session.execute(
+            db.select(Task.uuid, Task.id).where(Task.status == status, Task.modified_at == now, scope)).all()
+
+    def tags_for(names):
+        resolved = resolve_tags(names)
+        return [resolved[name] for name in normalize_tag_names(names)]
+
     def create_task_with_log(
         title,
         note=None,
@@ -117,6 +268,8 @@ def setup_routes(app, env_path: Path):
             tags = []
         if task_uuid is None:
             task_uuid = str(uuid.uuid4())
+        if creation_time is None:
+            creation_time = datetime.now(timezone.utc)
         
         task = Task(
             uuid=task_uuid,
@@ -133,17 +286,12 @@ def setup_routes(app, env_path: Path):
             next_uuid=next_uuid,
             origin_uuid=origin_uuid
         )
-        resolved_tags = []
-        for name in tags:
-            name = name.strip().lower()
-            if not name:
-                continue
-            tag = Tag.query.filter_by(name=name).first()
-            if not tag:
-                tag = Tag(name=name)
-                db.session.add(tag)
-            resolved_tags.append(tag)
-        task.tags = resolved_tags
+        if recurrence_seconds > 0 and origin_uuid is None:
+            # Новая цепь: якорь и момент первого порождения — на голове
+            task.recurrence_anchor_at = creation_time
+            task.recurrence_next_at = creation_time + timedelta(seconds=recurrence_seconds)
+            task.recurrence_tail_uuid = task_uuid
+        task.tags = tags_for(tags)
         db.session.add(task)
         db.session.flush()
 
@@ -151,30 +299,119 @@ def setup_routes(app, env_path: Path):
         log_entry = TaskStatusLog(
             task_uuid=task.uuid,
             status=status,
-            changed_at=creation_time if creation_time is not None else datetime.now(timezone.utc)
+            changed_at=creation_time
         )
         db.session.add(log_entry)
         return task
 
     
+    lemma_cache_path = INSTANCE_DIR / "lemma_cache.json"
+
+    def save_lemma_cache():
+        try:
+            lemma_cache.save(lemma_cache_path)
+        except OSError as e:
+            logging.warning(f"Не удалось сохранить кэш лемм: {e}")
+
+    tag_model_path = INSTANCE_DIR / "tag_model.bin"
+
+    def training_item(task):
+        return {
+            "text": f"{task.title} {task.note or ''}",
+            "tags": [tag.name for tag in task.tags]
+        }
+
+    def db_watermark():
+        """
+        Отметка состояния БД, с которой сверяется сохранённая модель. Берётся локальный
+        modified_at: слитые с пира задачи сохраняют его более старый updated_at.
+        """
+        count, max_modified = db.session.query(db.func.count(Task.id), db.func.max(Task.modified_at)).one()
+        return {
+            "count": count,
+            "max_modified_at": max_modified.isoformat() if max_modified else None
+        }
+
+    def load_tag_model(watermark):
+        """Загружает сохранённую модель, если она согласована с БД; иначе None."""
+        if not tag_model_path.exists():
+            return None
+        try:
+            suggester = TagSuggester.load(tag_model_path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Сохранённая модель тегов отклонена: {e}")
+            return None
+        saved = suggester.watermark
+        if saved.get("count") is None or "max_modified_at" not in saved:
+            return None  # модель прежней версии: отметка по updated_at теряла слитые задачи
+        if saved["count"] > watermark["count"]:
+            return None  # задачи удалялись — дообучение дельтой невозможно
+        if saved["max_modified_at"] and watermark["max_modified_at"] and \
+                saved["max_modified_at"] > watermark["max_modified_at"]:
+            return None
+        return suggester
+
     def init_tag_suggester():
         nonlocal tag_suggester
+        loaded = lemma_cache.load(lemma_cache_path)
         with app.app_context():
-            tasks_from_db = Task.query.all()
-            training_data = [
-                {
-                    "text": f"{task.title} {task.note or ''}",
-                    "tags": [tag.name for tag in task.tags]
-                }
-                for task in tasks_from_db
-                if task.tags
-            ]
-            tag_suggester = TagSuggester(tasks=training_data)
-
+            watermark = db_watermark()
+            suggester = load_tag_model(watermark)
+            if suggester is None:
+                training_data = [training_item(task) for task in Task.query.all() if task.tags]
+                suggester = TagSuggester(tasks=training_data)
+                changed = True
+                source = "полное обучение"
+            else:
+                # Дообучаем только задачами, изменёнными после сохранения модели
+                saved_max = suggester.watermark.get("max_modified_at")
+                query = Task.query
+                if saved_max:
+                    query = query.filter(Task.modified_at > datetime.fromisoformat(saved_max))
+                delta = [training_item(task) for task in query.all() if task.tags]
+                for item in delta:
+                    suggester.add_task(item["text"], item["tags"])
+                changed = bool(delta) or suggester.watermark != watermark
+                source = f"модель из {tag_model_path.name}, дельта {len(delta)}"
+            if changed:
+                try:
+                    suggester.save(tag_model_path, watermark)
+                except OSError as e:
+                    logging.warning(f"Не удалось сохранить модель тегов: {e}")
+            tag_suggester = suggester
+        print(f"🧠 Автоподбор тегов готов ({source}): загружено лемм из кэша — {loaded}, статистика {lemma_cache.stats()}")
+        save_lemma_cache()
+        atexit.register(save_lemma_cache)
+
+    if not SQLITE_RETURNING:
+        logging.warning(f"SQLite {sqlite3.sqlite_version} не поддерживает RETURNING (нужна 3.35+): "
+                        f"id вставленных и сменивших статус задач дочитываются отдельными запросами")
     with app.app_context():
-        db.create_all()
+        ensure_schema()
         init_tag_suggester()
 
+    def current_watermark():
+        with app.app_context():
+            return db_watermark()
+
+    def persist_tag_model(watermark):
+        """
+        Сохраняет дообученную модель с отметкой, снятой до применения последней пачки:
+        после рестарта дельта начнётся не позже первой не попавшей в модель задачи.
+        Вызывается из потока дообучения — тяжёлая часть save идёт вне suggester_lock.
+        """
+        tag_suggester.save(tag_model_path, watermark, lock=suggester_lock)
+
+    # Единственный фоновый поток дообучения вместо потока на каждую запись
+    suggester_updates = SuggesterUpdater(lambda: tag_suggester, suggester_lock, on_persist=persist_tag_model,
+                                         get_watermark=current_watermark)
+    if background:
+        suggester_updates.start()
+
+    def enqueue_suggester_update(task):
+        if task.tags:
+            suggester_updates.submit(f"{task.title} {task.note or ''}", [tag.name for tag in task.tags])
+
     # === Эндпоинты ===
     @app.route('/suggest-tags', methods=['POST'])
     def suggest_tags():
@@ -189,6 +426,36 @@ def setup_routes(app, env_path: Path):
             tags = tag_suggester.suggest_tags(text, top_k_tags=3)
         return jsonify({"suggested_tags": tags}), 200
 
+    @app.route('/suggest-tags/batch', methods=['POST'])
+    def suggest_tags_batch():
+        data = request.get_json(silent=True)
+        if not isinstance(data, list):
+            return jsonify({"error": "Ожидается список {title, note}"}), 400
+        if len(data) > SUGGEST_BATCH_LIMIT:
+            return jsonify({"error": f"Не более {SUGGEST_BATCH_LIMIT} задач за запрос"}), 400
+        texts = []
+        for index, item in enumerate(data):
+            if not isinstance(item, dict):
+                return jsonify({"error": f"Элемент {index}: ожидается объект {{title, note}}"}), 400
+            fields = [item.get('title'), item.get('note')]
+            if any(value is not None and not isinstance(value, str) for value in fields):
+                return jsonify({"error": f"Элемент {index}: title и note должны быть строками"}), 400
+            texts.append(" ".join((value or '').strip() for value in fields).strip())
+        if tag_suggester is None:
+            return jsonify({"suggested_tags": [[] for _ in texts]}), 200
+        with suggester_lock:
+            tags = tag_suggester.suggest_tags_batch(texts, top_k_tags=3)
+        return jsonify({"suggested_tags": tags}), 200
+
+    @app.route('/suggest-tags/stats', methods=['GET'])
+    def suggest_tags_stats():
+        return jsonify({
+            "updates": suggester_updates.stats(),
+            "lemma_cache": lemma_cache.stats(),
+            "documents": len(tag_suggester.tasks) if tag_suggester else 0,
+            "backend": tag_suggester.backend if tag_suggester else None
+        }), 200
+
     @app.route('/tags', methods=['GET'])
     def list_tags():
         tags = Tag.query.order_by(Tag.name).all()
@@ -204,6 +471,7 @@ def setup_routes(app, env_path: Path):
                 return jsonify({"error": "Цвет должен быть в формате #RRGGBB"}), 400
             tag.color = color
         db.session.commit()
+        tag_cache[tag.name] = tag.color
         return jsonify(tag.to_dict()), 200
 
     @app.route('/tasks', methods=['POST'])
@@ -234,6 +502,8 @@ def setup_routes(app, env_path: Path):
                     grace_end = grace_end.replace(tzinfo=timezone.utc)
             except ValueError:
                 pass
+        if grace_end and grace_end < due_at:
+            return jsonify({"error": "'grace_end' cannot be earlier than 'due_at'"}), 400
         task_uuid = data.get('uuid')
         if task_uuid and Task.query.filter_by(uuid=task_uuid).first():
             return jsonify({"error": "Task with this UUID already exists"}), 409
@@ -257,18 +527,7 @@ def setup_routes(app, env_path: Path):
             task_uuid=task_uuid
         )
         db.session.commit()
-        task_title = task.title
-        task_note = task.note or ''
-        task_tag_names = [tag.name for tag in task.tags]
-
-        def update_suggester():
-            nonlocal tag_suggester
-            with app.app_context():
-                if tag_suggester and task_tag_names:
-                    text = f"{task_title} {task_note}"
-                    with suggester_lock:
-                        tag_suggester.add_task(text, task_tag_names)
-        threading.Thread(target=update_suggester, daemon=True).start()
+        enqueue_suggester_update(task)
         return jsonify(task.to_dict()), 201
 
     @app.route('/tasks', methods=['GET'])
@@ -312,6 +571,7 @@ def setup_routes(app, env_path: Path):
     @app.route('/tasks/<int:task_id>', methods=['DELETE'])
     def delete_task(task_id):
         task = Task.query.get_or_404(task_id)
+        db.session.merge(TaskTombstone(uuid=task.uuid, deleted_at=datetime.now(timezone.utc)))
         db.session.delete(task)
         db.session.commit()
         return jsonify({"message": "Задача уничтожена во славу Омниссии"}), 200
@@ -334,6 +594,7 @@ def setup_routes(app, env_path: Path):
             task.note = data.get('note')
         if 'priority' in data:
             task.priority = data['priority']
+        previous_status = task.status
         if 'status' in data and data['status'] != task.status:
             new_status = data['status']
             if new_status == 'done' and task.status != 'done':
@@ -348,6 +609,7 @@ def setup_routes(app, env_path: Path):
                 setattr(task, field, int(data.get(field, 0)))
         if 'dependencies' in data:
             task.dependencies = data.get('dependencies', [])
+        previous_deadlines = (task.planned_at, task.due_at, task.grace_end)
         if 'deadlines' in data:
             deadlines = data['deadlines']
             if 'due_at' in deadlines:
@@ -367,32 +629,30 @@ def setup_routes(app, env_path: Path):
                         setattr(task, key, dt)
                     except ValueError:
                         pass
+            if task.grace_end and as_utc(task.grace_end) < as_utc(task.due_at):
+                return jsonify({"error": "'grace_end' cannot be earlier than 'due_at'"}), 400
         if 'tags' in data:
             tag_names = data.get('tags', [])
             if not isinstance(tag_names, list):
                 tag_names = []
-            tags = []
-            for name in tag_names:
-                name = name.strip().lower()
-                if not name:
-                    continue
-                tag = Tag.query.filter_by(name=name).first()
-                if not tag:
-                    tag = Tag(name=name)
-                    db.session.add(tag)
-                tags.append(tag)
-            task.tags = tags
+            task.tags = tags_for(tag_names)
+        # Перенесённый срок (например, «отложить») снова заслуживает своего уведомления.
+        # Просрочка и провал — тоже, если сдвинут их срок или задача из этого статуса выведена
+        moved = [notification_type for notification_type, before, after in zip(
+            ("start", "due_warn", "grace_warn"), previous_deadlines, (task.planned_at, task.due_at, task.grace_end)
+        ) if as_utc(before) != as_utc(after)]
+        for notification_type, deadline_moved in (("overdue", "due_warn" in moved), ("failed", "grace_warn" in moved)):
+            if deadline_moved or (previous_status == notification_type and task.status != notification_type):
+                moved.append(notification_type)
+        if moved:
+            db.session.execute(db.delete(NotificationLedger).where(
+                NotificationLedger.task_uuid == task.uuid, NotificationLedger.type.in_(moved)
+            ))
         db.session.commit()
-        def update_suggester():
-            nonlocal tag_suggester
-            with app.app_context():
-                task = Task.query.get(task_id)
-                if task and task.tags:
-                    text = f"{task.title} {task.note or ''}"
-                    tags = [tag.name for tag in task.tags]
-                    with suggester_lock:
-                        tag_suggester.add_task(text, tags)
-        threading.Thread(target=update_suggester, daemon=True).start()
+        if 'recurrence_seconds' in data and task.origin_uuid is None:
+            anchor_chains([task.uuid])
+            db.session.commit()
+        enqueue_suggester_update(task)
         return jsonify(task.to_dict()), 200
 
     @app.route('/')
@@ -408,13 +668,19 @@ def setup_routes(app, env_path: Path):
             "changed_at": log.changed_at.isoformat() + 'Z' if log.changed_at else None
         } for log in logs]), 200
 
+    # Общая сессия HTTP к пирам: соединения переиспользуются между синхронизациями
+    sync_http = requests.Session()
+    sync_http.mount('http://', requests.adapters.HTTPAdapter(pool_connections=SYNC_POOL_HOSTS, pool_maxsize=SYNC_POOL_SIZE))
+
     @app.route('/sync/handshake', methods=['GET'])
     def sync_handshake():
         return jsonify({
             "name": os.getenv('DEVICE_NAME', 'ThisIsFine'),
             "device_id": os.getenv('DEVICE_ID') or str(uuid.uuid4()),
             "version": "0.1",
-            "address": request.host
+            "address": request.host,
+            "formats": supported_formats(),
+            "encodings": supported_encodings()
         })
 
     @app.route('/sync/peers', methods=['GET'])
@@ -425,7 +691,8 @@ def setup_routes(app, env_path: Path):
             'name': p.name,
             'address': p.address,
             'device_id': p.device_id,
-            'last_sync': p.last_sync.isoformat() + 'Z' if p.last_sync else None
+            'last_sync': p.last_sync.isoformat() + 'Z' if p.last_sync else None,
+            'health': p.health_dict()
         } for p in peers])
 
     @app.route('/sync/peers', methods=['POST'])
@@ -435,7 +702,7 @@ def setup_routes(app, env_path: Path):
         if not addr or ':' not in addr:
             return jsonify({"error": "Неверный адрес"}), 400
         try:
-            res = requests.get(f"http://{addr}/sync/handshake", timeout=3)
+            res = sync_http.get(f"http://{addr}/sync/handshake", timeout=3)
             if res.status_code != 200:
                 return jsonify({"error": "Устройство не отвечает"}), 400
             info = res.json()
@@ -448,27 +715,381 @@ def setup_routes(app, env_path: Path):
         except Exception as e:
             return jsonify({"error": f"Ошибка: {str(e)}"}), 500
 
+    def parse_watermark(value):
+        """Разбирает ISO-отметку синхронизации; None — полная выгрузка."""
+        if not value:
+            return None
+        watermark = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if watermark.tzinfo is None:
+            watermark = watermark.replace(tzinfo=timezone.utc)
+        return watermark
+
+    def format_watermark(dt):
+        return dt.isoformat().replace('+00:00', 'Z')
+
+    def sync_export(since=None, uuids=None):
+        """
+        Выгрузка: задачи, связи тегов, логи, надгробия. Задачи читаются страницами по
+        SYNC_EXPORT_PAGE (по ключу id), теги и логи подгружаются для каждой страницы уже
+        в генераторе — память ограничена страницей, а не размером БД.
+        since — отметка этого узла: выгружаются только задачи, изменённые (или получившие логи) позже неё.
+        uuids — выгрузить только указанные задачи и надгробия (сверка по дереву хэшей).
+        Выгрузка — снимок на момент отметки: изменённое во время отдачи (например, наша же
+        отправка пиру) в неё не попадает и уйдёт со следующей, чья since — эта отметка.
+        Возвращает (генератор элементов, статистика); счётчики статистики растут по мере отдачи.
+        """
+        started = time.perf_counter()
+        watermark = datetime.now(timezone.utc)
+        task_filter = Task.modified_at <= watermark
+        tombstone_filter = TaskTombstone.deleted_at <= watermark
+        if since is not None:
+            since = since - SYNC_WATERMARK_OVERLAP
+            task_filter = db.and_(task_filter, db.or_(
+                Task.modified_at > since,
+                Task.uuid.in_(db.select(TaskStatusLog.task_uuid).where(TaskStatusLog.recorded_at > since))
+            ))
+            tombstone_filter = db.and_(tombstone_filter, TaskTombstone.deleted_at > since)
+        if uuids is not None:
+            task_filter = db.and_(task_filter, Task.uuid.in_(uuids))
+            tombstone_filter = db.and_(tombstone_filter, TaskTombstone.uuid.in_(uuids))
+        stats = {
+            "queries": 0,
+            "ms": round((time.perf_counter() - started) * 1000, 1),
+            "watermark": format_watermark(watermark),
+            "page_size": SYNC_EXPORT_PAGE,
+            "tasks": 0,
+            "tombstones": 0
+        }
+
+        def task_pages():
+            last_id = 0
+            while True:
+                tasks = (Task.query.options(noload(Task.tags))
+                         .filter(task_filter, Task.id > last_id)
+                         .order_by(Task.id).limit(SYNC_EXPORT_PAGE).all())
+                stats["queries"] += 1
+                if not tasks:
+                    return
+                last_id = tasks[-1].id
+
+                tags_by_task = defaultdict(list)
+                for task_id, tag_name in db.session.execute(
+                        db.select(task_tag.c.task_id, task_tag.c.tag_name)
+                        .where(task_tag.c.task_id.in_([task.id for task in tasks]))):
+                    tags_by_task[task_id].append(tag_name)
+
+                logs_by_uuid = defaultdict(list)
+                for task_uuid, status, changed_at in db.session.execute(
+                        db.select(TaskStatusLog.task_uuid, TaskStatusLog.status, TaskStatusLog.changed_at)
+                        .where(TaskStatusLog.task_uuid.in_([task.uuid for task in tasks]))
+                        .order_by(TaskStatusLog.id)):
+                    logs_by_uuid[task_uuid].append({
+                        "status": status,
+                        "changed_at": changed_at.isoformat() + 'Z' if changed_at else None
+                    })
+                stats["queries"] += 2
+                yield tasks, tags_by_task, logs_by_uuid
+                if len(tasks) < SYNC_EXPORT_PAGE:
+                    return
+
+        def items():
+            for tasks, tags_by_task, logs_by_uuid in task_pages():
+                for task in tasks:
+                    stats["tasks"] += 1
+                    yield {
+                        "task": task.to_dict(tag_names=tags_by_task.get(task.id, [])),
+                        "logs": logs_by_uuid.get(task.uuid, [])
+                    }
+            last_uuid = ""
+            while True:
+                tombstones = (TaskTombstone.query.filter(tombstone_filter, TaskTombstone.uuid > last_uuid)
+                              .order_by(TaskTombstone.uuid).limit(SYNC_EXPORT_PAGE).all())
+                stats["queries"] += 1
+                for tombstone in tombstones:
+                    stats["tombstones"] += 1
+                    yield {"tombstone": tombstone.to_dict()}
+                if len(tombstones) < SYNC_EXPORT_PAGE:
+                    return
+                last_uuid = tombstones[-1].uuid
+
+        return items(), stats
+
+    def export_headers(stats):
+        return {
+            "X-Sync-Export-Page-Size": str(stats["page_size"]),
+            "X-Sync-Export-Time-Ms": str(stats["ms"]),
+            "X-Sync-Watermark": stats["watermark"]
+        }
+
+    def export_response(items, stats):
+        """Потоковый ответ в формате и сжатии, согласованных по Accept / Accept-Encoding."""
+        fmt, encoding = negotiate(
+            parse_header_tokens(request.headers.get('Accept')),
+            parse_header_tokens(request.headers.get('Accept-Encoding'))
+        )
+        headers = {**export_headers(stats), **content_headers(fmt, encoding), "Vary": "Accept, Accept-Encoding"}
+        return Response(stream_with_context(encode_items(items, fmt, encoding)), headers=headers)
+
+    def read_sync_items():
+        """Элементы тела запроса: читаются и разбираются кусками, а не целиком."""
+        fmt, encoding = wire_of(request.mimetype, request.headers.get('Content-Encoding'))
+        chunks = iter(lambda: request.stream.read(CHUNK_SIZE), b'')
+        return decode_items(chunks, fmt, encoding)
+
+    # Пиры синхронизируются параллельно, но в SQLite пишет один: слияния идут по очереди,
+    # иначе длинные пачки упираются в блокировку записи ("database is locked")
+    sync_merge_lock = threading.Lock()
+
+    def merge_sync_stream(items):
+        """Сливает поток элементов пачками по SYNC_MERGE_CHUNK; возвращает суммарные счётчики."""
+        totals = defaultdict(int)
+        batch = []
+
+        def merge_batch():
+            with sync_merge_lock:
+                merged = merge_sync_data(batch)
+            for key, value in merged.items():
+                totals[key] += value
+            totals["received"] += len(batch)
+            batch.clear()
+
+        for item in items:
+            batch.append(item)
+            if len(batch) >= SYNC_MERGE_CHUNK:
+                merge_batch()
+        if batch:
+            merge_batch()
+        return dict(totals)
+
+    # Формат отправки для каждого пира — по его рукопожатию
+    peer_wire_cache = {}
+
+    def peer_wire(remote_url):
+        if remote_url not in peer_wire_cache:
+            try:
+                info = sync_http.get(f"{remote_url}/sync/handshake", timeout=3).json()
+            except (requests.RequestException, ValueError):
+                return negotiate([], [])  # не кэшируем: пир мог быть временно недоступен
+            peer_wire_cache[remote_url] = negotiate(info.get("formats"), info.get("encodings"))
+        return peer_wire_cache[remote_url]
+
+    def push_items(remote_url, items, timeout=30):
+        """Отправляет элементы пиру потоково, в формате, который он понимает."""
+        fmt, encoding = peer_wire(remote_url)
+        return sync_http.post(
+            f"{remote_url}/sync/tasks",
+            data=encode_items(items, fmt, encoding),
+            headers={"X-Sync-Token": os.getenv('SYNC_TOKEN'), **content_headers(fmt, encoding)},
+            timeout=timeout
+        )
+
     @app.route('/sync/tasks', methods=['GET'])
     def get_all_tasks_for_sync():
-        tasks = Task.query.all()
-        result = []
-        for task in tasks:
-            logs = TaskStatusLog.query.filter_by(task_uuid=task.uuid).all()
-            result.append({
-                "task": task.to_dict(),
-                "logs": [{"status": log.status, "changed_at": log.changed_at.isoformat() + 'Z'} for log in logs]
-            })
-        return jsonify(result)
+        try:
+            since = parse_watermark(request.args.get('since'))
+        except ValueError:
+            return jsonify({"error": "Неверный формат since"}), 400
+        items, stats = sync_export(since)
+        return export_response(items, stats)
 
     @app.route('/sync/tasks', methods=['POST'])
     def receive_sync_tasks():
         if request.headers.get('X-Sync-Token') != os.getenv('SYNC_TOKEN'):
             return jsonify({"error": "Access denied"}), 403
-        data = request.get_json()
-        if not isinstance(data, list):
-            return jsonify({"error": "Expected list of {task, logs}"}), 400
-        merge_sync_data(data)
-        return jsonify({"status": "ok"}), 200
+        try:
+            counts = merge_sync_stream(read_sync_items())
+        except ValueError as e:
+            # Пачки, слитые до ошибки, остаются: повторная отправка идемпотентна
+            db.session.rollback()
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"status": "ok", "received": 0, **counts}), 200
+
+    @app.route('/sync/tasks/fetch', methods=['POST'])
+    def fetch_sync_tasks():
+        """Выгрузка задач по списку uuid — вторая фаза сверки по дереву хэшей."""
+        if request.headers.get('X-Sync-Token') != os.getenv('SYNC_TOKEN'):
+            return jsonify({"error": "Access denied"}), 403
+        uuids = (request.get_json(silent=True) or {}).get('uuids')
+        if not isinstance(uuids, list):
+            return jsonify({"error": "Expected {uuids: [...]}"}), 400
+        if len(uuids) > SYNC_FETCH_LIMIT:
+            return jsonify({"error": f"Не более {SYNC_FETCH_LIMIT} uuid за запрос"}), 400
+        items, stats = sync_export(uuids=[str(u) for u in uuids])
+        return export_response(items, stats)
+
+    # === Дерево хэшей для сверки с пирами ===
+    # Хранится в памяти и догоняет БД по modified_at/recorded_at, как дельта-выгрузка
+    digest_state = {"tree": None, "built_at": None}
+    digest_lock = threading.Lock()
+
+    def load_task_digests(task_filter):
+        """{uuid: отпечаток} задач под фильтром — два запроса: задачи и их логи."""
+        logs_by_uuid = defaultdict(list)
+        log_rows = db.session.execute(
+            db.select(TaskStatusLog.task_uuid, TaskStatusLog.status, TaskStatusLog.changed_at)
+            .where(TaskStatusLog.task_uuid.in_(db.select(Task.uuid).where(task_filter)))
+        )
+        for task_uuid, status, changed_at in log_rows:
+            logs_by_uuid[task_uuid].append((status, changed_at))
+        task_rows = db.session.execute(db.select(Task.uuid, Task.updated_at).where(task_filter))
+        return {
+            task_uuid: task_digest(task_uuid, updated_at, logs_by_uuid.get(task_uuid, ()))
+            for task_uuid, updated_at in task_rows
+        }
+
+    def current_digest_tree():
+        """Дерево хэшей, доведённое до текущего состояния БД."""
+        with digest_lock:
+            started = datetime.now(timezone.utc)
+            tree = digest_state["tree"]
+            if tree is not None:
+                since = digest_state["built_at"] - SYNC_WATERMARK_OVERLAP
+                changed = load_task_digests(db.or_(
+                    Task.modified_at > since,
+                    Task.uuid.in_(db.select(TaskStatusLog.task_uuid).where(TaskStatusLog.recorded_at > since))
+                ))
+                for task_uuid, digest in changed.items():
+                    tree.set(task_uuid, digest)
+                for (task_uuid,) in db.session.execute(db.select(TaskTombstone.uuid).where(TaskTombstone.deleted_at > since)):
+                    tree.remove(task_uuid)
+                # Дерево содержит все задачи БД; лишние в нём — удаления без свежего надгробия
+                if db.session.scalar(db.select(db.func.count(Task.id))) != len(tree):
+                    tree = None
+            if tree is None:
+                tree = DigestTree()
+                for task_uuid, digest in load_task_digests(db.true()).items():
+                    tree.set(task_uuid, digest)
+            digest_state["tree"] = tree
+            digest_state["built_at"] = started
+            return tree
+
+    @app.route('/sync/digest', methods=['GET', 'POST'])
+    def sync_digest():
+        """
+        GET — корень дерева: {"hash", "count", "leaf_depth"}.
+        POST {"prefixes": [...]} — дочерние корзины: {"buckets": {префикс: [hash, count]}}.
+        POST {"items": [...]} — отпечатки задач под префиксами: {"items": {uuid: hash}}.
+        """
+        if request.headers.get('X-Sync-Token') != os.getenv('SYNC_TOKEN'):
+            return jsonify({"error": "Access denied"}), 403
+        if request.method == 'GET':
+            tree = current_digest_tree()
+            root_hash, count = tree.node("")
+            return jsonify({"hash": format_hash(root_hash), "count": count, "leaf_depth": tree.leaf_depth})
+
+        data = request.get_json(silent=True) or {}
+        prefixes = data.get('prefixes') or []
+        item_prefixes = data.get('items') or []
+        if not isinstance(prefixes, list) or not isinstance(item_prefixes, list):
+            return jsonify({"error": "prefixes и items должны быть списками"}), 400
+        if len(prefixes) + len(item_prefixes) > DIGEST_PREFIX_LIMIT:
+            return jsonify({"error": f"Не более {DIGEST_PREFIX_LIMIT} префиксов за запрос"}), 400
+
+        tree = current_digest_tree()
+        result = {}
+        if prefixes:
+            result["buckets"] = {
+                child: [format_hash(child_hash), count]
+                for prefix in prefixes
+                for child, (child_hash, count) in tree.children(str(prefix)).items()
+            }
+        if item_prefixes:
+            result["items"] = {
+                task_uuid: format_hash(digest)
+                for prefix in item_prefixes
+                for task_uuid, digest in tree.items(str(prefix)).items()
+            }
+        return jsonify(result)
+
+    def reconcile_with_peer(remote_url):
+        """
+        Сверка по дереву хэшей: спускаемся только в различающиеся корзины и
+        обмениваемся только различающимися задачами. Не зависит от часов узлов.
+        """
+        headers = {"X-Sync-Token": os.getenv('SYNC_TOKEN')}
+        stats = {"requests": 0, "bytes": 0, "buckets": 0, "fetched": 0, "pushed": 0, "probed": 0}
+
+        def post_digest(payload):
+            resp = sync_http.post(f"{remote_url}/sync/digest", json=payload, headers=headers, timeout=10)
+            resp.raise_for_status()
+            stats["requests"] += 1
+            stats["bytes"] += len(resp.content)
+            return resp.json()
+
+        tree = current_digest_tree()
+
+        # 1. Спуск по дереву: на каждом уровне один запрос на все различающиеся префиксы
+        frontier, leaf_prefixes = [""], []
+        while frontier:
+            remote = {}
+            for start in range(0, len(frontier), DIGEST_PREFIX_LIMIT):
+                remote.update(post_digest({"prefixes": frontier[start:start + DIGEST_PREFIX_LIMIT]})["buckets"])
+            local = {}
+            for prefix in frontier:
+                for child, (child_hash, count) in tree.children(prefix).items():
+                    local[child] = [format_hash(child_hash), count]
+            next_frontier = []
+            for child in sorted(set(local) | set(remote)):
+                local_node, remote_node = local.get(child), remote.get(child)
+                if local_node == remote_node:
+                    continue
+                largest = max(local_node[1] if local_node else 0, remote_node[1] if remote_node else 0)
+                if largest <= DIGEST_LEAF_ITEMS or len(child) >= tree.leaf_depth:
+                    leaf_prefixes.append(child)
+                else:
+                    next_frontier.append(child)
+            frontier = next_frontier
+        stats["buckets"] = len(leaf_prefixes)
+        if not leaf_prefixes:
+            return stats
+
+        # 2. Поштучное сравнение в различающихся корзинах
+        remote_items = {}
+        for start in range(0, len(leaf_prefixes), DIGEST_PREFIX_LIMIT):
+            remote_items.update(post_digest({"items": leaf_prefixes[start:start + DIGEST_PREFIX_LIMIT]})["items"])
+        local_items = {}
+        for prefix in leaf_prefixes:
+            for task_uuid, digest in tree.items(prefix).items():
+                local_items[task_uuid] = format_hash(digest)
+        to_fetch = [u for u, h in remote_items.items() if local_items.get(u) != h]
+        to_push = [u for u, h in local_items.items() if u in remote_items and remote_items[u] != h]
+        # Задачи, удалённые у нас, не загружаем обратно — отправляем пиру надгробия
+        deleted_here = load_tombstones([u for u in to_fetch if u not in local_items])
+        to_fetch = [u for u in to_fetch if u not in deleted_here]
+        to_push.extend(deleted_here)
+        # Задачи, которых у пира нет, он мог удалить: выгрузка пира по uuid содержит его
+        # надгробия, поэтому сначала запрашиваем их. Удалённые слияние удалит и у нас,
+        # отправляются только действительно отсутствующие у пира
+        local_only = [u for u in local_items if u not in remote_items]
+        stats["probed"] = len(local_only)
+
+        # 3. Обмен только различающимися задачами
+        requested = to_fetch + local_only
+        for start in range(0, len(requested), SYNC_FETCH_LIMIT):
+            resp = sync_http.post(
+                f"{remote_url}/sync/tasks/fetch",
+                json={"uuids": requested[start:start + SYNC_FETCH_LIMIT]},
+                headers={**headers, **request_headers()},
+                timeout=30,
+                stream=True
+            )
+            with resp:
+                resp.raise_for_status()
+                stats["requests"] += 1
+                merge_sync_stream(decode_response(resp))
+                stats["bytes"] += resp.raw.tell()
+        stats["fetched"] = len(to_fetch)
+        for start in range(0, len(local_only), TAG_QUERY_CHUNK):
+            to_push.extend(db.session.scalars(
+                db.select(Task.uuid).where(Task.uuid.in_(local_only[start:start + TAG_QUERY_CHUNK]))
+            ))
+        for start in range(0, len(to_push), SYNC_FETCH_LIMIT):
+            items, _ = sync_export(uuids=to_push[start:start + SYNC_FETCH_LIMIT])
+            resp = push_items(remote_url, items)
+            resp.raise_for_status()
+            stats["requests"] += 1
+        stats["pushed"] = len(to_push)
+        return stats
 
     @app.route('/sync/peers/<int:peer_id>', methods=['DELETE'])
     def delete_peer(peer_id):
@@ -477,6 +1098,58 @@ def setup_routes(app, env_path: Path):
         db.session.commit()
         return jsonify({"status": "ok"}), 200
 
+    def delta_sync_with_peer(peer, remote_url, full):
+        """Обмен изменениями после отметок пира; возвращает (результат, заголовки ответа)."""
+        # 1. Открываем выгрузку пира после его последней отметки: пир собирает её
+        #    до первого байта ответа, поэтому наша отправка в неё не попадёт
+        params = {"since": peer.remote_watermark} if peer.remote_watermark and not full else {}
+        remote_resp = sync_http.get(
+            f"{remote_url}/sync/tasks",
+            params=params,
+            headers={"X-Sync-Token": os.getenv('SYNC_TOKEN'), **request_headers()},
+            timeout=10,
+            stream=True
+        )
+        remote_resp.raise_for_status()
+
+        with remote_resp:
+            # 2. Отправляем наши изменения после отметки, которую пир уже подтвердил
+            since = None if full or not peer.push_watermark else peer.push_watermark
+            if since is not None and since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            items, stats = sync_export(since)
+            push_resp = push_items(remote_url, items)
+            if push_resp.status_code == 200:
+                peer.push_watermark = parse_watermark(stats["watermark"])
+
+            # 3. Сливаем выгрузку пира по мере чтения
+            merged = merge_sync_stream(decode_response(remote_resp))
+        # Отметку пира сохраняем только после успешного слияния
+        peer.remote_watermark = remote_resp.headers.get('X-Sync-Watermark')
+        return {
+            "tasks_received": merged.get("received", 0),
+            "merge": merged,
+            "tasks_sent": stats["tasks"] + stats["tombstones"],
+            "pushed": push_resp.status_code == 200
+        }, export_headers(stats)
+
+    def record_peer_attempt(peer, started, error=None):
+        """Обновляет здоровье пира; после ошибки назначает отсрочку с экспоненциальным ростом и разбросом."""
+        now = datetime.now(timezone.utc)
+        peer.last_attempt_at = now
+        peer.last_latency_ms = round((time.perf_counter() - started) * 1000, 1)
+        if error is None:
+            peer.last_sync = now
+            peer.last_error = None
+            peer.consecutive_failures = 0
+            peer.next_attempt_at = None
+        else:
+            peer.last_error = str(error)[:500]
+            peer.consecutive_failures = (peer.consecutive_failures or 0) + 1
+            delay = min(SYNC_BACKOFF_MAX, SYNC_BACKOFF_BASE * 2 ** (peer.consecutive_failures - 1))
+            peer.next_attempt_at = now + timedelta(seconds=random.uniform(delay / 2, delay))
+        db.session.commit()
+
     @app.route('/sync/peers/sync', methods=['POST'])
     def sync_with_peer():
         if request.headers.get('X-Sync-Token') != os.getenv('SYNC_TOKEN'):
@@ -486,160 +1159,233 @@ def setup_routes(app, env_path: Path):
         if not address:
             return jsonify({"error": "address required"}), 400
         peer = PeerDevice.query.filter_by(address=address).first_or_404()
+        peer_id = peer.id
+        full = bool(data.get('full'))  # принудительный полный обмен без отметок
+        remote_url = f"http://{address}"
+        started = time.perf_counter()
         try:
-            remote_url = f"http://{address}"
-            remote_tasks = requests.get(f"{remote_url}/sync/tasks", headers={"X-Sync-Token": os.getenv('SYNC_TOKEN')}, timeout=10).json()
-            local_sync_data = []
-            for task in Task.query.all():
-                logs = TaskStatusLog.query.filter_by(task_uuid=task.uuid).all()
-                local_sync_data.append({
-                    "task": task.to_dict(),
-                    "logs": [{"status": log.status, "changed_at": log.changed_at.isoformat() + 'Z'} for log in logs]
-                })
-            requests.post(f"{remote_url}/sync/tasks", json=local_sync_data, headers={"X-Sync-Token": os.getenv('SYNC_TOKEN')}, timeout=10)
-            merge_sync_data(remote_tasks)
-            peer.last_sync = datetime.now(timezone.utc)
-            db.session.commit()
-            return jsonify({"status": "ok", "tasks_received": len(remote_tasks)}), 200
+            if data.get('mode') == 'digest':
+                # Сверка по дереву хэшей: отметки времени не используются
+                result, headers = {"mode": "digest", **reconcile_with_peer(remote_url)}, {}
+            else:
+                result, headers = delta_sync_with_peer(peer, remote_url, full)
         except Exception as e:
+            db.session.rollback()
+            record_peer_attempt(db.session.get(PeerDevice, peer_id), started, error=e)
+            logging.warning(f"⚠️ Синхронизация с {address} не удалась: {e}")
             return jsonify({"error": f"Sync failed: {str(e)}\n{traceback.format_exc()}"}), 500
-        
+        record_peer_attempt(peer, started)
+        return jsonify({"status": "ok", **result, "health": peer.health_dict()}), 200, headers
+
+    def as_utc(dt):
+        """SQLite возвращает наивное время — в БД оно хранится в UTC."""
+        if dt is None:
+            return None
+        return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
+    def parse_sync_dt(value):
+        """ISO-время из выгрузки в UTC; fromisoformat в разы быстрее dateutil для формата to_dict()."""
+        if not value:
+            return None
+        try:
+            dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            dt = parser.isoparse(value)
+        return as_utc(dt)
+
+    def task_row_from_dict(data):
+        """Колонки задачи из элемента синхронизации — для пакетных insert/update."""
+        deadlines = data.get('deadlines') or {}
+        row = {
+            "uuid": data['uuid'],
+            "title": data['title'],
+            "note": data.get('note'),
+            "priority": data.get('priority') or 'routine',
+            "status": data.get('status') or 'planned',
+            "duration_seconds": int(data.get('duration_seconds') or 0),
+            "recurrence_seconds": int(data.get('recurrence_seconds') or 0),
+            "dependencies": data.get('dependencies') or [],
+            "planned_at": parse_sync_dt(deadlines.get('planned_at')),
+            "due_at": parse_sync_dt(deadlines['due_at']),
+            "grace_end": parse_sync_dt(deadlines.get('grace_end')),
+            "completed_at": parse_sync_dt(data.get('completed_at')),
+            "updated_at": parse_sync_dt(data['updated_at']),
+        }
+        if row["due_at"] is None or row["updated_at"] is None:
+            raise ValueError("due_at и updated_at обязательны")
+        # Старые пиры не передают цепочку повторений — не затираем её у себя
+        for key in ('next_uuid', 'origin_uuid'):
+            if key in data:
+                row[key] = data[key]
+        return row
 
     def merge_sync_data(sync_data):
         """
-        Принимает список { "task": ..., "logs": [...] }
-        и сливает с локальной БД.
+        Сливает пачку { "task", "logs" } / { "tombstone" } одной транзакцией:
+        задачи, логи и надгробия загружаются пачками IN, сравниваются в памяти
+        и записываются пакетными insert/update. Возвращает счётчики.
         """
-        for item in sync_data:
-            task_dict = item.get("task")
-            logs_list = item.get("logs", [])
+        counts = {"created": 0, "updated": 0, "skipped": 0, "logs": 0, "tombstones": 0}
+        now = datetime.now(timezone.utc)
 
-            if not task_dict or 'uuid' not in task_dict:
+        # 1. Разбор пачки: последняя версия каждой задачи и самые поздние надгробия
+        incoming, incoming_logs, incoming_tombstones = {}, defaultdict(list), {}
+        for item in sync_data:
+            try:
+                if item.get("tombstone"):
+                    task_uuid = item["tombstone"]["uuid"]
+                    deleted_at = parse_sync_dt(item["tombstone"]["deleted_at"])
+                    if deleted_at and (task_uuid not in incoming_tombstones or deleted_at > incoming_tombstones[task_uuid]):
+                        incoming_tombstones[task_uuid] = deleted_at
+                    continue
+                task_dict = item["task"]
+                row = task_row_from_dict(task_dict)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                counts["skipped"] += 1
                 continue
-
-            existing = Task.query.filter_by(uuid=task_dict['uuid']).first()
-            if task_dict["origin_uuid"]:
-                existing = Task.query.filter_by(origin_uuid=task_dict["origin_uuid"])
-                
-
-            task = None
-
-            if existing:
-                local_updated = existing.updated_at
-                if local_updated.tzinfo is None:
-                    local_updated = local_updated.replace(tzinfo=timezone.utc)
-                remote_updated = parser.isoparse(task_dict['updated_at'])
-                if remote_updated.tzinfo is None:
-                    remote_updated = remote_updated.replace(tzinfo=timezone.utc)
-
-                if remote_updated > local_updated:
-                    update_task_from_dict(existing, task_dict)
-                    task = existing
-                else:
-                    task = existing
+            task_uuid = row["uuid"]
+            incoming_logs[task_uuid].extend(item.get("logs") or [])
+            if task_uuid not in incoming or row["updated_at"] > incoming[task_uuid][0]["updated_at"]:
+                incoming[task_uuid] = (row, task_dict.get("tags") or [])
+
+        # 2. Локальное состояние: задачи, ключи логов и надгробия — пачками IN
+        uuids = list(set(incoming) | set(incoming_tombstones))
+        existing = {}  # uuid -> (id, updated_at)
+        log_keys = set()
+        for start in range(0, len(uuids), TAG_QUERY_CHUNK):
+            chunk = uuids[start:start + TAG_QUERY_CHUNK]
+            for task_id, task_uuid, updated_at in db.session.execute(
+                    db.select(Task.id, Task.uuid, Task.updated_at).where(Task.uuid.in_(chunk))):
+                existing[task_uuid] = (task_id, as_utc(updated_at))
+            for task_uuid, status, changed_at in db.session.execute(
+                    db.select(TaskStatusLog.task_uuid, TaskStatusLog.status, TaskStatusLog.changed_at)
+                    .where(TaskStatusLog.task_uuid.in_(chunk))):
+                if changed_at is not None:
+                    log_keys.add((task_uuid, status, as_utc(changed_at).replace(microsecond=0)))
+        tombstones = load_tombstones(uuids)
+
+        # 3. Сравнение в памяти: побеждает более позднее изменение; задачу,
+        #    удалённую позже её последнего изменения, не воскрешаем
+        inserts, updates, applied = [], [], []
+        for task_uuid, (row, tags) in incoming.items():
+            deleted_at = max(filter(None, [tombstones.get(task_uuid), incoming_tombstones.get(task_uuid)]), default=None)
+            local = existing.get(task_uuid)
+            if (deleted_at and deleted_at >= row["updated_at"]) or (local and row["updated_at"] <= local[1]):
+                counts["skipped"] += 1
+                continue
+            row["modified_at"] = now
+            # Давность провала — по времени изменения на исходном узле, а не приёма
+            row["notify_at"], row["notify_type"] = next_notification(
+                row["status"], row["planned_at"], row["due_at"], row["grace_end"], row["duration_seconds"], row["updated_at"], now
+            )
+            if local:
+                row["id"] = local[0]
+                updates.append(row)
             else:
-                task = create_task_from_dict(task_dict)
-
-            # === Дообучение автоподбора тегов ===
-            if task and task.tags:
-                # Собираем данные ДО коммита (но после применения изменений)
-                text = f"{task.title} {task.note or ''}"
-                tags = [tag.name for tag in task.tags]
-
-                def update_suggester():
-                    global tag_suggester
-                    if tag_suggester is None:
-                        return
-                    with suggester_lock:
-                        tag_suggester.add_task(text, tags)
-
-                threading.Thread(target=update_suggester, daemon=True).start()
-
-            if task:
-                existing_log_keys = set()
-                for log in TaskStatusLog.query.filter_by(task_uuid=task.uuid).all():
-                    key = (log.status, log.changed_at.replace(microsecond=0).replace(tzinfo=timezone.utc))
-                    existing_log_keys.add(key)
-
-                for log_entry in logs_list:
-                    try:
-                        status = log_entry.get("status")
-                        changed_at_str = log_entry.get("changed_at")
-                        if not status or not changed_at_str:
-                            continue
-                        changed_at = parser.isoparse(changed_at_str)
-                        if changed_at.tzinfo is None:
-                            changed_at = changed_at.replace(tzinfo=timezone.utc)
-                        changed_at = changed_at.replace(microsecond=0)
-                        log_key = (status, changed_at)
-                        if log_key not in existing_log_keys:
-                            new_log = TaskStatusLog(
-                                task_uuid=task.uuid,
-                                status=status,
-                                changed_at=changed_at
-                            )
-                            db.session.add(new_log)
-                            existing_log_keys.add(log_key)
-                    except Exception:
-                        continue
+                inserts.append(row)
+            applied.append((row, tags))
+
+        resolved = resolve_tags([name for _, tags in applied for name in tags])
+        db.session.flush()  # новые теги должны попасть в БД до вставки связей
+
+        ids = {task_uuid: local[0] for task_uuid, local in existing.items()}
+        if inserts:
+            ids.update(insert_tasks(inserts))
+        if updates:
+            db.session.execute(db.update(Task), updates)
+            updated_ids = [row["id"] for row in updates]
+            for start in range(0, len(updated_ids), TAG_QUERY_CHUNK):
+                db.session.execute(db.delete(task_tag).where(task_tag.c.task_id.in_(updated_ids[start:start + TAG_QUERY_CHUNK])))
+        tag_rows = [
+            {"task_id": ids[row["uuid"]], "tag_name": name}
+            for row, tags in applied
+            for name in normalize_tag_names(tags) if name in resolved
+        ]
+        if tag_rows:
+            db.session.execute(db.insert(task_tag), tag_rows)
+        counts["created"], counts["updated"] = len(inserts), len(updates)
+
+        # 4. Надгробия пачки: удаляем задачи, не менявшиеся после удаления на пире
+        final_updated = {task_uuid: local[1] for task_uuid, local in existing.items()}
+        final_updated.update({row["uuid"]: row["updated_at"] for row, _ in applied})
+        deleted_ids, tombstone_inserts, tombstone_updates = [], [], []
+        for task_uuid, deleted_at in incoming_tombstones.items():
+            known = tombstones.get(task_uuid)
+            if known and known >= deleted_at:
+                continue
+            local_updated = final_updated.get(task_uuid)
+            if local_updated and local_updated > deleted_at:
+                continue  # задачу изменили после удаления на пире — изменение побеждает
+            if task_uuid in ids:
+                deleted_ids.append(ids.pop(task_uuid))
+            (tombstone_updates if known else tombstone_inserts).append({"uuid": task_uuid, "deleted_at": deleted_at})
+        for start in range(0, len(deleted_ids), TAG_QUERY_CHUNK):
+            chunk = deleted_ids[start:start + TAG_QUERY_CHUNK]
+            db.session.execute(db.delete(task_tag).where(task_tag.c.task_id.in_(chunk)))
+            db.session.execute(db.delete(Task).where(Task.id.in_(chunk)))
+        if tombstone_inserts:
+            db.session.execute(db.insert(TaskTombstone), tombstone_inserts)
+        if tombstone_updates:
+            db.session.execute(db.update(TaskTombstone), tombstone_updates)
+        counts["tombstones"] = len(tombstone_inserts) + len(tombstone_updates)
+
+        # 5. Логи: только отсутствующие (статус, время с точностью до секунды)
+        log_rows = []
+        for task_uuid, logs in incoming_logs.items():
+            if task_uuid not in ids:
+                continue
+            for log_entry in logs:
+                try:
+                    status = log_entry.get("status")
+                    changed_at = parse_sync_dt(log_entry.get("changed_at"))
+                except (AttributeError, ValueError):
+                    continue
+                if not status or changed_at is None:
+                    continue
+                changed_at = changed_at.replace(microsecond=0)
+                key = (task_uuid, status, changed_at)
+                if key not in log_keys:
+                    log_keys.add(key)
+                    log_rows.append({"task_uuid": task_uuid, "status": status, "changed_at": changed_at, "recorded_at": now})
+        if log_rows:
+            db.session.execute(db.insert(TaskStatusLog), log_rows)
+        counts["logs"] = len(log_rows)
 
         db.session.commit()
 
+        # Пакетные insert/update не видны событиям сессии — планировщик сроков обновляем сами
+        # (с немедленной проверкой уведомлений пришедших задач)
+        for row, _ in applied:
+            if row["uuid"] in ids:
+                deadline_scheduler.schedule(row["uuid"], task_triggers(
+                    row["status"], row["due_at"], row["grace_end"], row["notify_at"], now
+                ) + (now,))
+        for task_uuid in incoming_tombstones:
+            if task_uuid not in ids:
+                deadline_scheduler.unschedule(task_uuid)
+        # Головы цепей с пиров: якорь повторений у каждого узла свой
+        new_heads = [row["uuid"] for row, _ in applied
+                     if row["recurrence_seconds"] > 0 and not row.get("origin_uuid") and row["uuid"] in ids]
+        if new_heads and anchor_chains(new_heads, only_unanchored=True):
+            db.session.commit()
 
-    def update_task_from_dict(task, data):
-        task.title = data['title']
-        task.note = data.get('note')
-        task.priority = data.get('priority', task.priority)
-        task.status = data.get('status', task.status)
-        task.duration_seconds = int(data.get('duration_seconds', task.duration_seconds))
-        task.recurrence_seconds = int(data.get('recurrence_seconds', task.recurrence_seconds))
-        task.dependencies = data.get('dependencies', task.dependencies)
-        remote_updated = parser.isoparse(data['updated_at'])
-        if remote_updated.tzinfo is None:
-            remote_updated = remote_updated.replace(tzinfo=timezone.utc)
-        task.updated_at = remote_updated
-        if data.get('completed_at'):
-            task.completed_at = parser.isoparse(data['completed_at'])
-        else:
-            task.completed_at = None
-        deadlines = data.get('deadlines', {})
-        task.due_at = parser.isoparse(deadlines['due_at'])
-        task.planned_at = parser.isoparse(deadlines['planned_at']) if deadlines.get('planned_at') else None
-        task.grace_end = parser.isoparse(deadlines['grace_end']) if deadlines.get('grace_end') else None
-        tag_names = data.get('tags', [])
-        tags = []
-        for name in tag_names:
-            name = name.strip().lower()
-            if not name: continue
-            tag = Tag.query.filter_by(name=name).first()
-            if not tag:
-                tag = Tag(name=name)
-                db.session.add(tag)
-            tags.append(tag)
-        task.tags = tags
-
-    def update_task_logs(task_uuid, logs_list):
-        existing_log_keys = set()
-        for log in TaskStatusLog.query.filter_by(task_uuid=task_uuid).all():
-            key = (log.status, log.changed_at.replace(microsecond=0).replace(tzinfo=timezone.utc))
-            existing_log_keys.add(key)
-        for log_entry in logs_list:
-            try:
-                status = log_entry.get("status")
-                changed_at_str = log_entry.get("changed_at")
-                if not status or not changed_at_str:
-                    continue
-                changed_at = parser.isoparse(changed_at_str)
-                if changed_at.tzinfo is None:
-                    changed_at = changed_at.replace(tzinfo=timezone.utc)
-                changed_at = changed_at.replace(microsecond=0)
-                log_key = (status, changed_at)
-                if log_key not in existing_log_keys:
-                    new_log = TaskStatusLog(task_uuid=task_uuid, status=status, changed_at=changed_at)
-                    db.session.add(new_log)
-                    existing_log_keys.add(log_key)
-            except:
-                continue
+        # === Дообучение автоподбора тегов (пачкой в фоновом потоке) ===
+        for row, tags in applied:
+            names = [name for name in normalize_tag_names(tags) if name in resolved]
+            if names and row["uuid"] in ids:
+                suggester_updates.submit(f"{row['title']} {row['note'] or ''}", names)
+        return counts
+
+    def load_tombstones(uuids):
+        """{uuid: deleted_at} для надгробий среди указанных задач (пачками IN)."""
+        uuids = [u for u in set(uuids) if u]
+        result = {}
+        for start in range(0, len(uuids), TAG_QUERY_CHUNK):
+            chunk = uuids[start:start + TAG_QUERY_CHUNK]
+            for task_uuid, deleted_at in db.session.execute(
+                    db.select(TaskTombstone.uuid, TaskTombstone.deleted_at).where(TaskTombstone.uuid.in_(chunk))):
+                result[task_uuid] = as_utc(deleted_at)
+        return result
 
     @app.route('/notify/config', methods=['GET'])
     def get_telegram_config():
@@ -706,159 +1452,661 @@ def setup_routes(app, env_path: Path):
             themes.append({"name": name, "label": label})
         return jsonify(themes)
 
-    @app.route('/logic/process-tick', methods=['POST'])
-    def process_time_based_transitions():
+    # === Планировщик сроков: planned → overdue → failed и уведомления ровно в свой момент ===
+    def task_deadlines(status, due_at, grace_end):
+        """
+        Моменты, в которые у задачи сменится статус. До просрочки это только due_at:
+        grace_end планируется после перехода в overdue (уже прошедший grace_end без
+        смены статуса срабатывал бы снова и снова).
+        """
+        if status in EXPIRING_STATUSES:
+            return (as_utc(due_at),)
+        if status == "overdue":
+            return (as_utc(grace_end),)
+        return ()
+
+    def task_triggers(status, due_at, grace_end, notify_at, now):
+        """
+        Расписание задачи: смены статуса и следующее уведомление (notify_at). Наступивший
+        notify_at не планируется — его забирает сбор уведомлений, иначе перепланирование
+        после срабатывания зациклилось бы.
+        """
+        upcoming = (as_utc(notify_at),) if notify_at and as_utc(notify_at) > now else ()
+        return task_deadlines(status, due_at, grace_end) + upcoming
+
+    def apply_time_transitions(uuids=None):
+        """
+        Переходы planned/inProgress → overdue → failed множественными UPDATE (transition_tasks)
+        по индексам (status, due_at) и (status, grace_end); логи вставляются одной пачкой.
+        Уже просроченные задачи в первый UPDATE не попадают, поэтому стоимость пропорциональна
+        числу задач, реально меняющих статус. uuids ограничивает переходы указанными задачами.
+        Повторный вызов (другой процесс, устаревший момент) ничего не меняет.
+        """
         now = datetime.now(timezone.utc)
-        updated_tasks = []
-        overdue_candidates = Task.query.filter(Task.status.notin_(["done", "failed"]), Task.due_at <= now).all()
-        for task in overdue_candidates:
-            if task.status != "overdue":
-                task.status = "overdue"
-                log_entry = TaskStatusLog(task_uuid=task.uuid, status="overdue")
-                db.session.add(log_entry)
-                updated_tasks.append({"uuid": task.uuid, "status": "overdue", "id": task.id})
-        failed_candidates = Task.query.filter(Task.status == "overdue", Task.grace_end.isnot(None), Task.grace_end <= now).all()
-        for task in failed_candidates:
-            task.status = "failed"
-            log_entry = TaskStatusLog(task_uuid=task.uuid, status="failed")
-            db.session.add(log_entry)
-            updated_tasks.append({"uuid": task.uuid, "status": "failed", "id": task.id})
+        chunks = [None] if uuids is None else [uuids[i:i + TAG_QUERY_CHUNK] for i in range(0, len(uuids), TAG_QUERY_CHUNK)]
+        changed = []
+        for chunk in chunks:
+            in_chunk = db.true() if chunk is None else Task.uuid.in_(chunk)
+            # Смена статуса сама и есть повод уведомить: notify_at выставляется тем же UPDATE
+            overdue = transition_tasks(in_chunk, db.and_(Task.status.in_(EXPIRING_STATUSES), Task.due_at <= now),
+                                       "overdue", now)
+            failed = transition_tasks(in_chunk, db.and_(Task.status == "overdue", Task.grace_end <= now), "failed", now)
+            changed += [{"uuid": u, "status": "overdue", "id": i} for u, i in overdue]
+            changed += [{"uuid": u, "status": "failed", "id": i} for u, i in failed]
+        if changed:
+            db.session.execute(db.insert(TaskStatusLog), [
+                {"task_uuid": c["uuid"], "status": c["status"], "changed_at": now, "recorded_at": now} for c in changed
+            ])
         db.session.commit()
+        return now, changed
+
+    def reschedule_from_db(uuids):
+        """Расписание по фактическому состоянию задач (UPDATE мимо ORM не видны событиям сессии)."""
+        states = {}
+        now = datetime.now(timezone.utc)
+        for start in range(0, len(uuids), TAG_QUERY_CHUNK):
+            for row in db.session.execute(
+                    db.select(Task.uuid, Task.status, Task.due_at, Task.grace_end, Task.notify_at)
+                    .where(Task.uuid.in_(uuids[start:start + TAG_QUERY_CHUNK]))):
+                states[row.uuid] = task_triggers(row.status, row.due_at, row.grace_end, row.notify_at, now)
+        for task_uuid in uuids:
+            deadline_scheduler.schedule(task_uuid, states.get(task_uuid, ()))
+
+    def on_deadlines_expired(uuids):
+        with app.app_context():
+            _, changed = apply_time_transitions(uuids)
+            fired = collect_notifications(uuids)
+            # Задача могла измениться между моментом и запуском — расписание по БД
+            reschedule_from_db(uuids)
+        if changed:
+            logging.info(f"⏰ Истекли сроки: {len(changed)} задач сменили статус")
+        if fired:
+            logging.info(f"🔔 Наступило уведомлений: {len(fired)}")
+
+    deadline_scheduler = DeadlineScheduler(on_deadlines_expired)
+
+    @event.listens_for(db.session, "before_flush")
+    def refresh_notify_schedule(session, flush_context, instances):
+        # Следующее уведомление пересчитывается, только когда меняются сроки, длительность или статус
+        now = datetime.now(timezone.utc)
+        for obj in list(session.new) + list(session.dirty):
+            if not isinstance(obj, Task):
+                continue
+            if obj not in session.new:
+                attrs = db.inspect(obj).attrs
+                if not any(attrs[field].history.has_changes() for field in NOTIFY_SCHEDULE_FIELDS):
+                    continue
+            obj.notify_at, obj.notify_type = next_notification(
+                obj.status, obj.planned_at, obj.due_at, obj.grace_end, obj.duration_seconds or 0, now, now
+            )
+
+    @event.listens_for(db.session, "after_flush")
+    def collect_deadline_changes(session, flush_context):
+        # Изменения ORM-задач копятся до коммита: откатившиеся не должны попасть в расписание.
+        # Момент now — немедленная проверка уведомлений (ручной перевод в overdue/failed и т. п.)
+        changes = session.info.setdefault("deadline_changes", {})
+        now = datetime.now(timezone.utc)
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, Task):
+                changes[obj.uuid] = task_triggers(obj.status, obj.due_at, obj.grace_end, obj.notify_at, now) + (now,)
+        for obj in session.deleted:
+            if isinstance(obj, Task):
+                changes[obj.uuid] = ()
+
+    @event.listens_for(db.session, "after_commit")
+    def apply_deadline_changes(session):
+        for task_uuid, instants in session.info.pop("deadline_changes", {}).items():
+            deadline_scheduler.schedule(task_uuid, instants)
+
+    @event.listens_for(db.session, "after_rollback")
+    def drop_deadline_changes(session):
+        session.info.pop("deadline_changes", None)
+
+    with app.app_context():
+        now = datetime.now(timezone.utc)
+        active = db.session.execute(
+            db.select(Task.uuid, Task.status, Task.due_at, Task.grace_end, Task.notify_at)
+            .where(db.or_(Task.status.in_(EXPIRING_STATUSES + ("overdue",)), Task.notify_at.isnot(None)))
+        ).all()
+        for row in active:
+            deadline_scheduler.schedule(row.uuid, task_triggers(row.status, row.due_at, row.grace_end, row.notify_at, now))
+
+    @app.route('/logic/scheduler', methods=['GET'])
+    def scheduler_stats():
+        return jsonify(deadline_scheduler.stats()), 200
+
+    @app.route('/logic/process-tick', methods=['POST'])
+    def process_time_based_transitions():
+        now, updated_tasks = apply_time_transitions()
+        reschedule_from_db(list(dict.fromkeys(c["uuid"] for c in updated_tasks)))
         return jsonify({"processed_at": now.isoformat() + "Z", "updated_tasks": updated_tasks}), 200
 
+    # === Уведомления: журнал отправленных — он же лента событий для /notify/stream ===
+    # Позиция в ленте — (notified_at, task_uuid, type); notified_at выдаётся под notify_lock
+    # строго возрастающим, поэтому читатель с курсором не пропускает позже закоммиченных записей
+    notify_lock = threading.Lock()
+    notify_changed = threading.Condition()
+    ledger_state = {"pruned_at": None, "last_at": None, "version": 0}
+
+    def prune_notification_ledger(now):
+        """
+        Удаляет записи журнала уведомлений удалённых задач и задач, завершённых (done/failed)
+        и не менявшихся дольше NOTIFY_LEDGER_TTL: повторно они уже не сработают.
+        """
+        stale = now - NOTIFY_LEDGER_TTL
+        finished = db.select(Task.uuid).where(
+            Task.uuid == NotificationLedger.task_uuid,
+            db.or_(Task.status.notin_(("done", "failed")), Task.modified_at >= stale)
+        )
+        result = db.session.execute(db.delete(NotificationLedger).where(
+            NotificationLedger.notified_at < stale, ~finished.exists()
+        ))
+        db.session.commit()
+        ledger_state["pruned_at"] = now
+        if result.rowcount:
+            logging.info(f"🧹 Журнал уведомлений: удалено устаревших записей — {result.rowcount}")
+
+    def notification_schedule(status, planned_at, due_at, grace_end, duration, changed_at, now):
+        """
+        Все уведомления, положенные задаче в её текущем состоянии: [(момент, тип)].
+        overdue и failed наступают вместе со сменой статуса; о провале, случившемся
+        (changed_at) раньше NOTIFY_LEDGER_TTL, уже не уведомляем.
+        """
+        schedule = []
+        if status == "planned" and planned_at:
+            schedule.append((as_utc(planned_at), "start"))
+        if duration > 0 and status in EXPIRING_STATUSES and due_at:
+            schedule.append((as_utc(due_at) - timedelta(seconds=duration), "due_warn"))
+        if status == "overdue":
+            schedule.append((min(as_utc(due_at), now) if due_at else now, "overdue"))
+        if duration > 0 and status not in ("done", "failed") and grace_end:
+            schedule.append((as_utc(grace_end) - timedelta(seconds=duration), "grace_warn"))
+        if status == "failed" and (changed_at is None or as_utc(changed_at) >= now - NOTIFY_LEDGER_TTL):
+            schedule.append((now, "failed"))
+        return schedule
+
+    def next_notification(status, planned_at, due_at, grace_end, duration, changed_at, now, sent=()):
+        """(notify_at, notify_type) — ближайшее ещё не отправленное уведомление или (None, None)."""
+        pending = [entry for entry in notification_schedule(status, planned_at, due_at, grace_end, duration, changed_at, now)
+                   if entry[1] not in sent]
+        return min(pending) if pending else (None, None)
+
+    def collect_notifications(uuids=None):
+        """
+        Записывает в журнал наступившие и ещё не отправленные уведомления (всех задач
+        или только uuids) и будит читателей ленты. Отбор — диапазон индекса notify_at <= now;
+        у отобранных задач notify_at переводится на следующее уведомление.
+        Возвращает [(строка задачи, тип)].
+        """
+        with notify_lock:
+            now = datetime.now(timezone.utc)
+            if ledger_state["last_at"] is not None and now <= ledger_state["last_at"]:
+                now = ledger_state["last_at"] + timedelta(microseconds=1)
+            chunks = [None] if uuids is None else [uuids[i:i + TAG_QUERY_CHUNK] for i in range(0, len(uuids), TAG_QUERY_CHUNK)]
+            candidates = []
+            for chunk in chunks:
+                candidates += db.session.execute(
+                    db.select(Task.id, Task.uuid, Task.status, Task.planned_at, Task.due_at, Task.grace_end,
+                              Task.duration_seconds, Task.updated_at, Task.modified_at)
+                    .where(Task.notify_at <= now, db.true() if chunk is None else Task.uuid.in_(chunk))
+                ).all()
+            candidates.sort(key=lambda row: row.id)
+
+            # Уже отправленные — по первичному ключу журнала (task_uuid, type)
+            candidate_uuids = [row.uuid for row in candidates]
+            sent = defaultdict(set)
+            for start in range(0, len(candidate_uuids), TAG_QUERY_CHUNK):
+                for task_uuid, notification_type in db.session.execute(
+                        db.select(NotificationLedger.task_uuid, NotificationLedger.type)
+                        .where(NotificationLedger.task_uuid.in_(candidate_uuids[start:start + TAG_QUERY_CHUNK]))):
+                    sent[task_uuid].add(notification_type)
+
+            fired, schedule_updates = [], []
+            for row in candidates:
+                schedule = notification_schedule(row.status, row.planned_at, row.due_at, row.grace_end,
+                                                 row.duration_seconds, row.updated_at, now)
+                for at, notification_type in schedule:
+                    if at <= now and notification_type not in sent[row.uuid]:
+                        fired.append((row, notification_type))
+                        sent[row.uuid].add(notification_type)
+                notify_at, notify_type = next_notification(row.status, row.planned_at, row.due_at, row.grace_end,
+                                                           row.duration_seconds, row.updated_at, now, sent[row.uuid])
+                # Служебные поля: updated_at/modified_at сохраняем как есть (onupdate их не сдвинет),
+                # иначе сбор уведомлений порождал бы изменения для синхронизации
+                schedule_updates.append({"id": row.id, "notify_at": notify_at, "notify_type": notify_type,
+                                         "updated_at": row.updated_at, "modified_at": row.modified_at})
+                # Следующее уведомление — в расписание (сроки статуса не поменялись)
+                deadline_scheduler.schedule(row.uuid, task_triggers(row.status, row.due_at, row.grace_end, notify_at, now))
+            if schedule_updates:
+                db.session.execute(db.update(Task), schedule_updates)
+            try:
+                if fired:
+                    db.session.execute(db.insert(NotificationLedger), [
+                        {"task_uuid": row.uuid, "type": notification_type, "notified_at": now} for row, notification_type in fired
+                    ])
+                db.session.commit()
+            except IntegrityError:
+                # Уведомление уже записал другой процесс — следующий сбор пересчитает эти задачи
+                db.session.rollback()
+                logging.warning("⚠️ Сбор уведомлений пересёкся с другим процессом — пропущен")
+                return []
+            if fired:
+                ledger_state["last_at"] = now
+            if ledger_state["pruned_at"] is None or now - ledger_state["pruned_at"] >= NOTIFY_LEDGER_PRUNE_INTERVAL:
+                prune_notification_ledger(now)
+        if fired:
+            with notify_changed:
+                ledger_state["version"] += 1
+                notify_changed.notify_all()
+        return fired
+
+    def format_notify_cursor(notified_at, task_uuid, notification_type):
+        return f"{as_utc(notified_at).isoformat().replace('+00:00', 'Z')}|{task_uuid}|{notification_type}"
+
+    def parse_notify_cursor(cursor):
+        """(notified_at, task_uuid, type) из курсора; ValueError — если он испорчен."""
+        notified_at, task_uuid, notification_type = cursor.split("|")
+        return parse_sync_dt(notified_at), task_uuid, notification_type
+
+    def notify_tail():
+        """Позиция конца ленты: читатель без курсора получает только новые события."""
+        last = db.session.execute(
+            db.select(NotificationLedger.notified_at, NotificationLedger.task_uuid, NotificationLedger.type)
+            .order_by(NotificationLedger.notified_at.desc(), NotificationLedger.task_uuid.desc(), NotificationLedger.type.desc())
+            .limit(1)
+        ).first()
+        return (as_utc(last.notified_at), last.task_uuid, last.type) if last else (datetime.min.replace(tzinfo=timezone.utc), "", "")
+
+    def read_notification_events(position, limit=NOTIFY_STREAM_BATCH):
+        """
+        События журнала после позиции: [(курсор, уведомление или None)]. None — задача
+        уже удалена; курсор всё равно продвигается.
+        """
+        notified_at, task_uuid, notification_type = position
+        rows = db.session.execute(
+            db.select(NotificationLedger.notified_at, NotificationLedger.task_uuid, NotificationLedger.type)
+            .where(db.or_(
+                NotificationLedger.notified_at > notified_at,
+                db.and_(NotificationLedger.notified_at == notified_at, db.or_(
+                    NotificationLedger.task_uuid > task_uuid,
+                    db.and_(NotificationLedger.task_uuid == task_uuid, NotificationLedger.type > notification_type)
+                ))
+            ))
+            .order_by(NotificationLedger.notified_at, NotificationLedger.task_uuid, NotificationLedger.type)
+            .limit(limit)
+        ).all()
+        if not rows:
+            return []
+        uuids = list({row.task_uuid for row in rows})
+        tasks = {task.uuid: task for task in Task.query.options(noload(Task.tags)).filter(Task.uuid.in_(uuids))}
+        tags_by_task = defaultdict(list)
+        for task_id, tag_name in db.session.execute(
+                db.select(task_tag.c.task_id, task_tag.c.tag_name)
+                .where(task_tag.c.task_id.in_([task.id for task in tasks.values()]))):
+            tags_by_task[task_id].append(tag_name)
+        events = []
+        for row in rows:
+            task = tasks.get(row.task_uuid)
+            cursor = format_notify_cursor(row.notified_at, row.task_uuid, row.type)
+            payload = {**task.to_dict(tag_names=tags_by_task.get(task.id, [])), "notification_type": row.type, "cursor": cursor} if task else None
+            events.append(((as_utc(row.notified_at), row.task_uuid, row.type), payload))
+        db.session.rollback()  # не держим читающую транзакцию между пачками
+        return events
+
+    with app.app_context():
+        # Позиция последней выдачи уведомлений (опросу или ленте): после перезапуска
+        # получателя /notify/pending отдаёт ровно то, что он ещё не получил
+        poll_state = {"position": notify_tail()}
+        # Всё, что наступило, пока сервер был выключен, — одной пачкой при старте
+        missed = collect_notifications() if background else []
+        if missed:
+            print(f"🔔 Уведомлений, наступивших во время простоя: {len(missed)}")
+    # Запуск — после объявления всего, что вызывает обработчик сработавших моментов
+    if background:
+        deadline_scheduler.start()
+        print(f"⏰ Планировщик сроков запущен: {deadline_scheduler.stats()}")
+
     @app.route('/notify/pending', methods=['GET'])
     def get_pending_notifications():
-        now = datetime.now(timezone.utc)
+        """
+        Уведомления ленты, ещё не выданные опросу (или после ?cursor=). Наступившие записываются
+        в журнал планировщиком в свой момент; здесь — страховочный сбор на случай его отставания.
+        Заголовок X-Notify-Cursor — позиция, с которой продолжать чтение /notify/stream.
+        """
+        collect_notifications()
+        explicit = request.args.get('cursor')
         try:
-            tasks_resp = requests.get(
-                f"http://localhost:{PORT}/tasks?due_from=1970-01-01T00:00:00Z&due_to=2038-01-19T03:14:07Z",
-                timeout=10
-            )
-            tasks_resp.raise_for_status()
-            tasks = tasks_resp.json()
-        except Exception as e:
-            return jsonify({"error": f"Не удалось получить задачи: {e}"}), 500
+            position = parse_notify_cursor(explicit) if explicit else poll_state["position"]
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
         pending = []
-        for task in tasks:
-            uuid = task.get("uuid")
-            if not uuid:
-                continue
-            status = task.get("status")
-            deadlines = task.get("deadlines", {})
-            duration = task.get("duration_seconds", 0)
-            if status == "planned" and deadlines.get("planned_at"):
-                planned_at = parser.isoparse(deadlines["planned_at"])
-                if planned_at.tzinfo is None:
-                    planned_at = planned_at.replace(tzinfo=timezone.utc)
-                if now >= planned_at and f"{uuid}_planned" not in NOTIFIED_CACHE:
-                    pending.append({**task, "notification_type": "start"})
-                    NOTIFIED_CACHE.add(f"{uuid}_planned")
-            if duration > 0 and status in ("planned", "inProgress") and deadlines.get("due_at"):
-                due_at = parser.isoparse(deadlines["due_at"])
-                if due_at.tzinfo is None:
-                    due_at = due_at.replace(tzinfo=timezone.utc)
-                warn_time = due_at - timedelta(seconds=duration)
-                if now >= warn_time and f"{uuid}_due_warn" not in NOTIFIED_CACHE:
-                    pending.append({**task, "notification_type": "due_warn"})
-                    NOTIFIED_CACHE.add(f"{uuid}_due_warn")
-            if status == "overdue" and f"{uuid}_overdue" not in NOTIFIED_CACHE:
-                pending.append({**task, "notification_type": "overdue"})
-                NOTIFIED_CACHE.add(f"{uuid}_overdue")
-            if duration > 0 and deadlines.get("grace_end") and status not in ("done", "failed"):
-                grace_end = parser.isoparse(deadlines["grace_end"])
-                if grace_end.tzinfo is None:
-                    grace_end = grace_end.replace(tzinfo=timezone.utc)
-                warn_time = grace_end - timedelta(seconds=duration)
-                if now >= warn_time and f"{uuid}_grace_warn" not in NOTIFIED_CACHE:
-                    pending.append({**task, "notification_type": "grace_warn"})
-                    NOTIFIED_CACHE.add(f"{uuid}_grace_warn")
-            if status == "failed" and f"{uuid}_failed" not in NOTIFIED_CACHE:
-                pending.append({**task, "notification_type": "failed"})
-                NOTIFIED_CACHE.add(f"{uuid}_failed")
-        return jsonify(pending), 200
-
-    def spawn_recurring_tasks():
-        now = datetime.now(timezone.utc)
-        recurring_tasks = Task.query.filter(Task.recurrence_seconds > 0).all()
-        for task in recurring_tasks:
-            # Находим первую запись о статусе "planned" — момент создания оригинала
-            first_planned_log = TaskStatusLog.query.filter_by(
-                task_uuid=task.uuid,
-                status="planned"
-            ).order_by(TaskStatusLog.changed_at.asc()).first()
-
-            if not first_planned_log:
-                continue
+        while True:
+            events = read_notification_events(position)
+            for position, payload in events:
+                if payload:
+                    pending.append(payload)
+            if len(events) < NOTIFY_STREAM_BATCH:
+                break
+        if not explicit:
+            poll_state["position"] = max(poll_state["position"], position)
+        return jsonify(pending), 200, {"X-Notify-Cursor": format_notify_cursor(*position)}
+
+    @app.route('/notify/stream', methods=['GET'])
+    def notification_stream():
+        """
+        Server-Sent Events: каждое уведомление — событие "notification" с id-курсором.
+        После переподключения клиент передаёт Last-Event-ID (или ?cursor=) и получает
+        пропущенное; без курсора — только новые события. В простое — лишь keep-alive.
+        """
+        cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+        try:
+            position = parse_notify_cursor(cursor) if cursor else notify_tail()
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        db.session.remove()
+
+        def events():
+            nonlocal position
+            yield f"retry: {NOTIFY_STREAM_RETRY_MS}\n\n"
+            while True:
+                with notify_changed:
+                    version = ledger_state["version"]
+                with app.app_context():
+                    batch = read_notification_events(position)
+                for position, payload in batch:
+                    if payload:
+                        yield (f"id: {payload['cursor']}\nevent: notification\n"
+                               f"data: {json.dumps(payload, ensure_ascii=False)}\n\n")
+                    poll_state["position"] = max(poll_state["position"], position)
+                if len(batch) == NOTIFY_STREAM_BATCH:
+                    continue
+                with notify_changed:
+                    if ledger_state["version"] == version:
+                        notify_changed.wait(NOTIFY_STREAM_KEEPALIVE)
+                    woken = ledger_state["version"] != version
+                if not woken:
+                    yield ": keep-alive\n\n"
+
+        return Response(events(), mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    # === Повторяющиеся задачи: состояние цепи хранится на её голове ===
+    def occurrence_uuid(head_uuid, at):
+        """
+        uuid вхождения детерминирован: узлы, породившие одно вхождение, получают одну задачу.
+        Ключ — момент вхождения, а не номер периода: после смены периода номера начинаются
+        заново и совпали бы с уже порождёнными вхождениями.
+        """
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"thisisfine:{head_uuid}:{as_utc(at).isoformat()}"))
 
-            original_creation = first_planned_log.changed_at
-            if original_creation.tzinfo is None:
-                original_creation = original_creation.replace(tzinfo=timezone.utc)
+    def anchor_chains(head_uuids, only_unanchored=False):
+        """
+        Записывает на головы цепей якорь (создание оригинала), последнее вхождение и момент
+        следующего порождения — для старых БД, голов, пришедших с пиров, и смены периода.
+        Это локальное состояние узла: updated_at/modified_at не сдвигаются, иначе голова
+        выгружалась бы пирам и могла перезаписать их более новую правку. Коммит — за вызывающим.
+        """
+        head_uuids = list(dict.fromkeys(head_uuids))
+        updates = []
+        for start in range(0, len(head_uuids), TAG_QUERY_CHUNK):
+            chunk = head_uuids[start:start + TAG_QUERY_CHUNK]
+            head_filter = [Task.uuid.in_(chunk), Task.origin_uuid.is_(None)]
+            if only_unanchored:
+                head_filter.append(Task.recurrence_anchor_at.is_(None))
+            heads = db.session.execute(
+                db.select(Task.id, Task.uuid, Task.recurrence_seconds, Task.next_uuid, Task.updated_at, Task.modified_at)
+                .where(*head_filter)
+            ).all()
+            if not heads:
+                continue
+            members = dict(db.session.execute(
+                db.select(Task.uuid, Task.next_uuid).where(Task.origin_uuid.in_([h.uuid for h in heads]))
+            ).all())
+            tails = {}
+            for head in heads:
+                tail, next_uuid, seen = head.uuid, head.next_uuid, {head.uuid}
+                while next_uuid in members and next_uuid not in seen:
+                    seen.add(next_uuid)
+                    tail, next_uuid = next_uuid, members[next_uuid]
+                tails[head.uuid] = tail
+            # Момент создания задачи — её первая запись "planned", как и раньше
+            created = dict(db.session.execute(
+                db.select(TaskStatusLog.task_uuid, db.func.min(TaskStatusLog.changed_at))
+                .where(TaskStatusLog.status == "planned",
+                       TaskStatusLog.task_uuid.in_(set(tails) | set(tails.values())))
+                .group_by(TaskStatusLog.task_uuid)
+            ).all())
+            for head in heads:
+                anchor = as_utc(created.get(head.uuid) or head.updated_at)
+                tail_created = as_utc(created.get(tails[head.uuid])) or anchor
+                updates.append({
+                    "id": head.id,
+                    "recurrence_anchor_at": anchor,
+                    "recurrence_tail_uuid": tails[head.uuid],
+                    "recurrence_next_at": tail_created + timedelta(seconds=head.recurrence_seconds)
+                    if head.recurrence_seconds > 0 else None,
+                    "updated_at": head.updated_at,
+                    "modified_at": head.modified_at
+                })
+        if updates:
+            db.session.execute(db.update(Task), updates)
+        return len(updates)
 
-            elapsed = (now - original_creation).total_seconds()
-            periods_passed = int(elapsed // task.recurrence_seconds)
+    def plan_recurrence_spawns(now, limit=RECURRENCE_CATCHUP_LIMIT):
+        """
+        Вхождения, которые пора породить. Выбираются только головы с истёкшим
+        recurrence_next_at (по индексу) — стоимость зависит от числа порождений,
+        а не от числа когда-либо созданных повторяющихся задач.
+        Пропущенные периоды (сервер был выключен) догоняются все, но не более limit
+        последних на цепь; более старые пропускаются.
+        """
+        heads = Task.query.options(noload(Task.tags)).filter(Task.recurrence_next_at <= now).all()
+        tail_uuids = [h.recurrence_tail_uuid for h in heads if h.recurrence_tail_uuid and h.recurrence_tail_uuid != h.uuid]
+        templates = {h.uuid: h for h in heads}
+        for start in range(0, len(tail_uuids), TAG_QUERY_CHUNK):
+            for tail in Task.query.options(noload(Task.tags)).filter(Task.uuid.in_(tail_uuids[start:start + TAG_QUERY_CHUNK])):
+                templates[tail.uuid] = tail
+
+        def shifted(dt, seconds):
+            return as_utc(dt) + timedelta(seconds=seconds) if dt else None
+
+        plans = []
+        for head in heads:
+            # Шаблон — последнее вхождение (правки названия и тегов переходят дальше); удалено — голова
+            template = templates.get(head.recurrence_tail_uuid, head)
+            period = head.recurrence_seconds
+            plan = {"head": head, "template": template, "occurrences": [], "skipped": 0, "next_at": None}
+            plans.append(plan)
+            if period <= 0 or template.recurrence_seconds <= 0:
+                continue  # цепь остановлена
+            anchor = as_utc(head.recurrence_anchor_at)
+            first = max(1, int((as_utc(head.recurrence_next_at) - anchor).total_seconds() // period))
+            latest = int((now - anchor).total_seconds() // period)
+            caught_up = max(first, latest - limit + 1)
+            plan["skipped"] = max(0, caught_up - first)
+            plan["next_at"] = anchor + timedelta(seconds=period * (latest + 1))
+            for k in range(caught_up, latest + 1):
+                delta = period * k
+                plan["occurrences"].append({
+                    "period": k,
+                    "uuid": occurrence_uuid(head.uuid, anchor + timedelta(seconds=delta)),
+                    "created_at": anchor + timedelta(seconds=delta),
+                    # Дедлайны сдвигаются от головы: ошибка не накапливается вдоль цепи
+                    "planned_at": shifted(head.planned_at, delta),
+                    "due_at": shifted(head.due_at, delta),
+                    "grace_end": shifted(head.grace_end, delta)
+                })
 
-            if periods_passed <= 0:
-                continue
+        # Вхождение, уже порождённое пиром, не дублируем; удалённое пользователем — не воскрешаем
+        candidates = [o["uuid"] for plan in plans for o in plan["occurrences"]]
+        existing = set()
+        for start in range(0, len(candidates), TAG_QUERY_CHUNK):
+            existing.update(db.session.scalars(
+                db.select(Task.uuid).where(Task.uuid.in_(candidates[start:start + TAG_QUERY_CHUNK]))
+            ))
+        deleted = load_tombstones(candidates)
+        for plan in plans:
+            for occurrence in plan["occurrences"]:
+                occurrence["exists"] = occurrence["uuid"] in existing
+                occurrence["deleted"] = occurrence["uuid"] in deleted
+        return plans
+
+    def spawn_recurring_tasks(now=None, limit=RECURRENCE_CATCHUP_LIMIT):
+        """
+        Порождает все назревшие вхождения одной транзакцией: после простоя цепь
+        догоняется за один проход. Возвращает строки созданных задач.
+        """
+        now = now or datetime.now(timezone.utc)
+        plans = plan_recurrence_spawns(now, limit)
+        if not plans:
+            return []
+
+        template_ids = list({p["template"].id for p in plans})
+        template_tags = defaultdict(list)
+        for start in range(0, len(template_ids), TAG_QUERY_CHUNK):
+            for task_id, tag_name in db.session.execute(
+                    db.select(task_tag.c.task_id, task_tag.c.tag_name)
+                    .where(task_tag.c.task_id.in_(template_ids[start:start + TAG_QUERY_CHUNK]))):
+                template_tags[task_id].append(tag_name)
+
+        # Вхождения, уже пришедшие с пира, остаются звеньями цепи
+        present = [o["uuid"] for p in plans for o in p["occurrences"] if o["exists"]]
+        present_tasks = {}
+        for start in range(0, len(present), TAG_QUERY_CHUNK):
+            for task in Task.query.options(noload(Task.tags)).filter(Task.uuid.in_(present[start:start + TAG_QUERY_CHUNK])):
+                present_tasks[task.uuid] = task
+
+        # Состояние цепи и связи next_uuid у существующих задач — локальные и детерминированные:
+        # пишутся мимо ORM с прежними updated_at/modified_at (onupdate их не сдвинет),
+        # как notify_at в сборе уведомлений
+        chain_updates = {}
+
+        def chain_update(task):
+            return chain_updates.setdefault(task.id, {
+                "id": task.id, "updated_at": task.updated_at, "modified_at": task.modified_at
+            })
 
-            # Проверяем, не создана ли уже следующая задача
-            if task.next_uuid and Task.query.filter_by(uuid=task.next_uuid).first():
+        rows, log_rows, tag_names = [], [], {}
+        for plan in plans:
+            head, template = plan["head"], plan["template"]
+            chain_update(head)["recurrence_next_at"] = plan["next_at"]
+            if not plan["occurrences"]:
                 continue
+            # Цепь: шаблон -> вхождение -> ... -> последнее, у каждого origin_uuid = голова
+            previous = template
+            for occurrence in plan["occurrences"]:
+                if occurrence["deleted"]:
+                    continue  # удалённое пропускаем: цепь идёт в обход него
+                if isinstance(previous, dict):
+                    previous["next_uuid"] = occurrence["uuid"]
+                else:
+                    chain_update(previous)["next_uuid"] = occurrence["uuid"]
+                if occurrence["exists"]:
+                    previous = present_tasks.get(occurrence["uuid"], previous)
+                    continue
+                previous = {
+                    "uuid": occurrence["uuid"],
+                    "title": template.title,
+                    "note": template.note,
+                    "planned_at": occurrence["planned_at"],
+                    "due_at": occurrence["due_at"],
+                    "grace_end": occurrence["grace_end"],
+                    "duration_seconds": template.duration_seconds,
+                    "priority": template.priority,
+                    "recurrence_seconds": template.recurrence_seconds,
+                    "dependencies": [],
+                    "status": "planned",
+                    "origin_uuid": head.uuid,
+                    "next_uuid": None,
+                    "updated_at": now,
+                    "modified_at": now
+                }
+                previous["notify_at"], previous["notify_type"] = next_notification(
+                    "planned", previous["planned_at"], previous["due_at"], previous["grace_end"],
+                    previous["duration_seconds"], now, now
+                )
+                rows.append(previous)
+                log_rows.append({"task_uuid": occurrence["uuid"], "status": "planned",
+                                 "changed_at": occurrence["created_at"], "recorded_at": now})
+                tag_names[occurrence["uuid"]] = template_tags.get(template.id, [])
+            chain_update(head)["recurrence_tail_uuid"] = plan["occurrences"][-1]["uuid"]
+            if plan["skipped"]:
+                logging.warning(f"⏭️ Цепь {head.uuid}: пропущено периодов сверх лимита догона — {plan['skipped']}")
+
+        if rows:
+            ids = insert_tasks(rows)
+            tag_rows = [{"task_id": ids[u], "tag_name": name} for u, names in tag_names.items() for name in names]
+            if tag_rows:
+                db.session.execute(db.insert(task_tag), tag_rows)
+            db.session.execute(db.insert(TaskStatusLog), log_rows)
+        db.session.execute(db.update(Task), list(chain_updates.values()))
+        db.session.commit()
 
-            # Смещаем ВСЕ дедлайны на N периодов от оригинала (не от now!)
-            delta = timedelta(seconds=task.recurrence_seconds * periods_passed)
-
-            new_planned = None
-            if task.planned_at:
-                base_planned = task.planned_at
-                if base_planned.tzinfo is None:
-                    base_planned = base_planned.replace(tzinfo=timezone.utc)
-                new_planned = base_planned + delta
-
-            base_due = task.due_at
-            if base_due.tzinfo is None:
-                base_due = base_due.replace(tzinfo=timezone.utc)
-            new_due = base_due + delta
-
-            new_grace = None
-            if task.grace_end:
-                base_grace = task.grace_end
-                if base_grace.tzinfo is None:
-                    base_grace = base_grace.replace(tzinfo=timezone.utc)
-                new_grace = base_grace + delta
-
-            # Время создания новой задачи — ровно оригинальное + delta
-            new_creation_time = original_creation + delta
-
-            new_task = create_task_with_log(
-                title=task.title,
-                note=task.note,
-                planned_at=new_planned,
-                due_at=new_due,
-                grace_end=new_grace,
-                duration_seconds=task.duration_seconds,
-                priority=task.priority,
-                recurrence_seconds=task.recurrence_seconds,
-                dependencies=[],
-                status="planned",
-                tags=[tag.name for tag in task.tags],
-                next_uuid=None,
-                origin_uuid=task.origin_uuid or task.uuid,
-                creation_time=new_creation_time  # <<< ПЕРЕДАЁМ!
-            )
+        for row in rows:
+            deadline_scheduler.schedule(row["uuid"], task_triggers(
+                row["status"], row["due_at"], row["grace_end"], row["notify_at"], now
+            ) + (now,))
+        if rows:
+            logging.info(f"🔁 Порождено вхождений повторяющихся задач: {len(rows)}")
+        return rows
 
-            task.next_uuid = new_task.uuid
+    with app.app_context():
+        # Цепи из БД прежних версий: якорь восстанавливается по логам один раз
+        unanchored = db.session.scalars(
+            db.select(Task.uuid).where(Task.recurrence_seconds > 0, Task.origin_uuid.is_(None), Task.recurrence_anchor_at.is_(None))
+        ).all()
+        if unanchored:
+            anchor_chains(unanchored)
             db.session.commit()
+            print(f"🔁 Восстановлены якоря цепей повторений: {len(unanchored)}")
+
+    def catchup_limit(value):
+        try:
+            return max(1, int(value)) if value is not None else RECURRENCE_CATCHUP_LIMIT
+        except (TypeError, ValueError):
+            return RECURRENCE_CATCHUP_LIMIT
 
-        
     @app.route('/logic/spawn-recurring', methods=['POST'])
     def spawn_recurring_tasks_endpoint():
         try:
-            spawn_recurring_tasks()
-            return jsonify({"status": "ok", "message": "Цепи повторяющихся задач обработаны"}), 200
+            data = request.get_json(silent=True) or {}
+            spawned = spawn_recurring_tasks(limit=catchup_limit(data.get('limit')))
+            return jsonify({"status": "ok", "message": "Цепи повторяющихся задач обработаны", "spawned": len(spawned)}), 200
         except Exception as e:
             logging.error(f"Ошибка в spawn_recurring_tasks: {e}\n{traceback.format_exc()}")
             return jsonify({"error": str(e)}), 500
 
+    @app.route('/logic/spawn-recurring/preview', methods=['GET'])
+    def preview_recurring_spawns():
+        """Что породил бы /logic/spawn-recurring сейчас (или в момент ?at=) — без записи в БД."""
+        now = datetime.now(timezone.utc)
+        if request.args.get('at'):
+            try:
+                now = parse_sync_dt(request.args['at'])
+            except (ValueError, OverflowError):
+                return jsonify({"error": "Invalid 'at' in ISO 8601 format"}), 400
+        plans = plan_recurrence_spawns(now, catchup_limit(request.args.get('limit')))
+        return jsonify({
+            "at": now.isoformat().replace('+00:00', 'Z'),
+            "chains": [{
+                "origin_uuid": plan["head"].uuid,
+                "title": plan["template"].title,
+                "stopped": plan["next_at"] is None,
+                "skipped_periods": plan["skipped"],
+                "next_spawn_at": plan["next_at"].isoformat().replace('+00:00', 'Z') if plan["next_at"] else None,
+                "occurrences": [{
+                    "uuid": o["uuid"],
+                    "period": o["period"],
+                    "created_at": o["created_at"].isoformat().replace('+00:00', 'Z'),
+                    "planned_at": o["planned_at"].isoformat().replace('+00:00', 'Z') if o["planned_at"] else None,
+                    "due_at": o["due_at"].isoformat().replace('+00:00', 'Z'),
+                    "grace_end": o["grace_end"].isoformat().replace('+00:00', 'Z') if o["grace_end"] else None,
+                    "action": "exists" if o["exists"] else "deleted" if o["deleted"] else "create"
+                } for o in plan["occurrences"]]
+            } for plan in plans],
+            "to_create": sum(1 for plan in plans for o in plan["occurrences"] if not o["exists"] and not o["deleted"])
+        }), 200
+
     @app.route('/tasks/simple', methods=['GET'])
     def get_tasks_simple():
         tasks = db.session.query(Task.id, Task.uuid, Task.title, Task.status, Task.priority).all()
@@ -908,7 +2156,9 @@ def main():
     if args.port is not None:
         global PORT
         PORT = args.port
-    setup_routes(app, args.env)
+    # В режиме отладки перезагрузчик Werkzeug запускает main() дважды: фоновые потоки —
+    # только в дочернем процессе, который обслуживает запросы
+    setup_routes(app, args.env, background=os.environ.get("WERKZEUG_RUN_MAIN") == "true")
     print(f"Хвала Омниссии! ThisIsFine запущен на порту {PORT} с env={args.env}")
     app.run(debug=True, host='0.0.0.0', port=PORT)
 
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Замер движков автоподбора тегов: чистый Python (постинги) против NumPy/SciPy (CSR-матрица).
+Для каждого размера корпуса обучает модель один раз, затем загружает её обоими движками
+и сравнивает задержку запросов и совпадение рекомендаций.
+"""
+
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from tag_suggester import TagSuggester, generate_sample_tasks, HAS_NUMPY
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+
+
+def synthetic_tasks(n: int, rng: random.Random):
+    """Задачи из перемешанных слов встроенного обучающего набора."""
+    samples = generate_sample_tasks()
+    words = [w for s in samples for w in s["text"].split()]
+    tags = sorted({t for s in samples for t in s["tags"]})
+    return [
+        {"text": ' '.join(rng.choices(words, k=rng.randint(2, 8))), "tags": rng.sample(tags, 2)}
+        for _ in range(n)
+    ]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench_backend(model_path: Path, backend: str, queries):
+    load_start = time.perf_counter()
+    suggester = TagSuggester.load(model_path, backend=backend)
+    suggester.suggest_tags(queries[0])  # прогрев: построение матрицы/норм
+    load_time = time.perf_counter() - load_start
+
+    latencies, results = [], []
+    for q in queries:
+        start = time.perf_counter()
+        results.append(suggester.suggest_tags(q))
+        latencies.append(time.perf_counter() - start)
+
+    batch_start = time.perf_counter()
+    query_vecs = [suggester._query_vector(q) for q in queries]
+    suggester._nearest_batch(query_vecs)
+    batch_time = time.perf_counter() - batch_start
+
+    return {
+        "backend": suggester.backend,
+        "load_ms": load_time * 1000,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "batch_ms": batch_time * 1000,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замер движков автоподбора тегов')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Размеры корпуса')
+    parser.add_argument('--queries', type=int, default=200, help='Число запросов на размер')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    if not HAS_NUMPY:
+        print("⚠️  NumPy/SciPy не установлены — замеряется только движок python")
+    backends = ["python", "numpy"] if HAS_NUMPY else ["python"]
+
+    rng = random.Random(args.seed)
+    print(f"{'документов':>10} {'движок':>7} {'загрузка, мс':>13} {'p50, мс':>9} {'p99, мс':>9} {'пачка, мс':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            model_path = Path(tmp) / f"model_{size}.bin"
+            TagSuggester(synthetic_tasks(size, rng), backend="python").save(model_path)
+            queries = [t["text"] for t in synthetic_tasks(args.queries, rng)]
+
+            reports = [bench_backend(model_path, backend, queries) for backend in backends]
+            for r in reports:
+                print(f"{size:>10} {r['backend']:>7} {r['load_ms']:>13.1f} {r['p50_ms']:>9.3f} "
+                      f"{r['p99_ms']:>9.3f} {r['batch_ms']:>10.1f}")
+            if len(reports) == 2:
+                same = sum(a == b for a, b in zip(reports[0]["results"], reports[1]["results"]))
+                print(f"{'':>10} совпадение рекомендаций: {same}/{len(queries)}")
+
+
+if __name__ == '__main__':
+    main()
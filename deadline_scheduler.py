@@ -0,0 +1,151 @@
+# deadline_scheduler.py
+"""
+Планировщик сроков задач.
+
+Мин-куча моментов истечения (due_at, grace_end): фоновый поток спит до ближайшего
+момента и передаёт истёкшие uuid обработчику. Пока ничего не истекло, БД не читается.
+Если обработчик упал (например, "database is locked"), uuid возвращаются в кучу
+с экспоненциальной задержкой — сроки не теряются.
+"""
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineScheduler:
+    """
+    schedule(uuid, моменты) заменяет расписание задачи; on_expire(список uuid) вызывается
+    из фонового потока, когда наступает любой из моментов. Устаревшие записи кучи
+    не удаляются сразу, а пропускаются, когда оказываются на вершине.
+    """
+
+    def __init__(self, on_expire: Callable[[list], None], max_sleep: float = 60.0,
+                 retry_base: float = 5.0, retry_max: float = 300.0):
+        self.on_expire = on_expire
+        self.max_sleep = max_sleep  # верхняя граница сна — на случай перевода системных часов
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._failures = 0  # подряд упавших вызовов обработчика
+        self._heap = []  # (timestamp, uuid)
+        self._deadlines = {}  # uuid -> кортеж ещё не наступивших моментов
+        self._live_count = 0  # сумма длин кортежей _deadlines
+        self._cond = threading.Condition()
+        self._thread = None
+        self.fired = 0
+        self.retried = 0
+
+    def schedule(self, task_uuid: str, instants: Iterable[Optional[datetime]]):
+        # Наивное время считается UTC — так его возвращает SQLite
+        stamps = tuple(sorted({
+            (dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp()
+            for dt in instants if dt is not None
+        }))
+        with self._cond:
+            previous = self._deadlines.get(task_uuid, ())
+            if previous == stamps:
+                return
+            self._live_count += len(stamps) - len(previous)
+            if not stamps:
+                del self._deadlines[task_uuid]
+                return
+            self._deadlines[task_uuid] = stamps
+            earliest = self._heap[0][0] if self._heap else None
+            for stamp in stamps:
+                heapq.heappush(self._heap, (stamp, task_uuid))
+            self._compact()
+            if earliest is None or stamps[0] < earliest:
+                self._cond.notify()
+
+    def unschedule(self, task_uuid: str):
+        self.schedule(task_uuid, ())
+
+    def _live(self, entry):
+        return entry[0] in self._deadlines.get(entry[1], ())
+
+    def _compact(self):
+        # Частые переносы сроков оставляют в куче мусор — пересобираем, когда его слишком много
+        if len(self._heap) > 2 * self._live_count + 1024:
+            self._heap = [entry for entry in self._heap if self._live(entry)]
+            heapq.heapify(self._heap)
+
+    def _pop_expired(self):
+        """Ждёт ближайшего момента; возвращает uuid истёкших задач (под блокировкой)."""
+        with self._cond:
+            while True:
+                while self._heap and not self._live(self._heap[0]):
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait(self.max_sleep)
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(min(delay, self.max_sleep))
+                    continue
+                now = time.time()
+                expired = []
+                while self._heap and self._heap[0][0] <= now:
+                    stamp, task_uuid = heapq.heappop(self._heap)
+                    stamps = self._deadlines.get(task_uuid, ())
+                    if stamp not in stamps:
+                        continue
+                    rest = tuple(s for s in stamps if s != stamp)
+                    self._live_count -= 1
+                    if rest:
+                        self._deadlines[task_uuid] = rest
+                    else:
+                        del self._deadlines[task_uuid]
+                    expired.append(task_uuid)
+                return list(dict.fromkeys(expired))
+
+    def _retry(self, uuids):
+        """Возвращает uuid в кучу через retry_base * 2^n секунд (не более retry_max)."""
+        delay = min(self.retry_base * 2 ** self._failures, self.retry_max)
+        self._failures += 1
+        self.retried += len(uuids)
+        stamp = time.time() + delay
+        with self._cond:
+            for task_uuid in uuids:
+                stamps = self._deadlines.get(task_uuid, ())
+                if stamp in stamps:
+                    continue
+                self._deadlines[task_uuid] = tuple(sorted(stamps + (stamp,)))
+                self._live_count += 1
+                heapq.heappush(self._heap, (stamp, task_uuid))
+            self._cond.notify()
+        return delay
+
+    def _run(self):
+        while True:
+            expired = self._pop_expired()
+            if not expired:
+                continue
+            self.fired += len(expired)
+            try:
+                self.on_expire(expired)
+            except Exception as e:
+                delay = self._retry(expired)
+                logger.error(f"💥 Ошибка обработки истёкших сроков, повтор через {delay:g} с: {e}", exc_info=True)
+            else:
+                self._failures = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name="deadline-scheduler")
+            self._thread.start()
+
+    def stats(self):
+        with self._cond:
+            live = [entry for entry in self._heap if self._live(entry)]
+            next_at = min(live)[0] if live else None
+            return {
+                "scheduled_tasks": len(self._deadlines),
+                "heap_size": len(self._heap),
+                "next_at": datetime.fromtimestamp(next_at, timezone.utc).isoformat().replace('+00:00', 'Z') if next_at else None,
+                "fired": self.fired,
+                "retried": self.retried
+            }
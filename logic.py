@@ -13,18 +13,26 @@ import argparse
 from pathlib import Path
 from dotenv import load_dotenv
 import os
+from datetime import datetime, timezone
 from urllib.parse import urljoin
 
 # === Константы по умолчанию ===
 DEFAULT_ENV_FILE = Path("tif.env")
 
 # Интервалы в секундах (неизменны)
-TICK_INTERVAL = 15      # для /logic/process-tick — быстрый
+# Переходы по срокам (planned → overdue → failed) выполняет планировщик сервера — опрос /logic/process-tick не нужен
 SPAWN_INTERVAL = 30     # для /logic/spawn-recurring — средний
 SYNC_INTERVAL = 900     # для /sync/peers/sync — медленный (15 мин)
+SYNC_CHECK_INTERVAL = 30  # как часто проверять, каким пирам пора синхронизироваться
+SYNC_TIMEOUT = 60       # таймаут синхронизации одного пира
+
+# Сколько пиров синхронизируется одновременно (SYNC_CONCURRENCY в .env)
+DEFAULT_SYNC_CONCURRENCY = 4
 
 # Глобальные переменные (инициализируются в main)
 THISISFINE_URL = None
+SYNC_CONCURRENCY = DEFAULT_SYNC_CONCURRENCY
+SYNC_TOKEN = None
 
 # Логгер
 logging.basicConfig(level=logging.INFO)
@@ -46,15 +54,6 @@ async def call_endpoint(session: aiohttp.ClientSession, url: str, name: str):
         logger.exception(f"💥 {name} — ошибка: {e}")
 
 
-async def periodic_process_tick(session: aiohttp.ClientSession):
-    """Обновление статусов по времени (planned → overdue → failed)."""
-    global THISISFINE_URL
-    while True:
-        url = urljoin(THISISFINE_URL, "/logic/process-tick")
-        await call_endpoint(session, url, "process-tick")
-        await asyncio.sleep(TICK_INTERVAL)
-
-
 async def periodic_spawn_recurring(session: aiohttp.ClientSession):
     """Порождение следующих задач в цепи повторяющихся."""
     global THISISFINE_URL
@@ -64,55 +63,85 @@ async def periodic_spawn_recurring(session: aiohttp.ClientSession):
         await asyncio.sleep(SPAWN_INTERVAL)
 
 
+def parse_time(value):
+    if not value:
+        return None
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def peer_is_due(peer: dict, now: datetime) -> bool:
+    """Пора ли синхронизироваться: отсрочка после ошибок истекла, а успешная синхронизация устарела."""
+    health = peer.get("health") or {}
+    next_attempt = parse_time(health.get("next_attempt_at"))
+    if next_attempt and next_attempt > now:
+        return False
+    if health.get("consecutive_failures"):
+        return True  # отсрочка истекла — повторяем, не дожидаясь SYNC_INTERVAL
+    last_attempt = parse_time(health.get("last_attempt_at") or peer.get("last_sync"))
+    return last_attempt is None or (now - last_attempt).total_seconds() >= SYNC_INTERVAL
+
+
+async def sync_peer(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, peer: dict):
+    """Синхронизация одного пира; ошибки и задержку записывает сервер в здоровье пира."""
+    address = peer["address"]
+    sync_url = urljoin(THISISFINE_URL, "/sync/peers/sync")
+    async with semaphore:
+        logger.info(f"🔄 Синхронизация с {peer.get('name', address)}")
+        try:
+            async with session.post(
+                sync_url,
+                json={"address": address},
+                headers={"X-Sync-Token": SYNC_TOKEN} if SYNC_TOKEN else None,
+                timeout=aiohttp.ClientTimeout(total=SYNC_TIMEOUT)
+            ) as resp:
+                if resp.status == 200:
+                    result = await resp.json()
+                    latency = (result.get("health") or {}).get("last_latency_ms")
+                    logger.info(f"✅ Синхронизация с {address} завершена за {latency} мс")
+                else:
+                    text = await resp.text()
+                    logger.error(f"❌ Синхронизация с {address} провалена: {resp.status} {text[:500]}")
+        except asyncio.TimeoutError:
+            logger.error(f"⏰ Таймаут при синхронизации с {address}")
+        except Exception as e:
+            logger.exception(f"💥 Ошибка синхронизации с {address}: {e}")
+
+
 async def periodic_sync_peers(session: aiohttp.ClientSession):
-    """Фоновая синхронизация с пировыми устройствами."""
+    """
+    Фоновая синхронизация с пировыми устройствами: пиры синхронизируются параллельно
+    (не больше SYNC_CONCURRENCY одновременно), медленный пир не задерживает остальных,
+    недоступный — повторяется с отсрочкой, назначенной сервером. Параллелен только
+    обмен с пирами; слияние в БД сервер выполняет по одной пачке за раз.
+    """
     global THISISFINE_URL
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+    in_flight = {}  # адрес -> asyncio.Task
+
     while True:
         peers_url = urljoin(THISISFINE_URL, "/sync/peers")
         try:
             async with session.get(peers_url) as resp:
-                if resp.status != 200:
-                    await asyncio.sleep(SYNC_INTERVAL)
-                    continue
-                peers = await resp.json()
+                peers = await resp.json() if resp.status == 200 else []
         except Exception as e:
             logger.warning(f"Не удалось получить список пиров: {e}")
-            await asyncio.sleep(SYNC_INTERVAL)
-            continue
-
-        if not peers:
-            logger.debug("Нет пиров для синхронизации")
-            await asyncio.sleep(SYNC_INTERVAL)
-            continue
+            peers = []
 
-        sync_url = urljoin(THISISFINE_URL, "/sync/peers/sync")
+        now = datetime.now(timezone.utc)
         for peer in peers:
             address = peer.get("address")
-            if not address:
+            if not address or address in in_flight or not peer_is_due(peer, now):
                 continue
-            logger.info(f"🔄 Синхронизация с {peer.get('name', address)}")
-            try:
-                payload = {"address": address}
-                async with session.post(
-                    sync_url,
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=60)
-                ) as resp:
-                    if resp.status == 200:
-                        logger.info(f"✅ Синхронизация с {address} завершена")
-                    else:
-                        text = await resp.text()
-                        logger.error(f"❌ Синхронизация с {address} провалена: {resp.status} {text}")
-            except asyncio.TimeoutError:
-                logger.error(f"⏰ Таймаут при синхронизации с {address}")
-            except Exception as e:
-                logger.exception(f"💥 Ошибка синхронизации с {address}: {e}")
-
-        await asyncio.sleep(SYNC_INTERVAL)
+            task = asyncio.create_task(sync_peer(session, semaphore, peer))
+            in_flight[address] = task
+            task.add_done_callback(lambda _, address=address: in_flight.pop(address, None))
+
+        await asyncio.sleep(SYNC_CHECK_INTERVAL)
 
 
 async def main():
-    global THISISFINE_URL
+    global THISISFINE_URL, SYNC_CONCURRENCY, SYNC_TOKEN
 
     parser = argparse.ArgumentParser(description='Асинхронный демон логики ThisIsFine')
     parser.add_argument('--env', type=Path, default=DEFAULT_ENV_FILE, help='Путь к .env-файлу')
@@ -144,12 +173,19 @@ async def main():
         if THISISFINE_URL.endswith('/'):
             THISISFINE_URL = THISISFINE_URL.rstrip('/')
 
+    SYNC_TOKEN = os.getenv("SYNC_TOKEN")
+    try:
+        SYNC_CONCURRENCY = max(1, int(os.getenv("SYNC_CONCURRENCY", DEFAULT_SYNC_CONCURRENCY)))
+    except ValueError:
+        logger.warning(f"Неверный SYNC_CONCURRENCY в .env, используется {DEFAULT_SYNC_CONCURRENCY}")
+
     logger.info(f"🧠 Асинхронный демон логики запущен с env={env_path}")
     logger.info(f"🔗 Целевой URL: {THISISFINE_URL}")
 
-    async with aiohttp.ClientSession() as session:
+    # Keep-alive соединения к серверу: параллельные синхронизации плюс периодические вызовы
+    connector = aiohttp.TCPConnector(limit=SYNC_CONCURRENCY + 4, keepalive_timeout=SYNC_CHECK_INTERVAL * 2)
+    async with aiohttp.ClientSession(connector=connector) as session:
         await asyncio.gather(
-            periodic_process_tick(session),
             periodic_spawn_recurring(session),
             periodic_sync_peers(session),
         )
@@ -40,6 +40,8 @@ class TaskStatusLog(db.Model):
     task_uuid = db.Column(db.String(36), db.ForeignKey('tasks.uuid'), nullable=False)
     status = db.Column(db.String(20), nullable=False)  # planned, inProgress, done...
     changed_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    # Локальное время появления записи на этом узле (для дельта-синхронизации)
+    recorded_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), index=True)
 
     def to_dict(self):
         return {
@@ -65,9 +67,18 @@ class Task(db.Model):
     status = db.Column(db.String(20), nullable=False, default='planned')
     completed_at = db.Column(db.DateTime(timezone=True), nullable=True)
     updated_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    # Локальное время последнего изменения строки на этом узле (updated_at при слиянии берётся с пира)
+    modified_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), index=True)
     # Добавить в Task:
     next_uuid = db.Column(db.String(36), db.ForeignKey('tasks.uuid'), nullable=True)
     origin_uuid = db.Column(db.String(36), db.ForeignKey('tasks.uuid'), nullable=True)
+    # Состояние цепи повторений — только у головы (origin_uuid IS NULL), на пиров не передаётся
+    recurrence_anchor_at = db.Column(db.DateTime(timezone=True), nullable=True)  # создание оригинала
+    recurrence_next_at = db.Column(db.DateTime(timezone=True), nullable=True, index=True)  # когда породить следующее вхождение
+    recurrence_tail_uuid = db.Column(db.String(36), nullable=True)  # последнее вхождение цепи
+    # Следующее уведомление: момент и тип (start, due_warn, overdue, grace_warn, failed); NULL — нечего слать
+    notify_at = db.Column(db.DateTime(timezone=True), nullable=True, index=True)
+    notify_type = db.Column(db.String(20), nullable=True)
 
     # Связь с тегами
     tags = db.relationship(
@@ -77,7 +88,15 @@ class Task(db.Model):
         backref=db.backref('tasks', lazy=True)
     )
 
-    def to_dict(self):
+    # Переходы по срокам и отбор уведомлений выбирают задачи по статусу и истёкшему моменту
+    __table_args__ = (
+        db.Index('ix_tasks_status_due_at', 'status', 'due_at'),
+        db.Index('ix_tasks_status_grace_end', 'status', 'grace_end'),
+        db.Index('ix_tasks_status_planned_at', 'status', 'planned_at'),
+    )
+
+    def to_dict(self, tag_names=None):
+        """tag_names — заранее загруженные имена тегов (без обращения к связи self.tags)."""
         def format_dt(dt):
             return dt.isoformat() + 'Z' if dt else None
 
@@ -92,13 +111,15 @@ class Task(db.Model):
                 "grace_end": format_dt(self.grace_end)
             },
             "duration_seconds": self.duration_seconds,
-            "tags": [tag.name for tag in self.tags],
+            "tags": tag_names if tag_names is not None else [tag.name for tag in self.tags],
             "priority": self.priority,
             "recurrence_seconds": self.recurrence_seconds,
             "dependencies": self.dependencies or [],
             "status": self.status,
             "completed_at": format_dt(self.completed_at),
-            "updated_at": format_dt(self.updated_at)
+            "updated_at": format_dt(self.updated_at),
+            "next_uuid": self.next_uuid,
+            "origin_uuid": self.origin_uuid
         }
 
 
@@ -110,6 +131,26 @@ class PeerDevice(db.Model):
     device_id = db.Column(db.String(36), nullable=False)      # уникальный ID узла
     last_sync = db.Column(db.DateTime(timezone=True), nullable=True)
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    remote_watermark = db.Column(db.String(64), nullable=True)       # отметка, выданная пиром при последней выгрузке
+    push_watermark = db.Column(db.DateTime(timezone=True), nullable=True)  # до какого момента наши изменения приняты пиром
+    # Здоровье пира: по нему демон логики решает, когда синхронизироваться снова
+    last_attempt_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_latency_ms = db.Column(db.Float, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    consecutive_failures = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=True)  # раньше не пытаться (отсрочка после ошибок)
+
+    def health_dict(self):
+        def format_dt(dt):
+            return dt.isoformat() + 'Z' if dt else None
+
+        return {
+            'last_attempt_at': format_dt(self.last_attempt_at),
+            'last_latency_ms': self.last_latency_ms,
+            'last_error': self.last_error,
+            'consecutive_failures': self.consecutive_failures or 0,
+            'next_attempt_at': format_dt(self.next_attempt_at)
+        }
 
     def to_dict(self):
         def format_dt(dt):
@@ -121,5 +162,62 @@ class PeerDevice(db.Model):
             'address': self.address,
             'device_id': self.device_id,
             'last_sync': format_dt(self.last_sync),
-            'created_at': format_dt(self.created_at)
+            'created_at': format_dt(self.created_at),
+            'health': self.health_dict()
         }
+
+
+class TaskTombstone(db.Model):
+    """Отметка об удалении задачи — чтобы удаление дошло до пиров при дельта-синхронизации."""
+    __tablename__ = 'task_tombstones'
+    uuid = db.Column(db.String(36), primary_key=True)
+    deleted_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc), index=True)
+
+    def to_dict(self):
+        return {
+            "uuid": self.uuid,
+            "deleted_at": self.deleted_at.isoformat() + 'Z'
+        }
+
+
+class NotificationLedger(db.Model):
+    """Отправленное уведомление: (задача, тип) — чтобы не повторять его после перезапуска."""
+    __tablename__ = 'notification_ledger'
+    task_uuid = db.Column(db.String(36), primary_key=True)
+    type = db.Column(db.String(20), primary_key=True)  # start, due_warn, overdue, grace_warn, failed
+    notified_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc), index=True)
+
+
+# Заполнение столбцов, добавленных в уже существующую БД
+SCHEMA_BACKFILL = {
+    ('tasks', 'modified_at'): "UPDATE tasks SET modified_at = updated_at WHERE modified_at IS NULL",
+    ('task_status_log', 'recorded_at'): "UPDATE task_status_log SET recorded_at = changed_at WHERE recorded_at IS NULL",
+    ('peer_devices', 'consecutive_failures'): "UPDATE peer_devices SET consecutive_failures = 0 WHERE consecutive_failures IS NULL",
+    # Расписание уведомлений существующих задач пересчитает первый же сбор уведомлений
+    ('tasks', 'notify_at'): "UPDATE tasks SET notify_at = '1970-01-01 00:00:00.000000' WHERE status != 'done'",
+}
+
+
+def ensure_schema():
+    """
+    Создаёт недостающие таблицы, а в существующих — недостающие столбцы и индексы.
+    Лёгкая замена миграциям: db.create_all() не трогает уже созданные таблицы.
+    """
+    db.create_all()
+    with db.engine.begin() as conn:
+        # Инспектор на том же соединении: после крупного заполнения столбца БД заблокирована для других
+        inspector = db.inspect(conn)
+        for table in db.metadata.sorted_tables:
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                conn.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                backfill = SCHEMA_BACKFILL.get((table.name, column.name))
+                if backfill:
+                    conn.execute(db.text(backfill))
+            existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(bind=conn)
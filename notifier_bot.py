@@ -6,11 +6,15 @@
 """
 
 import os
+import json
+import time
+import sqlite3
 import asyncio
 import logging
 from datetime import datetime, timezone, timedelta
-import requests
+import aiohttp
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -31,240 +35,538 @@ else:
     print("ℹ️ Временный файл не найден, использую tif.env")
 
 
-task_message_ids = {}
 # === Настройки ===
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 THISISFINE_URL = os.getenv("THISISFINE_URL", "http://localhost:5000")
+# Свой сервер Bot API (или заглушка для тестов) вместо https://api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# HTTP-клиент ThisIsFine: keep-alive пул и таймауты на каждый вызов
+API_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=3)
+API_POOL_SIZE = 8
+# Исходящие запросы к Telegram: ~1 сообщение в секунду на чат (с небольшим запасом
+# на всплеск) и до 30 в секунду на бота; 429 Retry-After приостанавливает чат
+TELEGRAM_POOL_SIZE = 8
+CHAT_RATE = 1.0
+CHAT_BURST = 5
+BOT_RATE = 30.0
+SEND_ATTEMPTS = 5
+# Однотипные уведомления, пришедшие вместе (за DIGEST_WINDOW с), при количестве
+# больше DIGEST_THRESHOLD сворачиваются в сводку до DIGEST_MAX_TASKS задач
+DIGEST_WINDOW = 0.3
+DIGEST_THRESHOLD = 3
+DIGEST_MAX_TASKS = 15
+DIGEST_ROW = 4
+# Реестр сообщений с кнопками (переживает перезапуск); записи завершённых задач
+# вычищаются раз в REGISTRY_PRUNE_INTERVAL с, любые — через REGISTRY_TTL
+REGISTRY_PATH = os.getenv("NOTIFIER_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "notifier.sqlite"))
+REGISTRY_PRUNE_INTERVAL = 600
+REGISTRY_TTL = 7 * 24 * 3600
+# Лента /notify/stream: сервер шлёт keep-alive раз в 15 с — молчание дольше считаем обрывом
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=3, sock_read=60)
+STREAM_RECONNECT_MAX = 60
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-# Глобальное хранилище предупреждений
-warned_tasks = set()
+# Общая сессия создаётся при запуске приложения (post_init) и закрывается при остановке
+http_session = None
 
-def update_task_status(task_id: int, status: str):
-    try:
-        requests.put(f"{THISISFINE_URL}/tasks/{task_id}", json={"status": status}, timeout=10)
-    except Exception as e:
-        logger.error(f"Не удалось обновить статус задачи {task_id}: {e}")
-
-def postpone_task(task_id: int, hours: float = 1):
-    """Откладывает planned_at на N часов и сбрасывает warned_tasks для этой задачи."""
-    global warned_tasks
-    print("postpone", task_id)
+
+async def api_request(method: str, path: str, **kwargs):
+    """
+    Запрос к ThisIsFine без блокировки цикла бота: (код ответа, JSON или None).
+    Сетевые ошибки и таймауты логируются и дают (None, None).
+    """
     try:
-        # Получаем текущую задачу
-        task_res = requests.get(f"{THISISFINE_URL}/tasks/{task_id}", timeout=10)
-        print(task_res)
-        if task_res.status_code != 200:
-            return
-        task = task_res.json()
-        uuid = task.get("uuid")
-        if not uuid:
-            return
-
-        # Обновляем planned_at
-        now = datetime.now(timezone.utc)
-        new_planned = now + timedelta(hours=hours)
-
-        # Формируем deadlines как объект (важно!)
-        deadlines = task.get("deadlines", {})
-        deadlines["planned_at"] = new_planned.isoformat().replace("+00:00", "Z")
-
-        # Отправляем ТОЛЬКО deadlines и status (если нужно)
-        update_data = {
-            "deadlines": deadlines
-        }
-        res = requests.put(
-            f"{THISISFINE_URL}/tasks/{task_id}",
-            json=update_data,
-            timeout=10
-        )
-        if res.status_code == 200:
-            # Сбрасываем уведомления для этой задачи
-            warned_tasks = {k for k in warned_tasks if not k.startswith(f"{uuid}_")}
-            logger.info(f"Задача {task_id} отложена до {new_planned}. Уведомления сброшены.")
-        else:
-            logger.error(f"Не удалось отложить задачу {task_id}: {res.status_code} {res.text}")
-    except Exception as e:
-        logger.error(f"Ошибка при откладывании задачи {task_id}: {e}")
+        async with http_session.request(method, f"{THISISFINE_URL}{path}", timeout=API_TIMEOUT, **kwargs) as resp:
+            try:
+                data = await resp.json(content_type=None)
+            except ValueError:
+                data = None
+            return resp.status, data
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Запрос {method} {path} не удался: {e!r}")
+        return None, None
 
-# --- Фоновая задача (работает в том же loop, что и бот) ---
-async def check_and_notify(context: ContextTypes.DEFAULT_TYPE):
-    """Опрашивает эндпоинт /notify/pending и отправляет уведомления, если они есть."""
-    global warned_tasks
-    bot = context.bot
-    chat_id = CHAT_ID
-    if not chat_id:
-        logger.warning("CHAT_ID не задан — уведомления отключены")
-        return
 
-    try:
-        res = requests.get(f"{THISISFINE_URL}/notify/pending", timeout=10)
-        pending_tasks = res.json() if res.status_code == 200 else []
-    except Exception as e:
-        logger.error(f"Не удалось получить очередь уведомлений: {e}")
+async def get_task(task_id: int):
+    status, task = await api_request("GET", f"/tasks/{task_id}")
+    return task if status == 200 else None
+
+
+async def update_task_status(task_id: int, status: str):
+    code, _ = await api_request("PUT", f"/tasks/{task_id}", json={"status": status})
+    if code != 200:
+        logger.error(f"Не удалось обновить статус задачи {task_id}: {code}")
+
+
+async def postpone_task(task_id: int, hours: float = 1, task: dict = None):
+    """Откладывает planned_at на N часов; сервер сам снимает отметку об уведомлении «пора начинать»."""
+    task = task or await get_task(task_id)
+    if not task or not task.get("uuid"):
         return
 
+    # Обновляем planned_at
     now = datetime.now(timezone.utc)
-    current_warned = set(warned_tasks)
+    new_planned = now + timedelta(hours=hours)
 
-    for task in pending_tasks:
-        uuid = task.get("uuid")
-        if not uuid:
-            continue
+    # Формируем deadlines как объект (важно!)
+    deadlines = dict(task.get("deadlines", {}))
+    deadlines["planned_at"] = new_planned.isoformat().replace("+00:00", "Z")
 
-        task_id = task["id"]
-        title = task["title"]
-        status = task.get("status")
-        deadlines = task.get("deadlines", {})
-        duration = task.get("duration_seconds", 0)
-        notification_type = task.get("notification_type")
-
-        warn_key = f"{uuid}_{notification_type}"
-        if warn_key in warned_tasks:
-            continue  # Уже отправляли — защита от дублей
-
-        # === Формируем текст и кнопки ===
-        text = ""
-        btns = None
-
-        if notification_type == "start":
-            text = f"🕗 Задача «{title}» пора начинать!"
-            btns = InlineKeyboardMarkup([
-                [InlineKeyboardButton("▶️ Начать", callback_data=f"start_{task_id}")],
-                [
-                    InlineKeyboardButton("+15 мин", callback_data=f"postpone_{task_id}_15"),
-                    InlineKeyboardButton("+30 мин", callback_data=f"postpone_{task_id}_30"),
-                    InlineKeyboardButton("+1 ч", callback_data=f"postpone_{task_id}_60"),
-                    InlineKeyboardButton("+2 ч", callback_data=f"postpone_{task_id}_120")
-                ],
-                [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
-            ])
-
-        elif notification_type == "due_warn":
-            text = f"⚠️ У задачи «{title}» осталось мало времени!"
-            if status != "inProgress":
-                btns = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("▶️ Начать", callback_data=f"start_{task_id}")],
-                    [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
-                ])
-            else:
-                btns = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
-                ])
-
-        elif notification_type == "overdue":
-            text = f"🔥 Задача «{title}» ПРОСРОЧЕНА!"
-            if status != "inProgress":
-                btns = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("▶️ Начать", callback_data=f"start_{task_id}")],
-                    [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
-                ])
-            else:
-                btns = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
-                ])
-
-        elif notification_type == "grace_warn":
-            text = f"🚨 Последний шанс для «{title}»!"
-            if status != "inProgress":
-                btns = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("▶️ Начать", callback_data=f"start_{task_id}")],
-                    [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
-                ])
-            else:
-                btns = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
-                ])
+    # Отправляем ТОЛЬКО deadlines
+    code, body = await api_request("PUT", f"/tasks/{task_id}", json={"deadlines": deadlines})
+    if code == 200:
+        logger.info(f"Задача {task_id} отложена до {new_planned}. Уведомления сброшены.")
+    else:
+        logger.error(f"Не удалось отложить задачу {task_id}: {code} {body}")
 
-        elif notification_type == "failed":
-            text = f"💀 Срок для «{title}» истёк. Задача помечена как FAILED."
-            btns = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
-            ])
+# --- Фоновая задача (работает в том же loop, что и бот) ---
+def build_notification(task: dict):
+    """Текст и кнопки уведомления; None — неизвестный тип."""
+    task_id = task["id"]
+    title = task["title"]
+    status = task.get("status")
+    notification_type = task.get("notification_type")
+
+    if notification_type == "start":
+        text = f"🕗 Задача «{title}» пора начинать!"
+        btns = InlineKeyboardMarkup([
+            [InlineKeyboardButton("▶️ Начать", callback_data=f"start_{task_id}")],
+            [
+                InlineKeyboardButton("+15 мин", callback_data=f"postpone_{task_id}_15"),
+                InlineKeyboardButton("+30 мин", callback_data=f"postpone_{task_id}_30"),
+                InlineKeyboardButton("+1 ч", callback_data=f"postpone_{task_id}_60"),
+                InlineKeyboardButton("+2 ч", callback_data=f"postpone_{task_id}_120")
+            ],
+            [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
+        ])
+        return text, btns
+
+    if notification_type == "due_warn":
+        text = f"⚠️ У задачи «{title}» осталось мало времени!"
+    elif notification_type == "overdue":
+        text = f"🔥 Задача «{title}» ПРОСРОЧЕНА!"
+    elif notification_type == "grace_warn":
+        text = f"🚨 Последний шанс для «{title}»!"
+    elif notification_type == "failed":
+        text = f"💀 Срок для «{title}» истёк. Задача помечена как FAILED."
+        btns = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
+        ])
+        return text, btns
+    else:
+        logger.warning(f"Неизвестный тип уведомления: {notification_type}")
+        return None
+
+    if status != "inProgress":
+        btns = InlineKeyboardMarkup([
+            [InlineKeyboardButton("▶️ Начать", callback_data=f"start_{task_id}")],
+            [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
+        ])
+    else:
+        btns = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Готово", callback_data=f"done_{task_id}")]
+        ])
+    return text, btns
 
-        else:
-            logger.warning(f"Неизвестный тип уведомления: {notification_type}")
-            continue
 
-        # === Отправка ===
-        try:
-            msg = await bot.send_message(chat_id=chat_id, text=text, reply_markup=btns)
-            # Сохраняем message_id для последующей очистки кнопок
-            if uuid not in task_message_ids:
-                task_message_ids[uuid] = []
-            task_message_ids[uuid].append({
-                "msg_id": msg.message_id,
-                "type": "start" if notification_type in ("start", "due_warn", "overdue", "grace_warn") else "done"
-            })
-            current_warned.add(warn_key)
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление для задачи {task_id}: {e}")
+DIGEST_HEADERS = {
+    "start": "🕗 Пора начинать задачи ({n}):",
+    "due_warn": "⚠️ Мало времени осталось у задач ({n}):",
+    "overdue": "🔥 ПРОСРОЧЕНЫ задачи ({n}):",
+    "grace_warn": "🚨 Последний шанс для задач ({n}):",
+    "failed": "💀 Срок истёк, задачи помечены как FAILED ({n}):",
+}
+
+
+def notification_kind(notification_type):
+    """Какие кнопки в сообщении: "start" — есть «Начать», "done" — только «Готово»."""
+    return "start" if notification_type in ("start", "due_warn", "overdue", "grace_warn") else "done"
+
+
+def build_digest(notification_type: str, tasks: list):
+    """Сводка однотипных уведомлений: нумерованный список и кнопки «▶️ N» / «✅ N»."""
+    lines = [DIGEST_HEADERS[notification_type].format(n=len(tasks))]
+    buttons = []
+    for i, task in enumerate(tasks, 1):
+        lines.append(f"{i}. {task['title']}")
+        if notification_type == "start" or (notification_type != "failed" and task.get("status") != "inProgress"):
+            buttons.append((f"▶️ {i}", f"start_{task['id']}", task["id"]))
+        buttons.append((f"✅ {i}", f"done_{task['id']}", task["id"]))
+    return "\n".join(lines), buttons
 
-    warned_tasks = current_warned
 
-async def clear_task_messages(bot, chat_id, uuid, action_type=None):
+def digest_markup(buttons: list):
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(label, callback_data=data) for label, data, _ in buttons[i:i + DIGEST_ROW]]
+        for i in range(0, len(buttons), DIGEST_ROW)
+    ])
+
+
+def compose_messages(batch: list):
     """
-    Удаляет кнопки из сообщений по задаче.
-    :param action_type: None → все кнопки, "start" → только кнопки "Начать", "done" → только "Готово"
+    Сообщения для пачки уведомлений: (тип, текст, кнопки, задачи, кнопки сводки или None).
+    Однотипных больше DIGEST_THRESHOLD — сводки по DIGEST_MAX_TASKS задач, остальные — по одному.
     """
-    if uuid not in task_message_ids:
-        return
+    groups = {}
+    for task in batch:
+        if task.get("uuid"):
+            groups.setdefault(task.get("notification_type"), []).append(task)
+
+    messages = []
+    for notification_type, tasks in groups.items():
+        if len(tasks) > DIGEST_THRESHOLD and notification_type in DIGEST_HEADERS:
+            for i in range(0, len(tasks), DIGEST_MAX_TASKS):
+                chunk = tasks[i:i + DIGEST_MAX_TASKS]
+                text, buttons = build_digest(notification_type, chunk)
+                messages.append((notification_type, text, digest_markup(buttons), chunk, buttons))
+            continue
+        for task in tasks:
+            notification = build_notification(task)
+            if notification is not None:
+                messages.append((notification_type, *notification, [task], None))
+    return messages
+
 
-    messages_to_keep = []
-    for item in task_message_ids[uuid]:
-        msg_id = item["msg_id"]
-        msg_type = item["type"]
+# --- Исходящая очередь Telegram ---
+class TokenBucket:
+    """
+    Ведро токенов: rate в секунду, в запасе не больше capacity. acquire() ждёт токен;
+    pause() — ответ 429: до конца паузы токены не выдаются, после неё — один токен.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = min(1.0, self.capacity)
+            self._stamp = until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TelegramOutbox:
+    """
+    Все запросы бота к Telegram идут через request(): ведро чата и общее ведро бота,
+    повтор после 429 (Retry-After) и сетевых сбоев. Уведомления ставятся в очередь чата
+    через notify(); обработчик очереди собирает пришедшие вместе и сворачивает однотипные.
+    """
 
-        # Удаляем кнопки, если:
-        # - action_type=None (все), ИЛИ
-        # - action_type совпадает с типом сообщения
-        if action_type is None or msg_type == action_type:
+    def __init__(self, bot):
+        self.bot = bot
+        self.bot_bucket = TokenBucket(BOT_RATE, BOT_RATE)
+        self.chat_buckets = {}
+        self.pending = {}  # chat_id -> уведомления, ждущие отправки
+        self.workers = {}  # chat_id -> задача, отправляющая очередь чата
+
+    def bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+        return self.chat_buckets[chat_id]
+
+    async def request(self, chat_id, method, /, *args, **kwargs):
+        """Вызов метода бота с ограничением скорости; None — Telegram отклонил запрос или не ответил."""
+        bucket = self.bucket(chat_id)
+        for attempt in range(SEND_ATTEMPTS):
+            await bucket.acquire()
+            await self.bot_bucket.acquire()
             try:
-                await bot.edit_message_reply_markup(
-                    chat_id=chat_id,
-                    message_id=msg_id,
-                    reply_markup=None
+                return await method(*args, **kwargs)
+            except RetryAfter as e:
+                logger.warning(f"⏳ Telegram просит подождать {e.retry_after} с (чат {chat_id})")
+                bucket.pause(e.retry_after)
+            except BadRequest as e:
+                logger.warning(f"Telegram отклонил {method.__name__}: {e}")
+                return None
+            except NetworkError as e:
+                logger.warning(f"Сбой связи с Telegram ({method.__name__}): {e}; повтор через {2 ** attempt} с")
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                logger.error(f"Telegram отклонил {method.__name__}: {e}")
+                return None
+        logger.error(f"{method.__name__} не выполнен за {SEND_ATTEMPTS} попыток (чат {chat_id})")
+        return None
+
+    def notify(self, chat_id, task: dict):
+        """Ставит уведомление в очередь чата; отправка — в фоне."""
+        self.pending.setdefault(chat_id, []).append(task)
+        worker = self.workers.get(chat_id)
+        if worker is None or worker.done():
+            self.workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+    async def _drain(self, chat_id):
+        while self.pending.get(chat_id):
+            # Даём догнать остальным уведомлениям той же пачки, чтобы свернуть их в сводку
+            await asyncio.sleep(DIGEST_WINDOW)
+            batch = self.pending.pop(chat_id)
+            for notification_type, text, btns, tasks, buttons in compose_messages(batch):
+                msg = await self.request(chat_id, self.bot.send_message, chat_id=chat_id, text=text, reply_markup=btns)
+                if msg is not None:
+                    registry.add(msg.chat_id, msg.message_id, notification_type, tasks, buttons)
+            # Курсор ленты сдвигается только после отправки: упавший до неё нотификатор
+            # после перезапуска получит эти события снова
+            cursor = batch[-1].get("cursor")
+            if cursor:
+                registry.save_stream_cursor(cursor)
+
+    def close(self):
+        dropped = sum(len(batch) for batch in self.pending.values())
+        if dropped:
+            logger.warning(f"Остановка: не отправлено уведомлений — {dropped}")
+        for worker in self.workers.values():
+            worker.cancel()
+
+
+class MessageRegistry:
+    """
+    Сообщения с кнопками по задачам (uuid → сообщения) в SQLite: переживают перезапуск
+    нотификатора и не копятся в памяти. Для сводок хранится их клавиатура, чтобы снимать
+    кнопки по одной задаче. Здесь же — курсор последнего принятого события ленты.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS task_messages (
+                task_uuid TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                msg_id INTEGER NOT NULL,
+                task_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                digest INTEGER NOT NULL DEFAULT 0,
+                sent_at REAL NOT NULL,
+                PRIMARY KEY (task_uuid, chat_id, msg_id)
+            );
+            CREATE INDEX IF NOT EXISTS ix_task_messages_msg ON task_messages (chat_id, msg_id);
+            CREATE INDEX IF NOT EXISTS ix_task_messages_sent_at ON task_messages (sent_at);
+            CREATE TABLE IF NOT EXISTS digest_keyboards (
+                chat_id INTEGER NOT NULL,
+                msg_id INTEGER NOT NULL,
+                buttons TEXT NOT NULL,
+                PRIMARY KEY (chat_id, msg_id)
+            );
+            CREATE TABLE IF NOT EXISTS stream_state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+
+    def stream_cursor(self):
+        """Курсор последнего принятого события /notify/stream или None."""
+        row = self.db.execute("SELECT value FROM stream_state WHERE key = 'cursor'").fetchone()
+        return row[0] if row else None
+
+    def save_stream_cursor(self, cursor: str):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO stream_state VALUES ('cursor', ?)", (cursor,))
+
+    def add(self, chat_id: int, msg_id: int, notification_type: str, tasks: list, buttons):
+        """Запоминает отправленное сообщение; buttons — кнопки сводки или None."""
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO task_messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(task["uuid"], chat_id, msg_id, task["id"], notification_kind(notification_type), buttons is not None, now)
+                 for task in tasks]
+            )
+            if buttons is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO digest_keyboards VALUES (?, ?, ?)",
+                    (chat_id, msg_id, json.dumps(buttons, ensure_ascii=False))
                 )
-            except Exception as e:
-                logger.warning(f"Не удалось очистить сообщение {msg_id}: {e}")
-        else:
-            # Сохраняем сообщения другого типа
-            messages_to_keep.append(item)
 
-    # Обновляем или удаляем из памяти
-    if action_type is None:
-        del task_message_ids[uuid]
-    else:
-        if messages_to_keep:
-            task_message_ids[uuid] = messages_to_keep
-        else:
-            del task_message_ids[uuid]
+    def is_digest(self, chat_id: int, msg_id: int):
+        return self.db.execute(
+            "SELECT 1 FROM digest_keyboards WHERE chat_id = ? AND msg_id = ?", (chat_id, msg_id)
+        ).fetchone() is not None
+
+    def take(self, uuid: str, action_type=None, skip=None):
+        """
+        Снимает с учёта кнопки задачи и возвращает нужные правки [(chat_id, msg_id, клавиатура)].
+        action_type — как у clear_task_messages; skip — (chat_id, msg_id) сообщения, которое правится отдельно.
+        """
+        edits = []
+        with self.db:
+            rows = self.db.execute(
+                "SELECT chat_id, msg_id, task_id, kind, digest FROM task_messages WHERE task_uuid = ?", (uuid,)
+            ).fetchall()
+            for chat_id, msg_id, task_id, kind, digest in rows:
+                if action_type is not None and kind != action_type:
+                    continue
+                key = (uuid, chat_id, msg_id)
+                # В сводке после «Начать» у задачи остаётся «Готово»
+                keep_done = bool(digest) and action_type == "start"
+                if keep_done:
+                    self.db.execute("UPDATE task_messages SET kind = 'done' WHERE task_uuid = ? AND chat_id = ? AND msg_id = ?", key)
+                else:
+                    self.db.execute("DELETE FROM task_messages WHERE task_uuid = ? AND chat_id = ? AND msg_id = ?", key)
+                if (chat_id, msg_id) == skip:
+                    continue
+                if not digest:
+                    edits.append((chat_id, msg_id, None))
+                    continue
+
+                row = self.db.execute(
+                    "SELECT buttons FROM digest_keyboards WHERE chat_id = ? AND msg_id = ?", (chat_id, msg_id)
+                ).fetchone()
+                if row is None:
+                    continue
+                buttons = json.loads(row[0])
+                prefixes = ("start_",) if keep_done else ("start_", "done_")
+                remaining = [b for b in buttons if not (b[2] == task_id and b[1].startswith(prefixes))]
+                if len(remaining) == len(buttons):
+                    continue
+                if remaining:
+                    self.db.execute(
+                        "UPDATE digest_keyboards SET buttons = ? WHERE chat_id = ? AND msg_id = ?",
+                        (json.dumps(remaining, ensure_ascii=False), chat_id, msg_id)
+                    )
+                else:
+                    self.db.execute("DELETE FROM digest_keyboards WHERE chat_id = ? AND msg_id = ?", (chat_id, msg_id))
+                edits.append((chat_id, msg_id, digest_markup(remaining)))
+        return edits
+
+    def tasks(self):
+        """(task_id, uuid) задач, у которых есть сообщения с кнопками."""
+        return self.db.execute("SELECT DISTINCT task_id, task_uuid FROM task_messages").fetchall()
+
+    def expire(self, before: float):
+        """Забывает сообщения, отправленные раньше before, — без правок в Telegram."""
+        with self.db:
+            self.db.execute("DELETE FROM task_messages WHERE sent_at < ?", (before,))
+            self.db.execute(
+                "DELETE FROM digest_keyboards WHERE NOT EXISTS (SELECT 1 FROM task_messages m "
+                "WHERE m.chat_id = digest_keyboards.chat_id AND m.msg_id = digest_keyboards.msg_id)"
+            )
+
+    def close(self):
+        self.db.close()
+
+
+outbox = None
+registry = None
+
+
+async def check_and_notify(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Опрашивает эндпоинт /notify/pending и ставит уведомления в исходящую очередь.
+    Повторы отсекает сервер: выданное уведомление записывается в его журнал.
+    """
+    chat_id = CHAT_ID
+    if not chat_id:
+        logger.warning("CHAT_ID не задан — уведомления отключены")
+        return
+
+    status, pending_tasks = await api_request("GET", "/notify/pending")
+    if status != 200 or not isinstance(pending_tasks, list):
+        if status is not None:
+            logger.error(f"Не удалось получить очередь уведомлений: {status}")
+        return
+
+    for task in pending_tasks:
+        outbox.notify(chat_id, task)
+
+async def clear_task_messages(bot, uuid, action_type=None, skip=None):
+    """
+    Удаляет кнопки из сообщений по задаче; правки уходят одновременно, в пределах лимитов outbox.
+    :param action_type: None → все кнопки, "start" → только кнопки "Начать", "done" → только "Готово"
+    :param skip: (chat_id, message_id) сообщения, текст которого заменяется отдельно
+    """
+    if uuid:
+        await edit_keyboards(bot, registry.take(uuid, action_type, skip))
+
+
+async def edit_keyboards(bot, edits: list):
+    """Правит клавиатуры одновременно; несколько правок одного сообщения сводятся к последней."""
+    latest = {(chat_id, msg_id): markup for chat_id, msg_id, markup in edits}
+    await asyncio.gather(*(
+        outbox.request(chat_id, bot.edit_message_reply_markup, chat_id=chat_id, message_id=msg_id, reply_markup=markup)
+        for (chat_id, msg_id), markup in latest.items()
+    ))
+
+
+async def prune_task_messages(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Снимает кнопки задач, завершённых или удалённых в обход бота, и забывает записи
+    старше REGISTRY_TTL — реестр не растёт, даже если сервер долго недоступен.
+    """
+    registry.expire(time.time() - REGISTRY_TTL)
+    entries = registry.tasks()
+    if not entries:
+        return
+    responses = await asyncio.gather(*(api_request("GET", f"/tasks/{task_id}") for task_id, _ in entries))
+    finished = [
+        uuid for (_, uuid), (status, task) in zip(entries, responses)
+        if status == 404 or (status == 200 and (task.get("uuid") != uuid or task.get("status") == "done"))
+    ]
+    await edit_keyboards(context.bot, [edit for uuid in finished for edit in registry.take(uuid)])
+    if finished:
+        logger.info(f"🧹 Сняты кнопки завершённых задач: {len(finished)}")
 
 # --- Обработчики ---
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     data = query.data
     bot = context.bot
     chat_id = query.message.chat_id
+    # Нажатие подтверждаем сразу, до запросов к ThisIsFine: иначе кнопка крутится,
+    # пока сервер отвечает, и Telegram может отклонить запоздалый ответ
+    try:
+        await query.answer()
+    except TelegramError as e:
+        logger.warning(f"Не удалось подтвердить нажатие кнопки: {e}")
+    # Сводку не переписываем: снимаем кнопки задачи, а итог присылаем ответом на неё.
+    # Обычное сообщение теряет кнопки вместе с заменой текста — при очистке его пропускаем
+    in_digest = registry.is_digest(chat_id, query.message.message_id)
+    clicked = None if in_digest else (chat_id, query.message.message_id)
+
+    async def report(text: str):
+        if in_digest:
+            await outbox.request(chat_id, bot.send_message, chat_id, text,
+                                 reply_to_message_id=query.message.message_id)
+        else:
+            await outbox.request(chat_id, query.edit_message_text, text)
 
     if data.startswith("start_"):
         task_id = int(data.split("_")[1])
-        task_res = requests.get(f"{THISISFINE_URL}/tasks/{task_id}", timeout=10)
-        if task_res.status_code == 200:
-            task = task_res.json()
-            update_task_status(task_id, "inProgress")
-            uuid = task.get("uuid")
-            if uuid:
-                await clear_task_messages(bot, chat_id, uuid, action_type="start")
-            await query.edit_message_text(f"✅ Задача «{task['title']}» переведена в «В работе».")
+        task = await get_task(task_id)
+        if task:
+            await update_task_status(task_id, "inProgress")
+            await asyncio.gather(
+                clear_task_messages(bot, task.get("uuid"), action_type="start", skip=clicked),
+                report(f"✅ Задача «{task['title']}» переведена в «В работе».")
+            )
         else:
-            await query.edit_message_text("❌ Не удалось обновить статус задачи.")
+            await report("❌ Не удалось обновить статус задачи.")
 
 
 
@@ -278,11 +580,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         hours = minutes / 60.0
 
-        task_res = requests.get(f"{THISISFINE_URL}/tasks/{task_id}", timeout=10)
+        task = await get_task(task_id)
 
-        if task_res.status_code == 200:
-            task = task_res.json()
-            postpone_task(task_id, hours=hours)
+        if task:
+            await postpone_task(task_id, hours=hours, task=task)
             if minutes < 60:
                 delay_str = f"{minutes} мин"
             elif minutes == 60:
@@ -291,39 +592,141 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 delay_str = "2 часа"
             else:
                 delay_str = f"{hours:g} ч"
-            await query.edit_message_text(f"🕗 Задача «{task['title']}» отложена на {delay_str}.")
+            await report(f"🕗 Задача «{task['title']}» отложена на {delay_str}.")
         else:
-            await query.edit_message_text("❌ Не удалось отложить задачу.")
+            await report("❌ Не удалось отложить задачу.")
 
     elif data.startswith("done_"):
         task_id = int(data.split("_")[1])
-        task_res = requests.get(f"{THISISFINE_URL}/tasks/{task_id}", timeout=10)
-        if task_res.status_code == 200:
-            task = task_res.json()
-            uuid = task.get("uuid")
-            update_task_status(task_id, "done")
-            if uuid:
-                await clear_task_messages(bot, chat_id, uuid, action_type=None)  # удаляем все кнопки
-            await query.edit_message_text(f"🎉 Задача «{task['title']}» выполнена!")
+        task = await get_task(task_id)
+        if task:
+            await update_task_status(task_id, "done")
+            await asyncio.gather(
+                clear_task_messages(bot, task.get("uuid"), action_type=None, skip=clicked),  # удаляем все кнопки
+                report(f"🎉 Задача «{task['title']}» выполнена!")
+            )
         else:
-            await query.edit_message_text("❌ Не удалось завершить задачу.")
+            await report("❌ Не удалось завершить задачу.")
 
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔔 Бот уведомлений ThisIsFine активен.")
 
+# --- Лента уведомлений (вместо опроса раз в 30 с) ---
+async def read_sse(resp):
+    """События Server-Sent Events из ответа: (id, тип, данные)."""
+    event_id, event_type, data = None, "message", []
+    async for raw in resp.content:
+        line = raw.decode("utf-8").rstrip("\r\n")
+        if not line:
+            if data:
+                yield event_id, event_type, "\n".join(data)
+            event_id, event_type, data = None, "message", []
+            continue
+        if line.startswith(":"):
+            continue  # keep-alive
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+        if field == "id":
+            event_id = value
+        elif field == "event":
+            event_type = value
+        elif field == "data":
+            data.append(value)
+
+
+async def consume_notification_stream(application):
+    """
+    Читает /notify/stream и отправляет уведомления, как только сервер их выдаёт.
+    Курсор последнего отправленного в Telegram события хранится в реестре: после
+    перезапуска нотификатора или сервера лента продолжается с него (Last-Event-ID). Без курсора
+    (первый запуск) накопленное забирается через /notify/pending — он же сообщает позицию
+    ленты. Сервер без ленты — возврат к опросу раз в 30 с.
+    """
+    cursor, delay = registry.stream_cursor(), 1
+    while True:
+        try:
+            if cursor is None:
+                async with http_session.get(f"{THISISFINE_URL}/notify/pending", timeout=API_TIMEOUT) as resp:
+                    resp.raise_for_status()
+                    pending = await resp.json()
+                    for task in pending:
+                        outbox.notify(CHAT_ID, task)
+                    cursor = resp.headers.get("X-Notify-Cursor")
+                    if cursor and not pending:
+                        registry.save_stream_cursor(cursor)  # иначе курсор сохранит отправка
+            headers = {"Accept": "text/event-stream"}
+            if cursor:
+                headers["Last-Event-ID"] = cursor
+            async with http_session.get(f"{THISISFINE_URL}/notify/stream", headers=headers, timeout=STREAM_TIMEOUT) as resp:
+                if resp.status == 404:
+                    logger.warning("Сервер не поддерживает /notify/stream — опрос /notify/pending раз в 30 с")
+                    application.job_queue.run_repeating(check_and_notify, interval=30, first=0)
+                    return
+                resp.raise_for_status()
+                logger.info("📡 Подключено к ленте уведомлений")
+                delay = 1
+                async for event_id, event_type, data in read_sse(resp):
+                    if event_type != "notification":
+                        continue
+                    outbox.notify(CHAT_ID, json.loads(data))
+                    cursor = event_id or cursor
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Лента уведомлений прервана: {e!r}; переподключение через {delay} с")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, STREAM_RECONNECT_MAX)
+
+
 # --- Запуск ---
+stream_task = None
+
+
+async def open_http_session(application):
+    global http_session, stream_task, outbox, registry
+    connector = aiohttp.TCPConnector(limit=API_POOL_SIZE, keepalive_timeout=60)
+    http_session = aiohttp.ClientSession(connector=connector)
+    outbox = TelegramOutbox(application.bot)
+    registry = MessageRegistry(REGISTRY_PATH)
+    application.job_queue.run_repeating(prune_task_messages, interval=REGISTRY_PRUNE_INTERVAL, first=10)
+    if CHAT_ID:
+        stream_task = asyncio.create_task(consume_notification_stream(application))
+    else:
+        logger.warning("CHAT_ID не задан — уведомления отключены")
+
+
+async def close_http_session(application):
+    if stream_task is not None:
+        stream_task.cancel()
+    if outbox is not None:
+        outbox.close()
+    if registry is not None:
+        registry.close()
+    if http_session is not None:
+        await http_session.close()
+
+
 def main():
     if not TELEGRAM_BOT_TOKEN:
         raise ValueError("Укажите TELEGRAM_BOT_TOKEN в переменных окружения")
 
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    # concurrent_updates: нажатие кнопки не ждёт, пока обработается предыдущее;
+    # пул соединений — чтобы правки клавиатур не стояли за отправкой уведомлений
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .connection_pool_size(TELEGRAM_POOL_SIZE)
+        .post_init(open_http_session)
+        .post_shutdown(close_http_session)
+    )
+    if TELEGRAM_API_URL:
+        api_url = TELEGRAM_API_URL.rstrip("/")
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    app = builder.build()
     app.add_handler(CommandHandler("start", start_handler))
     app.add_handler(CallbackQueryHandler(button_handler))
 
-    # Регистрируем фоновую задачу через job queue
-    job_queue = app.job_queue
-    job_queue.run_repeating(check_and_notify, interval=30, first=10)
-
     logger.info("Бот уведомлений запущен")
     app.run_polling()
 
@@ -0,0 +1,115 @@
+# sync_digest.py
+"""
+Дерево хэшей для сверки задач между узлами.
+
+Каждая задача сводится к 64-битному отпечатку (uuid, updated_at, множество логов).
+Задачи раскладываются по корзинам по префиксу uuid (шестнадцатеричные символы),
+хэш корзины — XOR отпечатков её задач, поэтому хэш любого префикса обновляется
+за O(глубина) при изменении одной задачи и не зависит от порядка вставки.
+"""
+import hashlib
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Глубина листьев: 16^4 = 65536 корзин — около двух задач на корзину при 100k задач
+LEAF_DEPTH = 4
+HEX_DIGITS = "0123456789abcdef"
+
+
+def _canonical_dt(dt: Optional[datetime], drop_microseconds: bool = False) -> str:
+    if dt is None:
+        return ""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    if drop_microseconds:
+        dt = dt.replace(microsecond=0)
+    return dt.isoformat()
+
+
+def task_digest(task_uuid: str, updated_at: Optional[datetime], logs: Iterable[Tuple[str, datetime]]) -> int:
+    """
+    Отпечаток задачи. Логи сравниваются с точностью до секунды и как множество —
+    так же, как их дедуплицирует слияние синхронизации.
+    """
+    log_keys = sorted({f"{status}@{_canonical_dt(changed_at, drop_microseconds=True)}" for status, changed_at in logs})
+    payload = "\n".join([task_uuid, _canonical_dt(updated_at), *log_keys])
+    return int.from_bytes(hashlib.blake2b(payload.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def format_hash(value: int) -> str:
+    return f"{value:016x}"
+
+
+class DigestTree:
+    """Хэши всех префиксов uuid до LEAF_DEPTH плюс отпечатки отдельных задач."""
+
+    def __init__(self, leaf_depth: int = LEAF_DEPTH):
+        self.leaf_depth = leaf_depth
+        self.digests: Dict[str, int] = {}  # uuid -> отпечаток
+        self._nodes: Dict[str, List[int]] = {}  # префикс -> [xor, число задач]
+        self._leaves: Dict[str, set] = {}  # листовой префикс -> uuid задач
+
+    def __len__(self):
+        return len(self.digests)
+
+    def _prefixes(self, task_uuid: str):
+        key = task_uuid.lower()
+        return [key[:depth] for depth in range(self.leaf_depth + 1)]
+
+    def _apply(self, task_uuid: str, digest: int, delta: int):
+        for prefix in self._prefixes(task_uuid):
+            node = self._nodes.setdefault(prefix, [0, 0])
+            node[0] ^= digest
+            node[1] += delta
+            if node[1] == 0:
+                del self._nodes[prefix]
+
+    def set(self, task_uuid: str, digest: int):
+        old = self.digests.get(task_uuid)
+        if old == digest:
+            return
+        if old is not None:
+            self._apply(task_uuid, old, -1)
+        else:
+            leaf = task_uuid.lower()[:self.leaf_depth]
+            self._leaves.setdefault(leaf, set()).add(task_uuid)
+        self.digests[task_uuid] = digest
+        self._apply(task_uuid, digest, 1)
+
+    def remove(self, task_uuid: str):
+        old = self.digests.pop(task_uuid, None)
+        if old is None:
+            return
+        self._apply(task_uuid, old, -1)
+        leaf = task_uuid.lower()[:self.leaf_depth]
+        self._leaves[leaf].discard(task_uuid)
+        if not self._leaves[leaf]:
+            del self._leaves[leaf]
+
+    def node(self, prefix: str) -> Tuple[int, int]:
+        """(хэш, число задач) префикса; пустой префикс — корень."""
+        xor, count = self._nodes.get(prefix.lower(), (0, 0))
+        return xor, count
+
+    def children(self, prefix: str) -> Dict[str, Tuple[int, int]]:
+        """Непустые дочерние корзины префикса."""
+        prefix = prefix.lower()
+        if len(prefix) >= self.leaf_depth:
+            return {}
+        result = {}
+        for digit in HEX_DIGITS:
+            child = prefix + digit
+            if child in self._nodes:
+                result[child] = tuple(self._nodes[child])
+        return result
+
+    def items(self, prefix: str) -> Dict[str, int]:
+        """Отпечатки всех задач под префиксом."""
+        prefix = prefix.lower()
+        if len(prefix) >= self.leaf_depth:
+            return {u: self.digests[u] for u in self._leaves.get(prefix[:self.leaf_depth], ()) if u.lower().startswith(prefix)}
+        return {
+            u: self.digests[u]
+            for leaf, uuids in self._leaves.items() if leaf.startswith(prefix)
+            for u in uuids
+        }
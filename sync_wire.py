@@ -0,0 +1,205 @@
+# sync_wire.py
+"""
+Формат передачи данных синхронизации.
+
+Записи { "task", "logs" } / { "tombstone" } кодируются потоково: NDJSON или MessagePack
+(JSON-массив — для старых пиров), сжимаются gzip или zstd и отдаются кусками
+фиксированного размера. Декодирование тоже потоковое: память ограничена размером куска.
+"""
+import json
+import zlib
+import logging
+
+try:
+    import msgpack
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+logger = logging.getLogger(__name__)
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+MSGPACK = "application/x-msgpack"
+
+IDENTITY = "identity"
+GZIP = "gzip"
+ZSTD = "zstd"
+
+# Размер куска при кодировании и чтении потока (байт)
+CHUNK_SIZE = 64 * 1024
+
+
+def supported_formats():
+    """Форматы этого узла в порядке предпочтения."""
+    return ([MSGPACK] if HAS_MSGPACK else []) + [NDJSON, JSON]
+
+
+def supported_encodings():
+    """Сжатия этого узла в порядке предпочтения."""
+    return ([ZSTD] if HAS_ZSTD else []) + [GZIP, IDENTITY]
+
+
+def parse_header_tokens(header):
+    """Значения заголовка Accept/Accept-Encoding без параметров; q=0 означает отказ."""
+    tokens = []
+    for part in (header or "").split(","):
+        value, *params = [p.strip() for p in part.split(";")]
+        if not value:
+            continue
+        if any(p.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for p in params):
+            continue
+        tokens.append(value.lower())
+    return tokens
+
+
+def negotiate(formats, encodings):
+    """
+    Выбирает (формат, сжатие) из предложенных другой стороной.
+    Без пересечения — JSON без сжатия, как у старых версий.
+    """
+    formats = set(formats or [])
+    encodings = set(encodings or [])
+    fmt = next((f for f in supported_formats() if f in formats), JSON)
+    encoding = next((e for e in supported_encodings() if e in encodings), IDENTITY)
+    return fmt, encoding
+
+
+def request_headers():
+    """Заголовки запроса выгрузки: что этот узел умеет принимать."""
+    formats = supported_formats()
+    return {
+        "Accept": ", ".join(f"{f};q={1 - i / 10:.1f}" for i, f in enumerate(formats)),
+        "Accept-Encoding": ", ".join(e for e in supported_encodings() if e != IDENTITY),
+    }
+
+
+def content_headers(fmt, encoding):
+    """Заголовки тела в выбранном формате."""
+    headers = {"Content-Type": fmt}
+    if encoding != IDENTITY:
+        headers["Content-Encoding"] = encoding
+    return headers
+
+
+def wire_of(content_type, content_encoding):
+    """(формат, сжатие) по заголовкам тела; ValueError — если они не поддерживаются."""
+    fmt = (content_type or JSON).split(";")[0].strip().lower()
+    encoding = (content_encoding or IDENTITY).strip().lower()
+    if fmt not in supported_formats():
+        raise ValueError(f"Неподдерживаемый формат синхронизации: {fmt}")
+    if encoding not in supported_encodings():
+        raise ValueError(f"Неподдерживаемое сжатие: {encoding}")
+    return fmt, encoding
+
+
+class _Identity:
+    def compress(self, data):
+        return data
+
+    decompress = compress
+
+    def flush(self):
+        return b""
+
+
+def _compressor(encoding):
+    if encoding == GZIP:
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return _Identity()
+
+
+def _decompressor(encoding):
+    if encoding == GZIP:
+        return zlib.decompressobj(31)
+    if encoding == ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return _Identity()
+
+
+def _records(items, fmt):
+    if fmt == MSGPACK:
+        packer = msgpack.Packer()
+        for item in items:
+            yield packer.pack(item)
+    elif fmt == NDJSON:
+        for item in items:
+            yield json.dumps(item, ensure_ascii=False).encode("utf-8") + b"\n"
+    else:
+        yield b"["
+        for i, item in enumerate(items):
+            yield (b"," if i else b"") + json.dumps(item, ensure_ascii=False).encode("utf-8")
+        yield b"]"
+
+
+def encode_items(items, fmt=JSON, encoding=IDENTITY, chunk_size=CHUNK_SIZE):
+    """Итератор байтовых кусков: записи кодируются и сжимаются по мере поступления."""
+    compressor = _compressor(encoding)
+    buffer = bytearray()
+    for record in _records(items, fmt):
+        buffer += record
+        if len(buffer) >= chunk_size:
+            out = compressor.compress(bytes(buffer))
+            buffer.clear()
+            if out:
+                yield out
+    out = compressor.compress(bytes(buffer)) + compressor.flush()
+    if out:
+        yield out
+
+
+def _decompressed(chunks, encoding):
+    decompressor = _decompressor(encoding)
+    try:
+        for chunk in chunks:
+            out = decompressor.decompress(chunk)
+            if out:
+                yield out
+        if encoding == GZIP:
+            out = decompressor.flush()
+            if out:
+                yield out
+    except (zlib.error, *((zstandard.ZstdError,) if HAS_ZSTD else ())) as e:
+        raise ValueError(f"Повреждённый поток синхронизации: {e}") from e
+
+
+def decode_items(chunks, fmt=JSON, encoding=IDENTITY):
+    """
+    Записи из потока байтовых кусков. NDJSON и MessagePack разбираются по мере чтения;
+    JSON-массив (старые пиры) читается целиком. Ошибки формата — ValueError.
+    """
+    data = _decompressed(chunks, encoding)
+    if fmt == MSGPACK:
+        unpacker = msgpack.Unpacker(raw=False)
+        for chunk in data:
+            unpacker.feed(chunk)
+            yield from unpacker
+    elif fmt == NDJSON:
+        tail = b""
+        for chunk in data:
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+        if tail.strip():
+            yield json.loads(tail)
+    else:
+        items = json.loads(b"".join(data) or b"null")
+        if not isinstance(items, list):
+            raise ValueError("Expected list of {task, logs}")
+        yield from items
+
+
+def decode_response(resp, chunk_size=CHUNK_SIZE):
+    """Записи из потокового ответа requests (stream=True); сжатие снимается здесь, а не в urllib3."""
+    fmt, encoding = wire_of(resp.headers.get("Content-Type"), resp.headers.get("Content-Encoding"))
+    return decode_items(resp.raw.stream(chunk_size, decode_content=False), fmt, encoding)
@@ -1,10 +1,35 @@
 # tag_suggester.py
 import re
+import os
+import sys
+import json
 import math
-from collections import defaultdict, Counter
+import mmap
+import zlib
+import heapq
+import queue
+import struct
+import time
+import logging
+import threading
+from array import array
+from pathlib import Path
+from collections import defaultdict, Counter, OrderedDict
+from contextlib import nullcontext
 from typing import List, Dict, Set, Tuple
 import pymorphy3
 
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # векторизованный движок необязателен — без него работает чистый Python
+    np = None
+    sparse = None
+
+HAS_NUMPY = np is not None
+
+logger = logging.getLogger(__name__)
+
 # === 1. Генерация обучающего набора (реальные данные можно заменить позже) ===
 def generate_sample_tasks() -> List[Dict]:
     return [
@@ -160,6 +185,67 @@ RUSSIAN_STOPWORDS = {
 
 _morph = pymorphy3.MorphAnalyzer()
 
+
+class LemmaCache:
+    """Ограниченный LRU-кэш слово -> лемма поверх pymorphy3 с опциональным сохранением на диск."""
+
+    def __init__(self, maxsize: int = 50000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lemma(self, word: str) -> str:
+        with self._lock:
+            cached = self._data.get(word)
+            if cached is not None:
+                self._data.move_to_end(word)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        normal_form = _morph.parse(word)[0].normal_form
+
+        with self._lock:
+            self._data[word] = normal_form
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return normal_form
+
+    def stats(self) -> Dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+    def load(self, path: Path) -> int:
+        """Загружает кэш из JSON-файла; возвращает число загруженных слов."""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if not isinstance(items, dict):
+            return 0
+        with self._lock:
+            for word, normal_form in list(items.items())[-self.maxsize:]:
+                self._data[word] = normal_form
+                self._data.move_to_end(word)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return len(self._data)
+
+    def save(self, path: Path):
+        """Атомарно сохраняет кэш в JSON (в порядке LRU, самые свежие — в конце)."""
+        with self._lock:
+            items = dict(self._data)
+        tmp_path = Path(f"{path}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+lemma_cache = LemmaCache()
+
+
 def preprocess_text(text: str) -> List[str]:
     """Возвращает список лемм (не строку!), без стоп-слов."""
     text = re.sub(r'[^а-я\s]', ' ', text.lower())
@@ -170,8 +256,7 @@ def preprocess_text(text: str) -> List[str]:
             continue
         if word[-2:] in ["сь", "ся"]:
             word = word[:-2]
-        parsed = _morph.parse(word)[0]
-        lemmas.append(parsed.normal_form)
+        lemmas.append(lemma_cache.lemma(word))
 
     return lemmas
 
@@ -182,95 +267,243 @@ def extract_ngrams(tokens: List[str], n: int) -> List[str]:
     return [' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1)]
 
 
+# Сколько ближайших соседей голосует за теги
+TOP_NEIGHBORS = 5
+
+# Движки подсчёта схожести: "numpy" (CSR-матрица, scipy.sparse) или "python" (постинги)
+BACKENDS = ("auto", "python", "numpy")
+
+# Схожесть квантуется до 1e-12, чтобы оба движка давали одинаковый порядок при равенствах
+_SIM_SCALE = 1e12
+
+
+def _resolve_backend(backend: str) -> str:
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный движок: {backend}")
+    if backend == "auto":
+        return "numpy" if HAS_NUMPY else "python"
+    if backend == "numpy" and not HAS_NUMPY:
+        return "python"
+    return backend
+
+# === Бинарный формат сохранённой модели ===
+# [magic 8 байт][длина заголовка uint32 LE][JSON-заголовок][секции, выровненные по 8 байт]
+MODEL_MAGIC = b"TIFTAGS\x01"
+MODEL_VERSION = 1
+_ALIGN = 8
+
+
+def sample_tasks_digest() -> int:
+    """Контрольная сумма встроенного обучающего набора — модель устаревает при его изменении."""
+    payload = json.dumps(generate_sample_tasks(), ensure_ascii=False, sort_keys=True)
+    return zlib.crc32(payload.encode('utf-8'))
+
+
 class TagSuggester:
-    def __init__(self, tasks: List[Dict] = None):
-        self.tasks = tasks + generate_sample_tasks()
+    def __init__(self, tasks: List[Dict] = None, backend: str = "auto"):
+        self.tasks = (tasks or []) + generate_sample_tasks()
+        self.backend = _resolve_backend(backend)
+        self.watermark: Dict = {}  # состояние БД, на момент которого сохранена модель
+        self._reset_index()
+        self._fit()
+
+    def _reset_index(self):
         self.all_tags: Set[str] = set()
         self.vocab: Dict[str, int] = {}  # term -> index
-        self.idf: Dict[str, float] = {}  # term -> IDF
-        self.task_tfidf: List[Dict[int, float]]  # список разрежённых векторов (индекс -> вес)
-        self._fit()
+        self.df = array('q')  # index -> число документов с термином
+        # Документы в формате CSR: нормированные TF (не зависят от N)
+        self.doc_indptr = array('q', [0])
+        self.doc_indices = array('q')
+        self.doc_tf = array('d')
+        # Постинги: базовый сегмент из файла (CSC) + документы, добавленные в процессе.
+        # После load() базовый сегмент и нормы — memoryview поверх отображённого файла
+        self._mapping = None
+        self._base_term_indptr = array('q', [0])
+        self._base_term_docs = array('q')
+        self._base_term_tf = array('d')
+        self.postings: Dict[int, List[Tuple[int, float]]] = defaultdict(list)  # индекс термина -> [(документ, tf)]
+        self.doc_norms = array('d')  # L2-нормы TF-IDF векторов документов
+        self._idf_by_idx = array('d')
+        self._matrix = None  # CSR-матрица с L2-нормированными строками (только для движка numpy)
+        self._dirty = True  # IDF и нормы устарели после добавления документов
 
     def _fit(self):
-        # Собираем все теги
-        self.all_tags.clear()
+        """Полное переобучение: заново индексирует все документы из self.tasks."""
+        self._reset_index()
         for task in self.tasks:
-            self.all_tags.update(task["tags"])
+            self._index_document(task)
+        self._refresh()
 
-        # Предобрабатываем все тексты
-        processed_docs = [preprocess_text(task["text"]) for task in self.tasks]
+    def _index_document(self, task: Dict):
+        """Лемматизирует один документ и обновляет словарь, DF и постинги на месте."""
+        self.all_tags.update(task["tags"])
 
-        # Генерируем все униграммы и биграммы
-        all_ngrams = []
-        for tokens in processed_docs:
-            grams = extract_ngrams(tokens, 1) + extract_ngrams(tokens, 2)
-            all_ngrams.append(grams)
+        tokens = preprocess_text(task["text"])
+        grams = extract_ngrams(tokens, 1) + extract_ngrams(tokens, 2)
 
-        # Строим словарь
-        term_freq_global = defaultdict(int)
-        for grams in all_ngrams:
-            for term in set(grams):  # уникальные термины в документе
-                term_freq_global[term] += 1
+        # Словарь растёт в порядке первого появления термина — как и при полном переобучении
+        for term in set(grams):
+            idx = self.vocab.get(term)
+            if idx is None:
+                idx = self.vocab[term] = len(self.vocab)
+                self.df.append(0)
+            self.df[idx] += 1
 
+        doc_id = len(self.doc_indptr) - 1
+        tf = Counter(grams)
+        for term, freq in tf.items():
+            idx = self.vocab[term]
+            weight = freq / len(grams)
+            self.doc_indices.append(idx)
+            self.doc_tf.append(weight)
+            self.postings[idx].append((doc_id, weight))
+        self.doc_indptr.append(len(self.doc_indices))
+
+    def _refresh(self):
+        """Лениво пересчитывает IDF и нормы документов (без повторной лемматизации)."""
+        if not self._dirty:
+            return
+
+        self._matrix = None
+        if self.backend == "numpy":
+            self._refresh_numpy()
+        else:
+            self._refresh_python()
+        self._dirty = False
+
+    def _refresh_python(self):
         N = len(self.tasks)
-        self.vocab = {term: idx for idx, term in enumerate(term_freq_global.keys())}
-        self.idf = {term: math.log(N / term_freq_global[term]) for term in term_freq_global}
-
-        # Считаем TF-IDF для каждой задачи
-        self.task_tfidf = []
-        for grams in all_ngrams:
-            tf = Counter(grams)
-            vec = {}
-            for term, freq in tf.items():
-                if term in self.vocab:
-                    tf_norm = freq / len(grams) if grams else 0
-                    weight = tf_norm * self.idf[term]
-                    vec[self.vocab[term]] = weight
-            self.task_tfidf.append(vec)
-
-    def _cosine_similarity(self, vec_a: Dict[int, float], vec_b: Dict[int, float]) -> float:
-        # Скалярное произведение
-        dot = sum(vec_a[k] * vec_b.get(k, 0.0) for k in vec_a)
-        norm_a = math.sqrt(sum(v * v for v in vec_a.values()))
-        norm_b = math.sqrt(sum(v * v for v in vec_b.values()))
-        if norm_a == 0 or norm_b == 0:
-            return 0.0
-        return dot / (norm_a * norm_b)
+        idf_by_idx = array('d', (math.log(N / df) for df in self.df))
+        self._idf_by_idx = idf_by_idx
 
-    def suggest_tags(self, query: str, top_k_tags: int = 3) -> List[str]:
-        if not query.strip():
-            return []
+        indptr, indices, tf = self.doc_indptr, self.doc_indices, self.doc_tf
+        self.doc_norms = array('d', (
+            math.sqrt(sum((tf[j] * idf_by_idx[indices[j]]) ** 2 for j in range(indptr[d], indptr[d + 1])))
+            for d in range(len(indptr) - 1)
+        ))
 
-        # Обрабатываем запрос
+    def _refresh_numpy(self):
+        # Копии, а не np.frombuffer: array.array нельзя расширять, пока на него смотрит numpy
+        N = len(self.tasks)
+        df = np.array(self.df, dtype=np.int64)
+        idf = np.log(N / df) if len(df) else np.zeros(0)
+        self._idf_by_idx = array('d', idf.tobytes())
+
+        indptr = np.array(self.doc_indptr, dtype=np.int64)
+        indices = np.array(self.doc_indices, dtype=np.int64)
+        weights = np.array(self.doc_tf, dtype=np.float64) * idf[indices]
+        n_docs = len(indptr) - 1
+        rows = np.repeat(np.arange(n_docs), np.diff(indptr))
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=n_docs))
+        self.doc_norms = array('d', norms.tobytes())
+
+        row_norms = norms[rows]
+        data = np.divide(weights, row_norms, out=np.zeros_like(weights), where=row_norms > 0)
+        self._matrix = sparse.csr_matrix((data, indices, indptr), shape=(n_docs, len(self.vocab)))
+
+    def _ensure_matrix(self):
+        """Матрица не сохраняется в файл — строится из загруженных массивов при первом запросе."""
+        self._refresh()
+        if self._matrix is None:
+            self._refresh_numpy()
+
+    def _term_postings(self, idx: int):
+        """Все (документ, tf) для термина: сначала из загруженного сегмента, затем добавленные."""
+        if idx + 1 < len(self._base_term_indptr):
+            start, end = self._base_term_indptr[idx], self._base_term_indptr[idx + 1]
+            yield from zip(self._base_term_docs[start:end], self._base_term_tf[start:end])
+        yield from self.postings.get(idx, ())
+
+    def _query_vector(self, query: str) -> Dict[int, float]:
+        """TF-IDF вектор запроса (индекс -> вес); пустой, если нет известных терминов."""
         tokens = preprocess_text(query)
         if not tokens:
-            return []
+            return {}
 
         grams = extract_ngrams(tokens, 1) + extract_ngrams(tokens, 2)
         tf = Counter(grams)
         query_vec = {}
         for term, freq in tf.items():
-            if term in self.vocab:
+            idx = self.vocab.get(term)
+            if idx is not None:
                 tf_norm = freq / len(grams)
-                weight = tf_norm * self.idf[term]
-                query_vec[self.vocab[term]] = weight
-
-        if not query_vec:
+                weight = tf_norm * self._idf_by_idx[idx]
+                query_vec[idx] = weight
+        return query_vec
+
+    def _nearest(self, query_vec: Dict[int, float], k: int = TOP_NEIGHBORS) -> List[Tuple[float, int]]:
+        """k ближайших документов по косинусу (схожесть > 0), по убыванию (схожесть, документ)."""
+        return self._nearest_batch([query_vec], k)[0]
+
+    def _nearest_batch(self, query_vecs: List[Dict[int, float]], k: int = TOP_NEIGHBORS) -> List[List[Tuple[float, int]]]:
+        if self.backend == "numpy":
+            return self._nearest_numpy(query_vecs, k)
+        return [self._nearest_python(query_vec, k) for query_vec in query_vecs]
+
+    def _nearest_python(self, query_vec: Dict[int, float], k: int) -> List[Tuple[float, int]]:
+        """Поиск через инвертированный индекс."""
+        query_norm = math.sqrt(sum(w * w for w in query_vec.values()))
+        if query_norm == 0:
             return []
 
-        # Считаем схожесть со всеми задачами
-        similarities = []
-        for idx, task_vec in enumerate(self.task_tfidf):
-            sim = self._cosine_similarity(query_vec, task_vec)
-            similarities.append((sim, idx))
-
-        # Берём 5 ближайших (по убыванию схожести)
-        similarities.sort(reverse=True)
-        top_neighbors = similarities[:5]
-
+        # Скалярные произведения только с документами, у которых есть общий термин
+        dots = defaultdict(float)
+        for idx, q_weight in query_vec.items():
+            idf = self._idf_by_idx[idx]
+            if idf == 0:
+                continue
+            for doc_id, tf in self._term_postings(idx):
+                dots[doc_id] += q_weight * tf * idf
+
+        doc_norms = self.doc_norms
+        scored = []
+        for doc_id, dot in dots.items():
+            if doc_norms[doc_id] > 0:
+                sim = math.floor(dot / (query_norm * doc_norms[doc_id]) * _SIM_SCALE + 0.5) / _SIM_SCALE
+                if sim > 0:
+                    scored.append((sim, doc_id))
+        return heapq.nlargest(k, scored)
+
+    def _nearest_numpy(self, query_vecs: List[Dict[int, float]], k: int) -> List[List[Tuple[float, int]]]:
+        """Все запросы пачки оцениваются одним разрежённым произведением матриц."""
+        self._ensure_matrix()
+
+        terms, columns, weights = [], [], []
+        for col, query_vec in enumerate(query_vecs):
+            query_norm = math.sqrt(sum(w * w for w in query_vec.values()))
+            if query_norm == 0:
+                continue
+            for idx, q_weight in query_vec.items():
+                terms.append(idx)
+                columns.append(col)
+                weights.append(q_weight / query_norm)
+
+        queries = sparse.csc_matrix(
+            (weights, (terms, columns)),
+            shape=(self._matrix.shape[1], len(query_vecs))
+        )
+        scores = (self._matrix @ queries).tocsc()
+
+        results = []
+        for col in range(len(query_vecs)):
+            start, end = scores.indptr[col], scores.indptr[col + 1]
+            docs = scores.indices[start:end]
+            sims = np.floor(scores.data[start:end] * _SIM_SCALE + 0.5) / _SIM_SCALE
+            positive = sims > 0
+            docs, sims = docs[positive], sims[positive]
+            if len(sims) > k:
+                kth = np.partition(sims, -k)[-k]
+                keep = sims >= kth
+                docs, sims = docs[keep], sims[keep]
+            # По убыванию схожести, при равенстве — по убыванию номера документа (как heapq.nlargest)
+            order = np.lexsort((docs, sims))[::-1][:k]
+            results.append([(float(sims[i]), int(docs[i])) for i in order])
+        return results
+
+    def _vote_tags(self, neighbors: List[Tuple[float, int]], top_k_tags: int) -> List[str]:
         # Собираем теги с весами
         tag_scores = defaultdict(float)
-        for sim, idx in top_neighbors:
+        for sim, idx in neighbors:
             if sim <= 0:
                 continue
             weight = sim  # можно оставить как есть (косинус уже нормирован)
@@ -281,9 +514,336 @@ class TagSuggester:
         sorted_tags = sorted(tag_scores.items(), key=lambda x: x[1], reverse=True)
         return [tag for tag, _ in sorted_tags[:top_k_tags]]
 
+    def suggest_tags(self, query: str, top_k_tags: int = 3) -> List[str]:
+        if not query.strip():
+            return []
+
+        self._refresh()
+
+        query_vec = self._query_vector(query)
+        if not query_vec:
+            return []
+
+        return self._vote_tags(self._nearest(query_vec), top_k_tags)
+
+    def suggest_tags_batch(self, queries: List[str], top_k_tags: int = 3) -> List[List[str]]:
+        """Подбор тегов для нескольких текстов за один проход; порядок ответов совпадает с запросами."""
+        self._refresh()
+
+        query_vecs = [self._query_vector(q) if q.strip() else {} for q in queries]
+        active = [i for i, vec in enumerate(query_vecs) if vec]
+        neighbors = self._nearest_batch([query_vecs[i] for i in active]) if active else []
+
+        results: List[List[str]] = [[] for _ in queries]
+        for i, top in zip(active, neighbors):
+            results[i] = self._vote_tags(top, top_k_tags)
+        return results
+
     def add_task(self, text: str, tags: List[str]):
-        self.tasks.append({"text": text, "tags": tags})
-        self._fit()
+        """Добавляет один документ: стоимость — обработка только этого документа."""
+        task = {"text": text, "tags": tags}
+        self.tasks.append(task)
+        self._index_document(task)
+        self._dirty = True
+
+    # === Сохранение и загрузка ===
+    def _merged_postings(self) -> Tuple[array, array, array]:
+        """Сливает базовый сегмент и добавленные постинги в единый CSC."""
+        term_indptr, term_docs, term_tf = array('q', [0]), array('q'), array('d')
+        for idx in range(len(self.vocab)):
+            for doc_id, tf in self._term_postings(idx):
+                term_docs.append(doc_id)
+                term_tf.append(tf)
+            term_indptr.append(len(term_docs))
+        return term_indptr, term_docs, term_tf
+
+    def _release_mapping(self, lock=None):
+        """
+        Копирует отображённые секции в память и закрывает отображение файла.
+        Копия снимается без lock (секции только читаются), под lock — лишь подмена.
+        """
+        if self._mapping is None:
+            return
+        term_indptr = array('q', self._base_term_indptr)
+        term_docs = array('q', self._base_term_docs)
+        term_tf = array('d', self._base_term_tf)
+        doc_norms = self.doc_norms
+        if isinstance(doc_norms, memoryview):
+            doc_norms = array('d', doc_norms)
+        with lock or nullcontext():
+            self._base_term_indptr, self._base_term_docs, self._base_term_tf = term_indptr, term_docs, term_tf
+            if isinstance(self.doc_norms, memoryview):
+                self.doc_norms = doc_norms
+            view, mm = self._mapping
+            self._mapping = None
+            view.release()
+            mm.close()
+
+    def save(self, path: Path, watermark: Dict = None, lock=None):
+        """
+        Атомарно сохраняет обученную модель в компактный бинарный файл.
+        lock — блокировка, под которой модель читают другие потоки: слияние постингов
+        и копирование отображения идут вне её. Вызывать из единственного потока,
+        который меняет модель (add_task), иначе — под этой блокировкой целиком.
+        """
+        with lock or nullcontext():
+            self._refresh()
+        if watermark is not None:
+            self.watermark = watermark
+        # Замещаемый файл может быть отображён этим же экземпляром (на Windows os.replace иначе упадёт)
+        self._release_mapping(lock)
+
+        term_indptr, term_docs, term_tf = self._merged_postings()
+        terms = [None] * len(self.vocab)
+        for term, idx in self.vocab.items():
+            terms[idx] = term
+
+        sections = [
+            ("doc_indptr", self.doc_indptr),
+            ("doc_indices", self.doc_indices),
+            ("doc_tf", self.doc_tf),
+            ("df", self.df),
+            ("doc_norms", self.doc_norms),
+            ("term_indptr", term_indptr),
+            ("term_docs", term_docs),
+            ("term_tf", term_tf),
+            ("vocab", '\n'.join(terms).encode('utf-8')),
+            ("docs", json.dumps([[t["text"], t["tags"]] for t in self.tasks], ensure_ascii=False).encode('utf-8')),
+        ]
+
+        layout = {}
+        offset = 0
+        for name, data in sections:
+            size = len(data) * data.itemsize if isinstance(data, array) else len(data)
+            layout[name] = [offset, size, data.typecode if isinstance(data, array) else 'B']
+            offset += size + (-size % _ALIGN)
+
+        header = json.dumps({
+            "version": MODEL_VERSION,
+            "byteorder": sys.byteorder,
+            "samples": sample_tasks_digest(),
+            "watermark": self.watermark,
+            "sections": layout,
+        }).encode('utf-8')
+        prefix = MODEL_MAGIC + struct.pack('<I', len(header)) + header
+        prefix += b'\0' * (-len(prefix) % _ALIGN)
+
+        tmp_path = Path(f"{path}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(prefix)
+            for name, data in sections:
+                raw = data.tobytes() if isinstance(data, array) else data
+                f.write(raw)
+                f.write(b'\0' * (-len(raw) % _ALIGN))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path, backend: str = "auto") -> "TagSuggester":
+        """
+        Загружает сохранённую модель без лемматизации. ValueError — файл несовместим.
+        Постинги и нормы документов не копируются: это memoryview поверх отображения файла,
+        страницы подгружаются ОС по мере обращения. Растущие при add_task массивы
+        (CSR документов, DF), словарь и метки копируются в память.
+        """
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            view = memoryview(mm)
+            try:
+                if bytes(view[:len(MODEL_MAGIC)]) != MODEL_MAGIC:
+                    raise ValueError("неизвестный формат файла модели")
+                (header_len,) = struct.unpack_from('<I', mm, len(MODEL_MAGIC))
+                header_start = len(MODEL_MAGIC) + 4
+                header = json.loads(bytes(view[header_start:header_start + header_len]))
+                if header.get("version") != MODEL_VERSION or header.get("byteorder") != sys.byteorder:
+                    raise ValueError("несовместимая версия модели")
+                if header.get("samples") != sample_tasks_digest():
+                    raise ValueError("обучающий набор изменился")
+
+                base = header_start + header_len
+                base += -base % _ALIGN
+
+                def section(name):
+                    offset, size, typecode = header["sections"][name]
+                    chunk = view[base + offset:base + offset + size]
+                    if typecode == 'B':
+                        return bytes(chunk)
+                    data = array(typecode)
+                    data.frombytes(chunk)
+                    return data
+
+                def mapped(name):
+                    offset, size, typecode = header["sections"][name]
+                    return (base + offset, base + offset + size, typecode)
+
+                suggester = cls.__new__(cls)
+                suggester._reset_index()
+                suggester.backend = _resolve_backend(backend)
+                suggester.watermark = header.get("watermark") or {}
+                suggester.doc_indptr = section("doc_indptr")
+                suggester.doc_indices = section("doc_indices")
+                suggester.doc_tf = section("doc_tf")
+                suggester.df = section("df")
+                spans = {name: mapped(name) for name in ("doc_norms", "term_indptr", "term_docs", "term_tf")}
+                vocab_raw = section("vocab").decode('utf-8')
+                terms = vocab_raw.split('\n') if vocab_raw else []
+                docs = json.loads(section("docs"))
+            finally:
+                view.release()
+        except BaseException:
+            mm.close()
+            raise
+
+        # Отображение живёт, пока на него смотрят секции; закрывается в _release_mapping
+        view = memoryview(mm)
+        suggester._mapping = (view, mm)
+        mapped_sections = {name: view[start:end].cast(typecode) for name, (start, end, typecode) in spans.items()}
+        suggester.doc_norms = mapped_sections["doc_norms"]
+        suggester._base_term_indptr = mapped_sections["term_indptr"]
+        suggester._base_term_docs = mapped_sections["term_docs"]
+        suggester._base_term_tf = mapped_sections["term_tf"]
+
+        suggester.vocab = dict(zip(terms, range(len(terms))))
+        suggester.tasks = [{"text": text, "tags": tags} for text, tags in docs]
+        for _, tags in docs:
+            suggester.all_tags.update(tags)
+
+        if len(suggester.doc_indptr) - 1 != len(suggester.tasks) or len(suggester.df) != len(terms):
+            raise ValueError("повреждённый файл модели")
+
+        N = len(suggester.tasks)
+        suggester._idf_by_idx = array('d', (math.log(N / df) for df in suggester.df))
+        suggester._dirty = False
+        return suggester
+
+class SuggesterUpdater:
+    """
+    Единственный фоновый поток дообучения автоподбора тегов.
+    Обновления (text, tags) копятся в ограниченной очереди и применяются пачкой
+    под одним захватом блокировки — всплеск синхронизации даёт одно переобучение.
+    Дообученная модель сохраняется через on_persist(watermark), когда очередь затихла,
+    но не чаще раза в persist_interval секунд. watermark — отметка get_watermark(),
+    снятая до применения последней пачки: всё закоммиченное до неё уже в модели.
+    """
+
+    def __init__(self, get_suggester, lock: threading.Lock, maxsize: int = 10000,
+                 coalesce_seconds: float = 0.5, max_batch: int = 5000,
+                 on_persist=None, persist_interval: float = 60.0, get_watermark=None):
+        self._get_suggester = get_suggester
+        self._lock = lock
+        self._on_persist = on_persist
+        self._get_watermark = get_watermark
+        self._watermark = None  # отметка до последней применённой пачки
+        self.persist_interval = persist_interval
+        self._unsaved = False  # есть применённые, но не сохранённые обновления
+        self._persisted_at = time.monotonic()
+        self.persisted = 0
+        self._queue: "queue.Queue[Tuple[float, str, Tuple[str, ...]]]" = queue.Queue(maxsize=maxsize)
+        self.coalesce_seconds = coalesce_seconds
+        self.max_batch = max_batch
+        self.enqueued = 0
+        self.applied = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.batches = 0
+        self.last_batch_size = 0
+        self.last_batch_seconds = 0.0
+        self.last_lag_seconds = 0.0
+        self._thread = threading.Thread(target=self._run, name="tag-suggester-updater", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, text: str, tags: List[str]) -> bool:
+        """Ставит обновление в очередь, не блокируя запрос. False — очередь переполнена."""
+        if not tags:
+            return False
+        try:
+            self._queue.put_nowait((time.monotonic(), text, tuple(tags)))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Очередь дообучения автоподбора переполнена — обновление отброшено")
+            return False
+        self.enqueued += 1
+        return True
+
+    def _persist_timeout(self):
+        """Сколько ждать новых обновлений перед сохранением модели; None — сохранять нечего."""
+        if self._on_persist is None or not self._unsaved:
+            return None
+        return max(0.0, self._persisted_at + self.persist_interval - time.monotonic())
+
+    def _persist(self):
+        self._unsaved = False
+        self._persisted_at = time.monotonic()
+        try:
+            self._on_persist(self._watermark)
+            self.persisted += 1
+        except Exception:
+            logger.exception("Ошибка сохранения модели автоподбора тегов")
+
+    def _collect(self) -> List[Tuple[float, str, Tuple[str, ...]]]:
+        try:
+            batch = [self._queue.get(timeout=self._persist_timeout())]
+        except queue.Empty:
+            return []
+        # Ждём немного, чтобы собрать весь всплеск в одну пачку
+        deadline = time.monotonic() + self.coalesce_seconds
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                self._persist()
+                continue
+            started = time.monotonic()
+            # Одинаковые (text, tags) в пределах пачки применяются один раз
+            unique = list(dict.fromkeys((text, tags) for _, text, tags in batch))
+            try:
+                suggester = self._get_suggester()
+                if suggester is not None:
+                    # Отметка до применения: закоммиченное позже её дообучится заново после рестарта
+                    watermark = self._get_watermark() if self._get_watermark else None
+                    with self._lock:
+                        for text, tags in unique:
+                            suggester.add_task(text, list(tags))
+                    self._watermark = watermark
+                    self._unsaved = True
+            except Exception:
+                logger.exception("Ошибка дообучения автоподбора тегов")
+            finished = time.monotonic()
+            self.applied += len(unique)
+            self.coalesced += len(batch) - len(unique)
+            self.batches += 1
+            self.last_batch_size = len(batch)
+            self.last_batch_seconds = finished - started
+            self.last_lag_seconds = finished - min(enqueued_at for enqueued_at, _, _ in batch)
+
+    def stats(self) -> Dict:
+        with self._queue.mutex:
+            oldest = self._queue.queue[0][0] if self._queue.queue else None
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_maxsize": self._queue.maxsize,
+            "lag_seconds": round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+            "enqueued": self.enqueued,
+            "applied": self.applied,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "last_batch_size": self.last_batch_size,
+            "last_batch_seconds": round(self.last_batch_seconds, 3),
+            "last_lag_seconds": round(self.last_lag_seconds, 3),
+            "persisted": self.persisted,
+        }
+
 
 # === 4. Демонстрация работы ===
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app as appmod  # noqa: E402
+from models import db  # noqa: E402
+
+SYNC_TOKEN = "test-token"
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    """Приложение на временной БД; фоновые потоки не запускаются, модель тегов — во временном каталоге."""
+    root = tmp_path_factory.mktemp("server")
+    env_path = root / "test.env"
+    env_path.write_text(f"DATABASE_URL=sqlite:///{(root / 'test.sqlite').as_posix()}\nSYNC_TOKEN={SYNC_TOKEN}\n")
+    flask_app = appmod.create_app(env_path)
+    appmod.INSTANCE_DIR = root
+    appmod.setup_routes(flask_app, env_path, background=False)
+    return flask_app
+
+
+@pytest.fixture(params=[True, False], ids=["returning", "no-returning"])
+def app(server, request, monkeypatch):
+    """
+    Пустая БД перед каждым тестом. Теги остаются: сервер кэширует известные имена.
+    Каждый тест идёт и с RETURNING, и с запасным путём для SQLite старше 3.35.
+    """
+    monkeypatch.setattr(appmod, "SQLITE_RETURNING", request.param)
+    with server.app_context():
+        for table in reversed(db.metadata.sorted_tables):
+            if table.name != "tags":
+                db.session.execute(table.delete())
+        db.session.commit()
+    return server
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,23 @@
+"""POST /suggest-tags/batch: разбор и проверка запроса."""
+import pytest
+
+
+def test_batch_returns_suggestions_in_order(client):
+    response = client.post("/suggest-tags/batch", json=[{"title": "купить молоко"}, {"title": None, "note": ""}, {}])
+    assert response.status_code == 200
+    suggested = response.get_json()["suggested_tags"]
+    assert len(suggested) == 3
+    assert suggested[1:] == [[], []]
+
+
+@pytest.mark.parametrize("payload", [
+    {"title": "не список"},
+    [{"title": 42}],
+    [{"title": "ок", "note": ["список"]}],
+    ["строка"],
+    [None],
+])
+def test_batch_rejects_malformed_items(client, payload):
+    response = client.post("/suggest-tags/batch", json=payload)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
@@ -0,0 +1,165 @@
+"""Слияние входящей синхронизации (POST /sync/tasks → merge_sync_data)."""
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from models import db, Task, Tag, TaskStatusLog, TaskTombstone
+from conftest import SYNC_TOKEN
+
+T0 = datetime(2030, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def iso(dt):
+    return dt.isoformat().replace("+00:00", "Z")
+
+
+def task_item(task_uuid=None, updated_at=T0, title="задача", tags=(), logs=(), **extra):
+    task = {
+        "uuid": task_uuid or str(uuid.uuid4()),
+        "title": title,
+        "status": "planned",
+        "deadlines": {"due_at": iso(T0 + timedelta(days=1))},
+        "updated_at": iso(updated_at),
+        "tags": list(tags),
+    }
+    task.update(extra)
+    return {"task": task, "logs": list(logs)}
+
+
+def tombstone_item(task_uuid, deleted_at):
+    return {"tombstone": {"uuid": task_uuid, "deleted_at": iso(deleted_at)}}
+
+
+def push(client, items):
+    response = client.post("/sync/tasks", json=items, headers={"X-Sync-Token": SYNC_TOKEN})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response.get_json()
+
+
+def stored(app, task_uuid):
+    with app.app_context():
+        task = Task.query.filter_by(uuid=task_uuid).one_or_none()
+        return task and (task.title, sorted(tag.name for tag in task.tags))
+
+
+def test_new_task_is_inserted(app, client):
+    item = task_item(title="новая", tags=["Дом"])
+    counts = push(client, [item])
+    assert (counts["created"], counts["updated"], counts["skipped"]) == (1, 0, 0)
+    assert stored(app, item["task"]["uuid"]) == ("новая", ["дом"])
+
+
+@pytest.mark.parametrize("delta, title, updated", [
+    (timedelta(minutes=1), "новее", 1),
+    (timedelta(0), "исходная", 0),
+    (-timedelta(minutes=1), "исходная", 0),
+])
+def test_update_decided_by_updated_at(app, client, delta, title, updated):
+    task_uuid = str(uuid.uuid4())
+    push(client, [task_item(task_uuid, title="исходная")])
+    counts = push(client, [task_item(task_uuid, updated_at=T0 + delta, title=title)])
+    assert (counts["created"], counts["updated"], counts["skipped"]) == (0, updated, 1 - updated)
+    assert stored(app, task_uuid)[0] == title
+
+
+def test_latest_version_in_batch_wins(app, client):
+    task_uuid = str(uuid.uuid4())
+    counts = push(client, [
+        task_item(task_uuid, updated_at=T0 + timedelta(minutes=2), title="поздняя"),
+        task_item(task_uuid, updated_at=T0, title="ранняя"),
+    ])
+    assert counts["created"] == 1
+    assert stored(app, task_uuid)[0] == "поздняя"
+
+
+def test_newer_tombstone_deletes_task(app, client):
+    task_uuid = str(uuid.uuid4())
+    push(client, [task_item(task_uuid)])
+    counts = push(client, [tombstone_item(task_uuid, T0 + timedelta(minutes=1))])
+    assert counts["tombstones"] == 1
+    assert stored(app, task_uuid) is None
+    with app.app_context():
+        assert db.session.get(TaskTombstone, task_uuid) is not None
+
+
+def test_older_tombstone_keeps_task(app, client):
+    task_uuid = str(uuid.uuid4())
+    push(client, [task_item(task_uuid, title="жива")])
+    counts = push(client, [tombstone_item(task_uuid, T0 - timedelta(minutes=1))])
+    assert counts["tombstones"] == 0
+    assert stored(app, task_uuid)[0] == "жива"
+
+
+def test_tombstone_blocks_older_task_in_same_batch(app, client):
+    task_uuid = str(uuid.uuid4())
+    counts = push(client, [
+        task_item(task_uuid),
+        tombstone_item(task_uuid, T0 + timedelta(minutes=1)),
+    ])
+    assert (counts["created"], counts["skipped"]) == (0, 1)
+    assert stored(app, task_uuid) is None
+
+
+def test_task_newer_than_local_tombstone_is_restored(app, client):
+    task_uuid = str(uuid.uuid4())
+    push(client, [tombstone_item(task_uuid, T0)])
+    counts = push(client, [task_item(task_uuid, updated_at=T0 + timedelta(minutes=1), title="вернулась")])
+    assert counts["created"] == 1
+    assert stored(app, task_uuid)[0] == "вернулась"
+
+
+def test_tags_created_during_merge(app, client):
+    name = f"тег-{uuid.uuid4().hex[:8]}"
+    first, second = task_item(tags=[name, " " + name.upper()]), task_item(tags=[name, "ещё-" + name])
+    push(client, [first, second])
+    with app.app_context():
+        assert Tag.query.filter(Tag.name.in_([name, "ещё-" + name])).count() == 2
+    assert stored(app, first["task"]["uuid"])[1] == [name]
+    assert stored(app, second["task"]["uuid"])[1] == sorted([name, "ещё-" + name])
+
+
+def test_update_replaces_tags(app, client):
+    task_uuid = str(uuid.uuid4())
+    push(client, [task_item(task_uuid, tags=["старый"])])
+    push(client, [task_item(task_uuid, updated_at=T0 + timedelta(minutes=1), tags=["новый"])])
+    assert stored(app, task_uuid)[1] == ["новый"]
+
+
+def test_logs_are_deduplicated(app, client):
+    task_uuid = str(uuid.uuid4())
+    log = {"status": "planned", "changed_at": iso(T0)}
+    # Та же запись с другими микросекундами — дубликат: ключ сравнивается с точностью до секунды
+    same_second = {"status": "planned", "changed_at": iso(T0 + timedelta(microseconds=250))}
+    counts = push(client, [task_item(task_uuid, logs=[log, same_second, {"status": "inProgress", "changed_at": iso(T0)}])])
+    assert counts["logs"] == 2
+    counts = push(client, [task_item(task_uuid, updated_at=T0 + timedelta(minutes=1), logs=[log])])
+    assert counts["logs"] == 0
+    with app.app_context():
+        assert TaskStatusLog.query.filter_by(task_uuid=task_uuid).count() == 2
+
+
+def test_malformed_items_are_skipped(app, client):
+    good = task_item()
+    counts = push(client, [{"task": {"uuid": str(uuid.uuid4())}}, {"task": None}, good])
+    assert (counts["created"], counts["skipped"]) == (1, 2)
+
+
+def test_heterogeneous_rows(app, client):
+    """Пачка из строк с разным набором ключей: старые пиры не передают цепочку повторений."""
+    head, occurrence, plain = (str(uuid.uuid4()) for _ in range(3))
+    push(client, [task_item(occurrence, next_uuid=None, origin_uuid=None)])
+    counts = push(client, [
+        task_item(head, recurrence_seconds=3600, next_uuid=None),
+        task_item(occurrence, updated_at=T0 + timedelta(minutes=1), origin_uuid=head, next_uuid=None),
+        task_item(plain, note="заметка", priority="vital"),
+    ])
+    assert (counts["created"], counts["updated"], counts["skipped"]) == (2, 1, 0)
+    with app.app_context():
+        assert Task.query.filter_by(uuid=occurrence).one().origin_uuid == head
+        plain_task = Task.query.filter_by(uuid=plain).one()
+        assert (plain_task.note, plain_task.priority, plain_task.next_uuid) == ("заметка", "vital", None)
+    # Обновление без ключей цепочки не затирает её
+    push(client, [task_item(occurrence, updated_at=T0 + timedelta(minutes=2))])
+    with app.app_context():
+        assert Task.query.filter_by(uuid=occurrence).one().origin_uuid == head